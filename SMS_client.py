@@ -20,29 +20,33 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-DEFAULT_LOGLEVEL = 'INFO'
-DEFAULT_CONFIGFILE = './verite.conf'
-SPECFILE_EXT = '.spec'
-
 # Standard library
-import sys
-import os.path
-import argparse
 import logging
+import random
 import asyncio
+import importlib
 from socket import AF_INET
 from urllib.parse import urlencode
 from functools import wraps
 
-# Third Party
-import aiohttp
-
 # Application
 import utils
 import daemons
+import jobqueue
+import sessioncache
 
 
 logger = logging.getLogger(__name__)
+server_logger = logging.getLogger(__name__ + '.server')
+
+# Answers of the SMS service meaning the request was refused before any sending
+RETRY_STATUSES = (429, 503)
+# Seconds to wait for the server selection of the SMS recipients
+SELECT_TIMEOUT = 10
+
+def sms_accepted(result):
+    # The SMS service answers with a message id on success, an error text otherwise
+    return not isinstance(result, Exception) and result.strip().isdigit()
 
 def threadsafe_method(func):
     @wraps(func)
@@ -50,36 +54,177 @@ def threadsafe_method(func):
         self._loop.call_soon_threadsafe(func, self, *args)
     return wrapper
 
+class SMSDispatcher:
+    def __init__(self, loop, concurrency=8, rate=10, retries=3, timeout=10, backoff=0.5):
+        self._loop = loop
+        self._concurrency = concurrency
+        self._bucket = utils.TokenBucket(rate, burst=concurrency)
+        self._retries = retries
+        self._timeout = timeout
+        self._backoff = backoff
+        self._session = None
+        self._workers = set()
+        
+    def preload(self):
+        # aiohttp is slow to import and only needed to send SMS: it is imported
+        # in a thread once the client is up rather than before the console shows
+        return self._loop.run_in_executor(None, importlib.import_module, 'aiohttp')
+        
+    def _get_session(self):
+        # One pooled session for the whole client lifetime, keeping connections alive
+        import aiohttp
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._concurrency)
+            timeout = aiohttp.ClientTimeout(total=self._timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+        
+    async def close(self):
+        # Workers still sending are cancelled, their recipients are marked interrupted on the next start
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        
+    async def _throttle(self):
+        while not self._bucket.consume():
+            await asyncio.sleep(1 / self._bucket.rate)
+            
+    async def get(self, url):
+        # Only retry when the SMS surely was not sent: a timeout or another server error
+        # may come after the provider took (and charged) the SMS, it is reported as failed
+        import aiohttp
+        session = self._get_session()
+        for attempt in range(self._retries + 1):
+            await self._throttle()
+            try:
+                async with session.get(url) as response:
+                    text = await response.text()
+                    if response.status < 500 and response.status != 429:
+                        return text
+                    error = aiohttp.ClientResponseError(response.request_info, response.history, 
+                                                        status=response.status, message=text)
+                    if response.status not in RETRY_STATUSES:
+                        raise error
+            except aiohttp.ClientConnectorError as e:
+                error = e
+            if attempt < self._retries:
+                delay = self._backoff * 2 ** attempt * (1 + random.random())
+                logger.debug('Retrying %r in %.2fs after %r', url, delay, error)
+                await asyncio.sleep(delay)
+        raise error
+        
+    async def dispatch(self, base_url, phonelist, result_cb=None, start_cb=None):
+        # Workers share a single iterator over the phonelist
+        pending = iter(phonelist)
+        results = {}
+        
+        async def worker():
+            for number in pending:
+                if start_cb is not None:
+                    start_cb(number)
+                try:
+                    result = await self.get(base_url + number)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    result = e
+                results[number] = result
+                if result_cb is not None:
+                    result_cb(number, result)
+                    
+        workers = [self._loop.create_task(worker()) for _ in range(min(self._concurrency, len(phonelist)))]
+        self._workers.update(workers)
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            self._workers.difference_update(workers)
+        return results
+
+
 class Client(daemons.PickleStreamProtocol):
-    def __init__(self, loop, config, callbacks):
+    def __init__(self, loop, config, callbacks, session_cache=None, dispatch=True):
         self._config = config
         self._globals = config['globals']
         self._sms_conf = config['sms_service']
         super().__init__(loop, **self._globals)
         
         self.connection_state_cb = None
+        self.event_cb = None
+        self.message_cb = None
+        self.session_reset_cb = None
+        self.sms_result_cb = None
+        self.voter_cb = None
+        self.link_stats_cb = None
+        self.cues_cb = None
+        self.cue_state_cb = None
+        self.history_start_cb = None
+        self.history_cb = None
         for name, target in callbacks.items():
             setattr(self, name, target)
+            
+        # Position in the server session, saved by consoles keeping a session cache
+        self._cache = sessioncache.SessionCache(session_cache) if session_cache else None
+        self._session = self._cache.meta if self._cache else dict(sessioncache.META_DEFAULTS)
+        self._synced = False
+        self._cache_commit = None
 
         options = self._sms_conf['send_options'].copy()
         options.update(self._sms_conf['credentials'])
         self._base_sms_url = self._sms_conf['fastapi_url'] + urlencode(options, encoding='utf8') + '&'
         self._credits_url = self._sms_conf['credits_url'] + urlencode(self._sms_conf['credentials'], encoding='utf8')
+        # Only consoles send SMS: headless clients such as the recorder never open
+        # the job queue, so they cannot resume (and pay for) the jobs of a console
+        self._dispatcher = None
+        self._jobs = None
+        self._job_tasks = set()
+        self._selections = {}
+        self._selection_id = 0
+        if dispatch:
+            self._dispatcher = SMSDispatcher(loop, 
+                                             concurrency=self._sms_conf['concurrency'], 
+                                             rate=self._sms_conf['rate'], 
+                                             retries=self._sms_conf['retries'], 
+                                             timeout=self._sms_conf['timeout'], 
+                                             )
+            self._jobs = jobqueue.SMSJobQueue(config['client']['jobs_db'])
         
-    @asyncio.coroutine
-    def setup(self):
-        self._server = yield from self._loop.create_server(lambda: self, port=0, family=AF_INET)
+    async def setup(self):
+        self._server = await self._loop.create_server(lambda: self, port=0, family=AF_INET)
         tcp_port = self._server.sockets[0].getsockname()[1]
         secret_message = utils.forge_secret(self._globals['secret'], tcp_port, self._globals['endianness'])
-        self._scanner = daemons.BroadcastClient(loop=self._loop, secret_message=secret_message, tcp_port=tcp_port, **self._globals)
+        client_conf = self._config['client']
+        self._scanner = daemons.BroadcastClient(loop=self._loop, secret_message=secret_message, tcp_port=tcp_port, 
+                                                min_interval=client_conf['broadcast_min_interval'], 
+                                                max_interval=client_conf['broadcast_max_interval'], 
+                                                **self._globals)
         self._scanner.start()
+        if self._jobs:
+            for job_id, sender, content, phonelist in self._jobs.pending_jobs():
+                logger.warning('Resuming SMS job %d for %d pending recipients', job_id, len(phonelist))
+                self._start_job(self._run_job(job_id, sender, content, phonelist))
+            self._dispatcher.preload()
+        if self._cache:
+            self._replay_cache()
         logger.debug('SMS Client Initialization finished')
         
-    @asyncio.coroutine
-    def stop(self):
-        yield from self._scanner.stop()
+    async def stop(self):
+        await self._scanner.stop()
+        if self._dispatcher:
+            # Jobs are cancelled and awaited before the queue closes under them
+            for task in self._job_tasks:
+                task.cancel()
+            await asyncio.gather(*self._job_tasks, return_exceptions=True)
+            await self._dispatcher.close()
+            self._jobs.close()
+        if self._cache:
+            if self._cache_commit:
+                self._cache_commit.cancel()
+            self._cache.close()
         self._server.close()
-        yield from self._server.wait_closed()
+        await self._server.wait_closed()
         if self._peer_transport:
             logger.critical('Closing TCP transport: %r', self._peer_transport)
             self._peer_transport.close()
@@ -91,83 +236,198 @@ class Client(daemons.PickleStreamProtocol):
         
     @threadsafe_method
     def send_sms(self, sender, content, phonelist, callback):
-        t = self._loop.create_task(self.async_send_sms(sender, content, phonelist))
+        t = self._start_job(self.async_send_sms(sender, content, phonelist))
         t.add_done_callback(callback)
         
-    @asyncio.coroutine
-    def async_send_sms(self, sender, content, phonelist):
+    def _start_job(self, coro):
+        task = self._loop.create_task(coro)
+        self._job_tasks.add(task)
+        task.add_done_callback(self._job_tasks.discard)
+        return task
+        
+    async def async_send_sms(self, sender, content, phonelist):
+        if self._jobs is None:
+            raise RuntimeError('SMS dispatch is disabled for this client')
+        selected = set(await self.select_recipients())
+        recipients = [phone for phone in phonelist if phone in selected]
+        if len(recipients) < len(phonelist):
+            logger.info('%d recipients left out by the server (opt out)', len(phonelist) - len(recipients))
+        job_id = self._jobs.create_job(sender, content, recipients)
+        return await self._run_job(job_id, sender, content, recipients)
+        
+    async def select_recipients(self, **criteria):
+        # Phones of the server phonebook that did not opt out, see phonebook.SELECT_CRITERIA
+        if not self._peer_transport:
+            raise ConnectionError('No server to select the SMS recipients')
+        self._selection_id += 1
+        request_id = self._selection_id
+        future = self._selections[request_id] = self._loop.create_future()
+        self.request_peer('/select', [request_id, criteria])
+        try:
+            return await asyncio.wait_for(future, SELECT_TIMEOUT)
+        finally:
+            del self._selections[request_id]
+        
+    async def _run_job(self, job_id, sender, content, phonelist):
         base_url = self._base_sms_url + urlencode({'sender': sender, 'text': content}, encoding='utf8') + '&to='
-        tasks = []
         
-        with aiohttp.ClientSession() as session:
-            for number in phonelist:
-                task = asyncio.ensure_future(self.timeout_get(base_url + number, session))
-                tasks.append(task)
+        def start_cb(number):
+            self._jobs.mark_sending(job_id, number)
+            
+        def result_cb(number, result):
+            self._jobs.record(job_id, number, sms_accepted(result), 
+                              repr(result) if isinstance(result, Exception) else result)
+            if self.sms_result_cb:
+                self.sms_result_cb(number, result)
                 
-            responses = yield from asyncio.gather(*tasks, loop=self._loop, return_exceptions=True)
-            # gather returns results in the original input order
-            return {p: r for p, r in zip(phonelist, responses)}
+        results = await self._dispatcher.dispatch(base_url, phonelist, result_cb, start_cb)
+        logger.info('SMS job %d done: %d sent out of %d', job_id, sum(map(sms_accepted, results.values())), len(results))
+        return results
         
     @threadsafe_method
     def get_credits(self, callback):
         t = self._loop.create_task(self.async_get_credits())
         t.add_done_callback(callback)
         
-    @asyncio.coroutine
-    def async_get_credits(self):        
-        with aiohttp.ClientSession() as session:
-            return (yield from self.timeout_get(self._credits_url, session))
+    async def async_get_credits(self):        
+        if self._dispatcher is None:
+            raise RuntimeError('SMS dispatch is disabled for this client')
+        return await self._dispatcher.get(self._credits_url)
+        
+    def _replay_cache(self):
+        # The console shows the cached session before the server is even found
+        voters, messages, events = self._cache.voters(), self._cache.messages(), self._cache.events()
+        for voter in voters:
+            if self.voter_cb:
+                self.voter_cb(list(voter))
+        for message in messages:
+            if self.message_cb:
+                self.message_cb(message, None)
+        for event in events:
+            if self.event_cb:
+                self.event_cb(event, None)
+        if self.history_start_cb:
+            self.history_start_cb(self._session['history_start'])
+        logger.info('Session restored from cache: %d events, %d messages, %d voters', 
+                    len(events), len(messages), len(voters))
+        
+    def _cache_changed(self):
+        if self._cache and self._cache_commit is None:
+            self._cache_commit = self._loop.call_later(1, self._commit_cache)
+            
+    def _commit_cache(self):
+        self._cache_commit = None
+        self._cache.commit()
         
-    @asyncio.coroutine
-    def timeout_get(self, url, session):
-        with aiohttp.Timeout(10):
-            response = yield from session.get(url)
-            return (yield from response.text())
+    def process_session(self, payload, timestamp):
+        session_id, reset = payload
+        self._synced = False
+        if reset:
+            # New server session, or too far behind to catch up: the server sends it all again
+            logger.info('Resetting session %r to %r', self._session['session_id'], session_id)
+            self._session.update(session_id=session_id, event_seq=0, message_rev=0, history_start=0)
+            if self._cache:
+                self._cache.clear()
+                self._cache_changed()
+            if self.session_reset_cb:
+                self.session_reset_cb()
+                
+    def process_synced(self, payload, timestamp):
+        # The revisions of the sync are only saved once all its items are in
+        self._session['event_seq'], self._session['message_rev'] = payload
+        self._synced = True
+        self._cache_changed()
+        
+    def process_event(self, payload, timestamp):
+        seq, *event = payload
+        if seq is not None:
+            self._session['event_seq'] = seq
+        if self._cache:
+            self._cache.add_events([event])
+            self._cache_changed()
+        if self.event_cb:
+            self.event_cb(event, timestamp)
+            
+    def process_message(self, payload, timestamp):
+        message, rev = payload[:-1], payload[-1]
+        if self._synced:
+            self._session['message_rev'] = max(self._session['message_rev'], rev)
+        if self._cache:
+            self._cache.put_message(message)
+            self._cache_changed()
+        if self.message_cb:
+            self.message_cb(message, timestamp)
+            
+    def process_voter(self, payload, timestamp):
+        self._session['phonebook_rev'] = max(self._session['phonebook_rev'], payload[-1])
+        if self._cache:
+            self._cache.put_voter(payload)
+            self._cache_changed()
+        if self.voter_cb:
+            self.voter_cb(payload)
+            
+    def process_cues(self, payload, timestamp):
+        if self.cues_cb:
+            self.cues_cb(payload)
+            
+    def process_cue_state(self, payload, timestamp):
+        if self.cue_state_cb:
+            self.cue_state_cb(payload)
+            
+    def process_history_start(self, payload, timestamp):
+        self._session['history_start'] = payload
+        self._cache_changed()
+        if self.history_start_cb:
+            self.history_start_cb(payload)
+            
+    def process_history(self, payload, timestamp):
+        start, events = payload
+        self._session['history_start'] = start
+        if self._cache:
+            self._cache.add_events(events)
+            self._cache_changed()
+        if self.history_cb:
+            self.history_cb(start, events)
+            
+    def process_selection(self, payload, timestamp):
+        request_id, phones = payload
+        future = self._selections.get(request_id)
+        if future is not None and not future.done():
+            future.set_result(phones)
+            
+    def process_log(self, payload, timestamp):
+        levelno, name, message, dropped = payload
+        if dropped:
+            server_logger.warning('%d log records dropped by server rate limiting', dropped)
+        server_logger.log(levelno, '%s: %s', name, message)
             
     ###########################################################################
     # asyncio.Protocol API
     ###########################################################################
     def connection_made(self, transport):
         super().connection_made(transport)
+        self._synced = False
+        session = self._session
+        self.request_peer('/sync', [session['session_id'], session['event_seq'], session['message_rev'], 
+                                    session['phonebook_rev']])
         if self.connection_state_cb:
             self.connection_state_cb(state=True, peername=transport.get_extra_info('peername'))
         
     def connection_lost(self, exc):
+        # Resuming the scanner resets the broadcast pacing: the secret is sent again right away
         super().connection_lost(exc)
+        for future in self._selections.values():
+            if not future.done():
+                future.set_exception(ConnectionError('Server lost during the selection of the SMS recipients'))
         if self.connection_state_cb:
             self.connection_state_cb(state=False, exc=exc)
             
+    def link_stats_changed(self):
+        if self.link_stats_cb:
+            self.link_stats_cb(self.link_stats.as_dict())
+            
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='SMS Server for the show #Vérité')
-    parser.add_argument('-l', '--loglevel', type=str, choices=list(logging._nameToLevel), default=DEFAULT_LOGLEVEL)
-    parser.add_argument('-c', '--configfile', type=open, default=DEFAULT_CONFIGFILE)
-    parser.add_argument('-s', '--specfile', type=open)
-    args = parser.parse_args()
-    logging.basicConfig(level=args.loglevel)
-    
-    configfile = args.configfile
-    if args.specfile:
-        specfile = args.specfile
-    else:
-        root, _ = os.path.splitext(configfile.name) 
-        try:
-            specfile = open(root + SPECFILE_EXT)
-        except OSError:
-            specfile = None
-        
-    try:
-        config = utils.parse_configfile(configfile, configspec=specfile)
-    except utils.ConfigObjError as e:
-        logger.critical('Error in configuration file', exc_info=True)
-        sys.exit(e)
-    finally:
-        configfile.close()
-        if specfile:
-            specfile.close()
-        
-    loop = asyncio.get_event_loop()
-    loop.set_debug(True)
-
-    with Client(loop, config) as client:
-        loop.run_forever()
+    # The headless client records the session stream, see SMS_recorder.py
+    import SMS_recorder
+    SMS_recorder.main()
@@ -21,7 +21,7 @@
 
 
 import kivy
-kivy.require('1.9.1')
+kivy.require('1.10.0')
 
 # Hack to interface standard python logging with kivy's custom logging
 # See http://stackoverflow.com/questions/36106353/using-python-logging-when-logging-root-has-been-redefined-kivy
@@ -38,12 +38,11 @@ from kivy.clock import Clock, mainthread
 from kivy.core.window import Window
 from kivy.properties import ListProperty, DictProperty, StringProperty, ObjectProperty, NumericProperty, BooleanProperty
 from kivy.uix.label import Label
-from kivy.uix.widget import Widget
-from kivy.uix.scrollview import ScrollView
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.stacklayout import StackLayout
 from kivy.uix.togglebutton import ToggleButton
 from kivy.uix.behaviors.togglebutton import ToggleButtonBehavior
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
 
 # Standard library
 import sys
@@ -52,6 +51,7 @@ import os.path
 import argparse
 import asyncio
 from threading import Thread
+from collections import deque
 
 # Application
 import utils
@@ -79,6 +79,24 @@ RGB_COLORS = {'black': [0, 0, 0],
               
 RGBA_COLORS = {name: values + [1] for name, values in RGB_COLORS.items()}
 
+EVENT_COLORS = {utils.EventTypes.vrai: RGB_COLORS['dark_green'], 
+                utils.EventTypes.faux: RGB_COLORS['dark_red'], 
+                utils.EventTypes.message: RGB_COLORS['blue'], 
+                utils.EventTypes.sondage: RGB_COLORS['black'], 
+                utils.EventTypes.fin_sondage: RGB_COLORS['grey'], 
+                utils.EventTypes.vote: RGB_COLORS['black'], 
+               }
+
+# Colors of the poll choices in configuration order, set by choice in VOTE_COLORS at startup
+CHOICE_PALETTE = [RGB_COLORS[name] for name in ('dark_green', 'dark_red', 'blue', 'grey', 'green', 'red')]
+VOTE_COLORS = {}
+
+# Timeline filter categories, as toggled in the GUI
+EVENT_CATEGORIES = {'votes': set(utils.VOTE_TYPES), 
+                    'messages': {utils.EventTypes.message}, 
+                    'sondages': {utils.EventTypes.sondage, utils.EventTypes.fin_sondage}, 
+                   }
+
 
 class KivyLogHandler(logging.Handler):
     def emit(self, record):
@@ -89,59 +107,79 @@ class KivyLogHandler(logging.Handler):
 logger.addHandler(KivyLogHandler())
 
 
-class Tooltip(Label):
-    pass
+class FrameQueue:
+    # Filled from the asyncio thread, drained on the Kivy thread once per frame.
+    # deque.append and deque.popleft are atomic, no lock is needed
+    def __init__(self, budget, chunk_size=128):
+        self._items = deque()
+        self.budget = budget
+        self.chunk_size = chunk_size
+        
+    def __len__(self):
+        return len(self._items)
+        
+    def put(self, kind, key, payload):
+        self._items.append((kind, key, payload))
+        
+    def chunks(self):
+        deadline = time.perf_counter() + self.budget
+        items = self._items
+        while items and time.perf_counter() < deadline:
+            chunk = []
+            for _ in range(min(self.chunk_size, len(items))):
+                chunk.append(items.popleft())
+            yield chunk
 
 
-class TooltipBehavior(Widget):
-    _tooltip = StringProperty()
+class Tooltip(Label):
+    pass
 
 
-class SMS(StackLayout):
+class SMS(RecycleDataViewBehavior, StackLayout):
     _id = NumericProperty()
     phone = StringProperty()
     content = StringProperty()
     to_display = BooleanProperty()
     displayed = BooleanProperty()
+    count = NumericProperty(1)
+    flagged = BooleanProperty(False)
 
 
-class Voter(Label, ToggleButtonBehavior, TooltipBehavior):
+class Voter(RecycleDataViewBehavior, ToggleButtonBehavior, Label):
     phone = StringProperty()
+    send_status = StringProperty()
     pedigree = StringProperty('?')
     color = ListProperty(RGB_COLORS['black'])
-    send_status = StringProperty()
     enabled = BooleanProperty(True)
+    opt_out = BooleanProperty(False)
     
-    def on_send_status(self, instance, value):
-        self.color = RGB_COLORS['dark_green2'] if value.isdigit() else RGB_COLORS['dark_red2']
-        self._tooltip = str(value)
-        
     def on_state(self, instance, value):
         self.enabled = (value == 'normal')
+        App.get_running_app().root.set_voter_enabled(self.phone, self.enabled)
+        
+    def on_touch_down(self, touch):
+        # Right click toggles the opt out of the phone, kept in the server phonebook
+        if self.collide_point(*touch.pos) and 'button' in touch.profile and touch.button == 'right':
+            App.get_running_app().root.set_opt_out(self.phone, not self.opt_out)
+            return True
+        return super().on_touch_down(touch)
             
         
-class EventWidget(Label, TooltipBehavior):
+class EventRow(RecycleDataViewBehavior, Label):
     color = ListProperty(RGB_COLORS['white'])
-    
-    def __init__(self, timestamp, phone, data, type, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.timestamp = timestamp[-6:-4] + 'h' + timestamp[-4:-2] + 'm' + timestamp[-2:] +'s'
-        self.phone = phone
-        self.type = type
-        self.data = data
-        if type == utils.EventTypes.vrai:
-            color = RGB_COLORS['dark_green']
-        elif type == utils.EventTypes.faux:
-            color = RGB_COLORS['dark_red']
-        elif type == utils.EventTypes.message:
-            color = RGB_COLORS['blue']
-        elif type == utils.EventTypes.sondage:
-            color = RGB_COLORS['black']
-        elif type == utils.EventTypes.fin_sondage:
-            color = RGB_COLORS['grey']
-            
-        self.text = self.timestamp + '    ' + self.phone + '    ' + self.data
-        self.color = color
+    phone = StringProperty()
+
+
+def event_row(event):
+    timestamp = event.timestamp
+    timestamp = timestamp[-6:-4] + 'h' + timestamp[-4:-2] + 'm' + timestamp[-2:] +'s'
+    color = EVENT_COLORS[event.type]
+    if event.type == utils.EventTypes.vote:
+        color = VOTE_COLORS.get(event.data, color)
+    return {'text': timestamp + '    ' + event.phone + '    ' + event.data, 
+            'color': color, 
+            'phone': event.phone, 
+            }
     
     
 class SMSClient(BoxLayout):
@@ -150,12 +188,18 @@ class SMSClient(BoxLayout):
     popup = ObjectProperty()
     tooltip = ObjectProperty()
     messages = DictProperty()
-    timeline = ListProperty()
+    timeline_count = NumericProperty()
+    history_left = NumericProperty()
     timeline_view = ObjectProperty()
+    timeline_categories = ListProperty()
+    timeline_phone = StringProperty()
     phonebook = DictProperty()
     phonebook_view = ObjectProperty()
+    phonebook_filtered = ListProperty()
     connected = BooleanProperty(False)
     connection_status = StringProperty('Server not connected')
+    link_status = StringProperty()
+    cue_status = StringProperty('Pas de conduite')
     sms_service_connected = BooleanProperty(False)
     sms_service_status = StringProperty('SMS Service not contacted')
     
@@ -166,36 +210,44 @@ class SMSClient(BoxLayout):
             logger.debug('SEND OSC New Message with content %r', content)
             self.send_osc('/newmessage', [content])
         
-    def delete_message(self, sms):
-        id = sms._id
-        sms.parent.remove_widget(sms)
-        if id in self.messages:
-            del self.messages[id]
-        else:
-            logger.error('Deletion of SMS not in messages: %r, %r', id, sms.content)
+    def _refresh_columns(self, *args):
+        self.available.data = list(self._columns[False].values())
+        self.displayed.data = list(self._columns[True].values())
+        
+    def delete_message(self, id):
+        message = self.messages.pop(id, None)
+        if message is None:
+            logger.error('Deletion of SMS not in messages: %r', id)
+            return
+        del self._columns[message['to_display']][id]
+        self._columns_trigger()
         self.send_osc('/delete', [id])
         logger.debug('DELETE Message id: %r', id)
         
-    def change_column(self, sms):
-        to_display = not sms.to_display
-        sms.to_display = to_display
-        neighbour = self.displayed if to_display else self.available
-        sms.parent.remove_widget(sms)
-        neighbour.add_widget(sms)
-        self.send_osc('/to_display', [sms._id, to_display])
+    def change_column(self, id):
+        message = self.messages[id]
+        to_display = not message['to_display']
+        del self._columns[message['to_display']][id]
+        message['to_display'] = to_display
+        self._columns[to_display][id] = message
+        self._columns_trigger()
+        self.send_osc('/to_display', [id, to_display])
         
-    def set_pedigree(self, sms):
-        if sms.phone != CLIENT_ID:
-            self.phonebook[sms.phone].pedigree = sms.content
-        self.delete_message(sms)
+    def set_pedigree(self, id):
+        message = self.messages[id]
+        phone = message['phone']
+        if phone in self.phonebook:
+            self.phonebook[phone]['pedigree'] = message['content']
+            self._phonebook_trigger()
+            self.send_osc('/pedigree', [phone, message['content']])
+        self.delete_message(id)
         
     def set_displayed(self):
-        for sms in self.available.children:
-            sms.displayed = False
-        for sms in self.displayed.children:
-            sms.displayed = True
-        # Children are stored from bottom to top
-        ids = [sms._id for sms in reversed(self.displayed.children)]
+        for to_display, column in self._columns.items():
+            for message in column.values():
+                message['displayed'] = to_display
+        self._columns_trigger()
+        ids = list(self._columns[True])
         self.send_osc('/messages', ids)
         logger.debug('DISPLAY: %r', ids)
         
@@ -215,22 +267,35 @@ class SMSClient(BoxLayout):
     def send_sms(self, popup, sender_input, sms_input):
         sender = sender_input.text
         content = sms_input.text
-        phonelist = [phone for phone, voter in self.phonebook.items() if voter.enabled]
+        phonelist = [phone for phone, voter in self.phonebook.items() if voter['enabled'] and not voter['opt_out']]
         popup.dismiss()
         if content and sender and phonelist:
             logger.info('Sending SMS with sender: %r content: %r', sender, content)
             self._client.send_sms(sender, content, phonelist, self.sms_callback)
             sms_input.text = ''
             
+    def sms_result_callback(self, phone, result):
+        # One call per recipient from the asyncio thread, applied with the other updates of a frame
+        result = result.__repr__() if isinstance(result, Exception) else result.replace('\n', '00')
+        self._updates.put('sms_result', phone, result)
+        
+    def _apply_sms_result(self, phone, result):
+        voter = self.phonebook.get(phone)
+        if voter is not None:
+            voter['color'] = RGB_COLORS['dark_green2'] if result.isdigit() else RGB_COLORS['dark_red2']
+            voter['send_status'] = result
+            self._phonebook_trigger()
+        logger.debug('GOT SMS RESPONSE for %r: %r', phone, result)
+            
     @mainthread
     def sms_callback(self, future):
+        if future.cancelled():
+            logger.warning('SMS sending interrupted, recipients not reached yet are sent on the next start')
+            return
         try:
             result = future.result()
-            for phone, res in result.items():
-                res = res.__repr__() if isinstance(res, Exception) else res.replace('\n', '00')
-                result[phone] = res
-                self.phonebook[phone].send_status = res
-            logger.info('GOT SMS RESPONSE: %r', result)
+            failed = sum(isinstance(res, Exception) for res in result.values())
+            logger.info('SMS SENT to %d numbers, %d failed', len(result), failed)
         except Exception as e:
             result = e
             logger.error('SMS RESPONSE ERROR: %r', result)
@@ -251,32 +316,163 @@ class SMSClient(BoxLayout):
             self.sms_service_status = 'Highpush credits unavailable: {}'.format(e.__repr__())
             logger.error('Credits callback failed with error: %r', result)
 
-    @mainthread
-    def process_event(self, payload, timestamp):
-        event = utils.Event(*payload)
-        phone = event.phone
-        if phone != CLIENT_ID and phone not in self.phonebook:
-            voter = Voter(phone=phone)
+    def _refresh_phonebook(self, *args):
+        self.phonebook_view.refresh_from_data()
+        
+    def _get_voter(self, phone):
+        voter = self.phonebook.get(phone)
+        if voter is None:
+            voter = {'phone': phone, 'pedigree': '?', 'enabled': True, 'state': 'normal', 
+                     'opt_out': False, 'color': RGB_COLORS['black'], 'send_status': ''}
             self.phonebook[phone] = voter
-            self.phonebook_view.add_widget(voter)
-        widget = EventWidget(*event)
-        if phone != CLIENT_ID:
-            widget._tooltip = self.phonebook[phone].pedigree
-            self.phonebook[phone].bind(pedigree=widget.setter('_tooltip'))
-        else:
-            widget._tooltip = 'client'
-        index = utils.insort_record(self.timeline, event)
-        self.timeline_view.add_widget(widget, index=index)
-        logger.debug('GOT EVENT %r from phone %r', event, phone)
+            if self._phonebook_match(phone):
+                self.phonebook_filtered.append(voter)
+        return voter
+        
+    def _phonebook_match(self, phone):
+        return not self.timeline_phone or self.timeline_phone in phone
+        
+    def set_voter_enabled(self, phone, enabled):
+        voter = self.phonebook[phone]
+        voter['enabled'] = enabled
+        voter['state'] = 'normal' if enabled else 'down'
+        
+    def set_opt_out(self, phone, opt_out):
+        self.phonebook[phone]['opt_out'] = opt_out
+        self._phonebook_trigger()
+        self.send_osc('/opt_out', [phone, opt_out])
+
+    ###########################################################################
+    # Updates from the asyncio thread, applied in batches on each frame
+    ###########################################################################
+    def process_voter(self, payload):
+        self._updates.put('voter', payload[0], payload)
+        
+    def process_event(self, payload, timestamp):
+        self._updates.put('event', None, payload)
         
-    @mainthread
     def process_message(self, payload, timestamp):
-        _id, phone, content, to_display, displayed = payload
+        self._updates.put('message', payload[0], payload)
+        
+    def session_reset(self):
+        self._updates.put('reset', None, None)
+        
+    def _drain_updates(self, dt):
+        for chunk in self._updates.chunks():
+            events = []
+            # Only the last update of a message or a voter in a chunk matters
+            merged = {}
+            for kind, key, payload in chunk:
+                if kind == 'event':
+                    events.append(payload)
+                elif kind == 'reset':
+                    # Queued events and messages belong to the dropped session, the phonebook stays
+                    events = []
+                    merged = {k: v for k, v in merged.items() if k[0] in ('voter', 'sms_result')}
+                    self._clear_session()
+                elif kind == 'history':
+                    self._history_pending = None
+                    self.history_left = payload
+                else:
+                    merged[kind, key] = payload
+            if events:
+                self._apply_events(events)
+            for (kind, key), payload in merged.items():
+                if kind == 'message':
+                    self._apply_message(payload)
+                elif kind == 'sms_result':
+                    self._apply_sms_result(key, payload)
+                else:
+                    self._apply_voter(payload)
+                    
+    def _clear_session(self):
+        self.timeline = []
+        self._timeline_filtered = []
+        self.timeline_view.data = []
+        self.timeline_count = 0
+        self.history_left = 0
+        self.messages.clear()
+        for column in self._columns.values():
+            column.clear()
+        self._columns_trigger()
+        
+    def _apply_voter(self, payload):
+        phone, first_seen, last_seen, messages, votes, pedigree, opt_out, rev = payload
+        voter = self._get_voter(phone)
+        voter['pedigree'] = pedigree or '?'
+        voter['opt_out'] = bool(opt_out)
+        self._phonebook_trigger()
+
+    def _apply_events(self, payloads):
+        data = self.timeline_view.data
+        for payload in payloads:
+            event = utils.Event(*payload)
+            phone = event.phone
+            if phone != CLIENT_ID:
+                self._get_voter(phone)
+            utils.insort_record(self.timeline, event)
+            if self._timeline_match(event):
+                index = utils.insort_record(self._timeline_filtered, event)
+                data.insert(index, event_row(event))
+            logger.debug('GOT EVENT %r from phone %r', event, phone)
+        self.timeline_count = len(self.timeline)
+        
+    def history_start(self, position):
+        # Events of the server timeline before this position are only sent on request.
+        # Queued with the events so that a session reset still pending cannot override it
+        self._updates.put('history', None, position)
+        
+    def history_page(self, start, events):
+        for event in events:
+            self._updates.put('event', None, event)
+        self.history_start(start)
+        
+    def load_history(self):
+        # One page at a time: a request repeated before its page arrives would get the same events
+        if self.history_left and self._history_pending is None:
+            self._history_pending = self.history_left
+            self.send_osc('/history', [self.history_left, self._history_page_size])
+            
+    def _timeline_match(self, event):
+        if self.timeline_phone and self.timeline_phone not in event.phone:
+            return False
+        if self.timeline_categories:
+            return any(event.type in EVENT_CATEGORIES[c] for c in self.timeline_categories)
+        return True
+        
+    def toggle_timeline_category(self, category, enabled):
+        categories = [c for c in self.timeline_categories if c != category]
+        if enabled:
+            categories.append(category)
+        self.set_timeline_filter(categories=categories)
+        
+    def set_timeline_filter(self, categories=None, phone=None):
+        if categories is not None:
+            self.timeline_categories = categories
+        if phone is not None:
+            self.timeline_phone = phone
+            self.phonebook_filtered = [voter for p, voter in self.phonebook.items() if self._phonebook_match(p)]
+        # Filtering only touches the data model, the view recycles its rows
+        self._timeline_filtered = [event for event in self.timeline if self._timeline_match(event)]
+        self.timeline_view.data = [event_row(event) for event in self._timeline_filtered]
+        
+    def _apply_message(self, payload):
+        _id, phone, content, to_display, displayed, count, flagged = payload
         phone = phone or ''
-        sms = SMS(_id=_id, phone=phone, content=content, to_display=to_display, displayed=displayed)
-        self.messages[_id] = sms
-        column = self.displayed if to_display else self.available
-        column.add_widget(sms)
+        previous = self.messages.get(_id)
+        if previous is not None:
+            del self._columns[previous['to_display']][_id]
+        if not content:
+            # Deleted message, possibly from another console or before a restart
+            self.messages.pop(_id, None)
+            self._columns_trigger()
+            return
+        message = {'_id': _id, 'phone': phone, 'content': content, 
+                   'to_display': to_display, 'displayed': displayed, 
+                   'count': count, 'flagged': flagged}
+        self.messages[_id] = message
+        self._columns[to_display][_id] = message
+        self._columns_trigger()
         logger.debug('ADD Message _id: %r, content: %r', _id, content)
         
         
@@ -288,20 +484,94 @@ class SMSClient(BoxLayout):
         else:
 #            TODO: if server restarts, how to keep show data consistent ?
             self.connection_status = 'Server disconnected:\n{}'.format(kwargs['exc'])
+            self.link_status = ''
+            # The requested page is lost with the connection
+            self._history_pending = None
+            
+    @mainthread
+    def link_stats(self, stats):
+        self.link_status = '\nRTT {:.1f} ms, jitter {:.1f} ms'.format(stats['srtt'] * 1000, stats['jitter'] * 1000)
+        if stats['raw_received']:
+            self.link_status += '\nReçu {:.0f} ko, {:.0%} sur le réseau'.format(stats['raw_received'] / 1000, 
+                                                                          stats['wire_received'] / stats['raw_received'])
+        
+    @mainthread
+    def cue_list(self, cues):
+        self._cue_list = cues
+        self._refresh_cue_status()
+        
+    @mainthread
+    def cue_state(self, state):
+        self._cue_state = state + [time.monotonic()]
+        self._refresh_cue_status()
+        
+    def _refresh_cue_status(self, *args):
+        if not self._cue_list:
+            self.cue_status = 'Pas de conduite'
+            return
+        position, running, show_time, received = self._cue_state
+        if running:
+            show_time += time.monotonic() - received
+        status = '{} {:02.0f}:{:02.0f}  ({}/{})'.format('EN COURS' if running else 'PAUSE', *divmod(show_time, 60), 
+                                                      position, len(self._cue_list))
+        if position < len(self._cue_list):
+            at, label = self._cue_list[position]
+            status += '\nSuivant [{}] à {:02.0f}:{:02.0f} : {}'.format(position, *divmod(at, 60), label)
+        else:
+            status += '\nFin de la conduite'
+        self.cue_status = status
+        
+    def cue_command(self, command, *args):
+        self.send_osc('/cue', [command] + list(args))
+        logger.debug('CUE command %r %r', command, args)
+        
+    def cue_jump(self, input):
+        if input.text.isdigit():
+            self.cue_command('jump', int(input.text))
+            input.text = ''
             
     def send_osc(self, address, params=[]):
         self._client.request_server(address, params)
             
     def _start_thread(self, loop, config):
-        callbacks = {'process_event': self.process_event, 
-                     'process_message': self.process_message, 
+        callbacks = {'event_cb': self.process_event, 
+                     'message_cb': self.process_message, 
+                     'session_reset_cb': self.session_reset, 
                      'connection_state_cb': self.connection_state, 
+                     'link_stats_cb': self.link_stats, 
+                     'sms_result_cb': self.sms_result_callback, 
+                     'voter_cb': self.process_voter, 
+                     'cues_cb': self.cue_list, 
+                     'cue_state_cb': self.cue_state, 
+                     'history_start_cb': self.history_start, 
+                     'history_cb': self.history_page, 
                      }
         self._asyncio_loop = loop
+        choices = config['poll']['choices']
+        VOTE_COLORS.update(zip(choices, CHOICE_PALETTE * (len(choices) // len(CHOICE_PALETTE) + 1)))
+        self.timeline = []
+        self._timeline_filtered = []
+        self._history_page_size = config['timeline']['history_page']
+        self._history_pending = None
+        self._updates = FrameQueue(config['client']['frame_budget'])
+        Clock.schedule_interval(self._drain_updates, 0)
+        # Message columns keyed by to_display, ordered by arrival
+        self._columns = {False: {}, True: {}}
+        self._columns_trigger = Clock.create_trigger(self._refresh_columns)
+        self._phonebook_trigger = Clock.create_trigger(self._refresh_phonebook)
+        self._cue_list = []
+        self._cue_state = [0, False, 0, 0]
+        Clock.schedule_interval(self._refresh_cue_status, 1)
         self._thread = Thread(target=self._thread_job, args=(loop, config, callbacks), name='Client Asyncio Thread')
         self._thread.start()
         
         self.tooltip = Tooltip()
+        # Tooltip text is looked up from the row data under the cursor, on hover only
+        self._tooltip_sources = [(self.timeline_view, self._event_tooltip), 
+                                 (self.phonebook_view, lambda row: row['send_status']), 
+                                 (self.available, lambda row: row['content']), 
+                                 (self.displayed, lambda row: row['content']), 
+                                 ]
         self.schedule_tooltip = Clock.create_trigger(self.display_tooltip, 1)
         Window.bind(mouse_pos=self.on_motion)
         Window.bind(on_motion=self.on_motion)
@@ -318,20 +588,8 @@ class SMSClient(BoxLayout):
         pos = Window.mouse_pos
         t = self.tooltip
         
-        text = ''
-        next_ = []
-        candidates = [self]
-        while candidates and text == '':
-            for child in (child for widget in candidates for child in widget.children):
-                point = pos if isinstance(child, ScrollView) else child.to_widget(*pos)
-                if child.collide_point(*point):
-                    if hasattr(child, '_tooltip'):
-                        text = child._tooltip
-                        break
-                    next_.append(child)
-            candidates, next_ = next_, []
-            
-        if text == '':
+        text = self._tooltip_text(pos)
+        if not text:
             return
         t.text = text
         t.text_size = None, None
@@ -343,10 +601,27 @@ class SMSClient(BoxLayout):
         t.y = pos[1] if pos[1] + t.height <= Window.height else pos[1] - t.height
         Window.add_widget(self.tooltip)
         
+    def _tooltip_text(self, pos):
+        for view, get_text in self._tooltip_sources:
+            # Views of hidden tabs are detached from the window
+            if view.get_root_window() is None or not view.collide_point(*view.to_widget(*pos)):
+                continue
+            layout = view.layout_manager
+            # Binary search over the computed row positions
+            index = layout.get_view_index_at(layout.to_widget(*pos))
+            if 0 <= index < len(view.data):
+                return get_text(view.data[index])
+            return ''
+        return ''
+        
+    def _event_tooltip(self, row):
+        voter = self.phonebook.get(row['phone'])
+        return voter['pedigree'] if voter else 'client'
+        
     def _thread_job(self, loop, config, callbacks):
         logger.debug('STARTING asyncio thread')
         asyncio.set_event_loop(loop)
-        with Client(loop, config, callbacks) as client:
+        with Client(loop, config, callbacks, session_cache=config['client']['session_cache']) as client:
             self._client = client
             loop.run_forever()
         logger.debug('STOPPED asyncio thread')
@@ -354,48 +629,42 @@ class SMSClient(BoxLayout):
 
 class SMSClientApp(App):
 #    TODO: handle KeyboardInterrupt properly    
-#    TODO: transform asyncio callbacks into a Queue
-    def __init__(self, config, *args, **kwargs):
+    def __init__(self, config, profile, *args, debug=False, **kwargs):
         super().__init__(*args, **kwargs)
         self._config = config
-        loop = asyncio.get_event_loop()
-        loop.set_debug(True)
+        self._profile = profile
+        loop = utils.new_event_loop(config['globals']['event_loop'])
+        loop.set_debug(debug)
         self._asyncio_loop = loop
         
     def build(self):
-        return SMSClient()
+        root = SMSClient()
+        self._profile.mark('build')
+        return root
         
     def on_start(self):
-        self._filename = 'Verite_Phonebook_' + time.strftime('%Y-%m-%d_%Hh%M')
         self.root._start_thread(self._asyncio_loop, self._config)
+        Clock.schedule_once(self._first_frame, 0)
+        
+    def _first_frame(self, dt):
+        self._profile.mark('first frame')
+        self._profile.report()
     
     def on_stop(self):
         if self._asyncio_loop.is_running():
             self._asyncio_loop.call_soon_threadsafe(self._asyncio_loop.stop)
         self.root._thread.join()
         
-#        directory = os.path.join(os.path.abspath(self.directory), 'phonebooks')
-#        if not os.path.exists(directory):
-#            try:
-#                os.mkdir(directory)
-#            except OSError as e:
-#                logger.error("Couldn't create directory %r: %r", directory, e)
-#        try:
-#            relpath = os.path.join(directory, self._filename)
-#            with open(relpath, 'w') as f:
-#                for phone in self.root.phonebook:
-#                    f.write(phone + '\n')
-#        except OSError as e:
-#            logger.error("Couldn't write phonebook to file %r: %r", relpath, e)
-#        logger.debug('Phonebook written to %r', os.path.abspath(relpath))
-        
         
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='SMS Server for the show #Vérité')
     parser.add_argument('-l', '--loglevel', type=str, choices=list(logging._nameToLevel), default=DEFAULT_LOGLEVEL)
     parser.add_argument('-c', '--configfile', type=open, default=DEFAULT_CONFIGFILE)
     parser.add_argument('-s', '--specfile', type=open)
+    parser.add_argument('--profile-startup', action='store_true', 
+                        help='Report startup timings on stderr, see python -X importtime for the imports')
     args = parser.parse_args()
+    profile = utils.StartupProfile(args.profile_startup)
 #    logging.basicConfig(level=args.loglevel) #, format='%(levelname)s:%(name)s:%(message)s')
     Logger.setLevel(args.loglevel)
     logger.setLevel(args.loglevel)
@@ -411,13 +680,14 @@ if __name__ == '__main__':
             specfile = None
         
     try:
-        config = utils.parse_configfile(configfile, configspec=specfile)
-    except utils.ConfigObjError as e:
+        config = utils.load_config(configfile, specfile)
+    except utils.ConfigError as e:
         logger.critical('Error in configuration file', exc_info=True)
         sys.exit(e)
     finally:
         configfile.close()
         if specfile:
             specfile.close()
+    profile.mark('configuration')
             
-    SMSClientApp(config).run()
+    SMSClientApp(config, profile, debug=args.loglevel == 'DEBUG').run()
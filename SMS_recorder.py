@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) 2017 Benoit Bregeault
+
+# ---------------------------------------------------------------------
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Standard library
+import sys
+import gzip
+import json
+import time
+import os.path
+import argparse
+import logging
+
+# Application
+import utils
+from SMS_client import Client
+
+DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+
+DEFAULT_LOGLEVEL = 'INFO'
+DEFAULT_CONFIGNAME = 'verite.conf'
+SPECFILE_EXT = '.spec'
+DEFAULT_CONFIGFILE = os.path.join(DIRECTORY, DEFAULT_CONFIGNAME)
+DEFAULT_ARCHIVE = 'Verite_Session_{}.jsonl.gz'
+
+
+logger = logging.getLogger('SMS Recorder')
+
+
+class SessionRecorder:
+    def __init__(self, loop, path, flush_interval=1, report_interval=5, compresslevel=6, history_page=500):
+        self._loop = loop
+        self.client = None
+        self._history_page = history_page
+        self.path = path
+        self._file = gzip.open(path, 'at', encoding='utf8', compresslevel=compresslevel)
+        self._lines = []
+        self._flush_interval = flush_interval
+        self._report_interval = report_interval
+        self._counts = {'event': 0, 'message': 0, 'voter': 0}
+        self._reported = dict(self._counts)
+        self._report_time = time.monotonic()
+        self._flush_handle = None
+        self._report_handle = None
+
+    def __repr__(self):
+        return "{}('{}')".format(self.__class__.__qualname__, self.path)
+
+    def callbacks(self):
+        return {'event_cb': self.record_event,
+                'message_cb': self.record_message,
+                'voter_cb': self.record_voter,
+                'history_start_cb': self.request_history,
+                'history_cb': self.record_history,
+                'connection_state_cb': self.connection_state,
+                }
+
+    def start(self):
+        self._flush_handle = self._loop.call_later(self._flush_interval, self._periodic_flush)
+        self._report_handle = self._loop.call_later(self._report_interval, self._report)
+
+    def close(self):
+        for handle in (self._flush_handle, self._report_handle):
+            if handle:
+                handle.cancel()
+        self.flush()
+        self._file.close()
+        logger.info('Session archived to %r: %r', self.path, self._counts)
+
+    def _record(self, kind, timestamp, payload):
+        self._counts[kind] += 1
+        self._lines.append(json.dumps([kind, timestamp, payload], ensure_ascii=False))
+
+    def record_event(self, payload, timestamp):
+        self._record('event', timestamp, list(payload))
+
+    def record_message(self, payload, timestamp):
+        self._record('message', timestamp, payload)
+
+    def record_voter(self, payload):
+        self._record('voter', None, payload)
+
+    def record_history(self, start, events):
+        for event in events:
+            self.record_event(event, None)
+        self.request_history(start)
+
+    def request_history(self, before):
+        # The server only sends its recent events on connection: the older ones
+        # are paged until the start of the session so that the archive is complete
+        if before > 0 and self.client:
+            self.client.request_peer('/history', [before, self._history_page])
+
+    def connection_state(self, state, **kwargs):
+        logger.info('Connection state: %r %r', state, kwargs)
+
+    def flush(self):
+        if self._lines:
+            self._lines.append('')
+            self._file.write('\n'.join(self._lines))
+            self._lines = []
+        # A gzip flush ends a deflate block: the archive stays readable up to here
+        self._file.flush()
+
+    def _periodic_flush(self):
+        self.flush()
+        self._flush_handle = self._loop.call_later(self._flush_interval, self._periodic_flush)
+
+    def _report(self):
+        now = time.monotonic()
+        elapsed = now - self._report_time
+        rates = ', '.join('{:.1f} {}/s'.format((self._counts[k] - self._reported[k]) / elapsed, k)
+                          for k in self._counts)
+        logger.info('Throughput: %s (total %r)', rates, self._counts)
+        self._reported = dict(self._counts)
+        self._report_time = now
+        self._report_handle = self._loop.call_later(self._report_interval, self._report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless session recorder for the show #Vérité')
+    parser.add_argument('-l', '--loglevel', type=str, choices=list(logging._nameToLevel), default=DEFAULT_LOGLEVEL)
+    parser.add_argument('-c', '--configfile', type=open, default=DEFAULT_CONFIGFILE)
+    parser.add_argument('-s', '--specfile', type=open)
+    parser.add_argument('-o', '--output', type=str, default=DEFAULT_ARCHIVE.format(time.strftime('%Y%m%d_%H%M%S')))
+    parser.add_argument('-f', '--flush-interval', type=float, default=1)
+    parser.add_argument('-r', '--report-interval', type=float, default=5)
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
+
+    configfile = args.configfile
+    if args.specfile:
+        specfile = args.specfile
+    else:
+        root, _ = os.path.splitext(configfile.name)
+        try:
+            specfile = open(root + SPECFILE_EXT)
+        except OSError:
+            specfile = None
+
+    try:
+        config = utils.load_config(configfile, specfile)
+    except utils.ConfigError as e:
+        logger.critical('Error in configuration file', exc_info=True)
+        sys.exit(e)
+    finally:
+        configfile.close()
+        if specfile:
+            specfile.close()
+
+    loop = utils.new_event_loop(config['globals']['event_loop'])
+    recorder = SessionRecorder(loop, args.output, args.flush_interval, args.report_interval, 
+                               history_page=config['timeline']['history_page'])
+    recorder.start()
+    try:
+        with Client(loop, config, recorder.callbacks(), dispatch=False) as client:
+            recorder.client = client
+            loop.run_forever()
+    finally:
+        recorder.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -25,13 +25,22 @@ import re
 import sys
 import time
 import os.path
+import heapq
+import uuid
 import argparse
 import logging
 import asyncio
+from functools import partial
+from collections import OrderedDict, Counter, deque
 
 # Application
 import utils
 import daemons
+import phonebook
+import classifier
+import moderation
+import cues
+import timeline
 from utils import CLIENT_ID
 
 DIRECTORY = os.path.dirname(os.path.realpath(__file__))
@@ -43,10 +52,12 @@ DEFAULT_CONFIGFILE = os.path.join(DIRECTORY, DEFAULT_CONFIGNAME)
 
 
 
-OSC_VRAI = utils.CustomOscMessage('/vrai')
-OSC_FAUX = utils.CustomOscMessage('/faux')
-OSC_RESET = utils.CustomOscMessage('/reponses', [0, 0])
+RECENT_SMS_SIZE = 10000
+COUNT_UPDATE_DELAY = 0.5
+SQL_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
 OSC_FINSONDAGE = utils.CustomOscMessage('/finsondage', [])
+MESSAGES_SEPARATOR = '        '
 
 
 logger = logging.getLogger('SMS Server')
@@ -54,139 +65,396 @@ logger = logging.getLogger('SMS Server')
 
 
 class Server(daemons.PickleStreamProtocol):
-    def __init__(self, loop, config):
+    # One show: its console, display, inboxes and session state. The broadcast
+    # scanner and the worker processes are given by the SessionHost
+    def __init__(self, loop, config, name='', scanner=None, pool=None):
+        self.name = name
+        # Records of this session are tagged, so that only its console receives them
+        self._logger = logging.LoggerAdapter(logger, {'session': name})
         self._config = config
         self._globals = config['globals']
         self._regex = config['regex']
-
-        # SMS storage structures
-        self._timeline = []
+        self._sender_pattern = re.compile(self._regex['sender_pattern'])
+        
+        # Votes and automatic network SMS are recognized in a single regex pass
+        poll_conf = config['poll']
+        self._reader = classifier.SMSReader(self._regex['sms_pattern'], classifier.Classifier.from_config(poll_conf))
+        choices = self._reader.classifier.choices
+        self._osc_votes = [utils.CustomOscMessage('/' + choice.lower()) for choice in choices]
+        self._osc_reset = utils.CustomOscMessage('/reponses', [0] * len(choices))
+        
+        # Optional worker processes reading and classifying inbox files, results are ingested in order
+        self._pool = pool
+        self._read_batch = []
+        self._pending_reads = deque()
+        
+        # Scripted show: cue list with the OSC messages of each cue encoded beforehand
+        cue_conf = config['cues']
+        self._cues = None
+        if cue_conf['file']:
+            cue_list = cues.load_cues(cue_conf['file'])
+            self._cue_messages = [self._encode_cue(cue) for cue in cue_list]
+            self._cues = cues.CueScheduler(loop, cue_list, self._fire_cue, self._cue_state_changed, 
+                                           late_warning=cue_conf['late_warning'], logger=self._logger)
+        
+        # Moderation of messages: flagged words and index of messages by fingerprint
+        self._moderator = moderation.Moderator.from_config(config['moderation'])
+        self._fingerprints = {}
+        self._count_updates = set()
+        # SMS asking to receive no more SMS, compared by fingerprint
+        self._opt_out_keywords = set(map(moderation.fingerprint, config['server']['opt_out_keywords']))
+        self._opt_out_keywords.discard('')
+        
+        # Per phone rate limiting of the ingestion, by event type
+        rate_conf = self._rate_conf = config['rate_limit']
+        self._rate_limits = {}
+        for event_type, name in ((utils.EventTypes.vote, 'vote'), (utils.EventTypes.message, 'message')):
+            if rate_conf[name + '_rate'] > 0:
+                self._rate_limits[event_type] = utils.KeyedTokenBuckets(rate_conf[name + '_rate'], 
+                                                                         rate_conf[name + '_burst'])
+        # Buckets are filled and evicted on the clock of the SMS timestamps, never the local one
+        self._sms_time = 0
+        self._suppressed = Counter()
+        self._rate_summary = None
+
+        # SMS storage structures, with the revision of the last change of each message.
+        # A console syncs by session id, last event number and last revisions
+        self._session_id = uuid.uuid4().hex
+        self._message_rev = 0
+        self._message_revs = []
+        self._peer_synced = False
+        timeline_conf = self._timeline_conf = config['timeline']
+        self._timeline = timeline.TieredTimeline(timeline_conf['segment'], 
+                                                 hot_size=timeline_conf['hot_size'], 
+                                                 spill_size=timeline_conf['spill_size'], 
+                                                 index_interval=timeline_conf['index_interval'])
         self._messages = []
+        self._phonebook = phonebook.PhonebookStore(config['server']['phonebook_db'])
+        self._phonebook_commit = None
 
+        # Consoles of this session are told apart by their secret
         secret = self._globals['secret'].encode('utf8')
-        secret_pattern = re.escape(secret) + self._regex['port_pattern'].encode('utf8')
-        inbox = config['server']['inbox']
-
-        # Listening daemons
-        self._listener = daemons.UDPBroadcastListener(loop=loop, secret_pattern=secret_pattern, 
-                                                    callback=self.got_secret, 
-                                                    endianness=self._globals['endianness'], 
-                                                    )
-        self._scanner = daemons.BroadcastServer(loop=loop, protocol=self._listener, **self._globals)
-        self._watcher = daemons.SMSWatcher(directory=inbox, callback=self.got_sms)
+        self.secret_pattern = re.escape(secret) + self._regex['port_pattern'].encode('utf8')
+        self._scanner = scanner
+        self._sql_watcher = None
+        if config['server']['sql_inbox']:
+            self._sql_watcher = daemons.SQLInboxWatcher(config['server']['sql_inbox'], callback=self.got_sql_sms, 
+                                                        poll_interval=config['server']['sql_poll_interval'], 
+                                                        batch_size=config['server']['sql_batch_size'], 
+                                                        logger=self._logger)
+        
+        # Merging of several inboxes: recently seen SMS and reordering buffer
+        self._recent_sms = OrderedDict()
+        self._duplicates = 0
+        self._merge_window = config['server']['merge_window']
+        self._merge_heap = []
+        self._merge_flush = None
 
         # Transports
         self._display_transport = None
 
-        # Temporary task for TCP connection
+        # Temporary task for TCP connection, and last client for direct reconnection
         self._connecting = None
+        self._last_client = None
+        self._reconnect = None
+        self._reconnect_left = 0
+        self._stopping = False
         super().__init__(loop, **self._globals)
         
         # Temporary poll & video tasks
         self._poll = None
         self._poll_running = False
+        self._poll_id = ''
+
+        # Log records forwarded to the client, filtered in the logging thread
+        server_conf = self._server_conf = config['server']
+        self.log_handler = daemons.PeerLogHandler(loop, self.forward_log, 
+                                                  level=server_conf['log_forward_level'], 
+                                                  rate=server_conf['log_forward_rate'], 
+                                                  burst=server_conf['log_forward_burst'], 
+                                                  session=name, 
+                                                  )
         
-    @asyncio.coroutine
-    def setup(self):
+    async def setup(self):
         display_conf = self._config['display']
         display_peer = (display_conf['addr'], display_conf['port'])
-        self._display_transport, _ = yield from self._loop.create_datagram_endpoint(
+        self._display_transport, _ = await self._loop.create_datagram_endpoint(
                                                         asyncio.DatagramProtocol, 
                                                         remote_addr=display_peer)
-        yield from self._watcher.setup(self._loop)
-        self._scanner.start()
+        if self._sql_watcher:
+            await self._sql_watcher.setup(self._loop)
+        if self._rate_limits:
+            self._rate_summary = self._loop.call_later(self._rate_conf['summary_interval'], self._summarize_suppressed)
         
-    @asyncio.coroutine
-    def stop(self):
-        yield from self._watcher.stop()
-        yield from self._scanner.stop()
+    async def stop(self):
+        self._stopping = True
+        if self._cues:
+            self._cues.pause()
+        if self._rate_summary:
+            self._rate_summary.cancel()
+        if self._reconnect:
+            self._reconnect.cancel()
+        if self._sql_watcher:
+            await self._sql_watcher.stop()
+        if self._pool:
+            self._submit_reads()
+            if self._pending_reads:
+                await asyncio.wait(list(self._pending_reads))
+        if self._merge_flush:
+            self._merge_flush.cancel()
+            self._flush_merged(release_all=True)
         if self._peer_transport:
             self._peer_transport.close()
         self._display_transport.close()
+        if self._phonebook_commit:
+            self._phonebook_commit.cancel()
+        self._phonebook.close()
+        self._timeline.close()
         
     def got_sms(self, sms_path):
-        filename = os.path.basename(sms_path)
-        metadata = re.match(self._regex['sms_pattern'], filename, re.I)
-        if metadata is None:
-            logger.debug('Invalid SMS: %r', filename)
+        if self._pool is None:
+            self._process_sms(self._reader.read(sms_path))
+            return
+        # Files found in the same loop iteration are sent to a worker together
+        if not self._read_batch:
+            self._loop.call_soon(self._submit_reads)
+        self._read_batch.append(sms_path)
+        
+    def _submit_reads(self):
+        if not self._read_batch:
+            return
+        future = self._loop.run_in_executor(self._pool, classifier.read_batch, self.name, self._read_batch)
+        self._read_batch = []
+        self._pending_reads.append(future)
+        future.add_done_callback(self._reads_done)
+        
+    def _reads_done(self, _):
+        # Batches are ingested in submission order, whichever worker finishes first
+        pending = self._pending_reads
+        while pending and pending[0].done():
+            future = pending.popleft()
+            if future.cancelled():
+                continue
+            if future.exception():
+                self._logger.error('SMS worker error: %r', future.exception())
+                continue
+            for record in future.result():
+                self._process_sms(record)
+        
+    def got_sql_sms(self, sms_id, received, sender, content):
+        source = 'SQL inbox ID {}'.format(sms_id)
+        if content is None:
+            self._logger.debug('Skipping SMS without decoded text: %r', source)
             return
-
         try:
-            content = open(sms_path).read()
+            timestamp = time.strftime(self._globals['timestamp_format'], time.strptime(received, SQL_DATETIME_FORMAT))
+            sender_match = self._sender_pattern.search(sender)
+        except (ValueError, TypeError) as e:
+            # A NULL or malformed row is skipped, the watcher still moves past its ID
+            self._logger.warning('Skipping invalid SMS in SQL inbox: %r, %r', source, e)
+            return
+        phone = '0' + sender_match.group('phone') if sender_match else sender
+        self._process_sms(self._reader.record(source, timestamp, phone, content))
+        
+    def _process_sms(self, record):
+        source, timestamp, phone, content, classification, error = record
+        if error:
 #            TODO: add phone to phonebook anyway ?
-        except UnicodeDecodeError:
-            logger.debug('Wrong encoding in SMS: %r', filename)
+            self._logger.debug('%s: %r', error, source)
             return
-            
-        if content == 'Delivered' or re.match('.*ce correspondant a cherché à vous joindre.*', content):
-            logger.debug('Skipping Automatic Network SMS: %r', filename)
+        if classification is None:
+            self._logger.debug('Skipping Automatic Network SMS: %r', source)
             return
         
-        content = content.strip().replace('\n', ' ')
-        sms_data = metadata.groupdict()
-        sms_data['phone'] = '0' + sms_data['phone']
-        vote_match = re.match(self._regex['vote_pattern'], content, re.I)
+        sms_data = {'timestamp': timestamp, 'phone': phone}
+        
+        # The same SMS can show up in several modem inboxes
+        key = (timestamp, phone, content)
+        if key in self._recent_sms:
+            self._duplicates += 1
+            self._logger.debug('Skipping duplicate SMS: %r (%d duplicates so far)', source, self._duplicates)
+            return
+        self._recent_sms[key] = None
+        if len(self._recent_sms) > RECENT_SMS_SIZE:
+            self._recent_sms.popitem(last=False)
+            
+        # Timed by the SMS timestamp, so that an inbox replayed at startup is limited as it was received
+        limit = self._rate_limits.get(classification[0])
+        if limit is not None:
+            sms_time = utils.timestamp_seconds(timestamp, self._globals['timestamp_format'])
+            self._sms_time = max(self._sms_time, sms_time)
+            if not limit.consume(phone, now=sms_time):
+                # Counted only: a flooding phone costs no event, message, frame or voter update
+                self._suppressed[phone] += 1
+                return
         
-        if vote_match:
-            vote = bool(vote_match.group('vrai'))
-            logger.debug('Got {} vote: "{}" from {}'.format(vote, content, filename))
-            sms_data['type'] = utils.EventTypes.vrai if vote else utils.EventTypes.faux
-            sms_data['data'] = 'VRAI' if vote else 'FAUX'
+        sms_data['type'], sms_data['data'], choice = classification
+        if choice is not None:
+            self._logger.debug('Got {} vote: "{}" from {}'.format(sms_data['data'], content, source))
             if self._poll_running:
-                self.vote(vote)
+                self.vote(choice)
         # TODO: handle multipart messages (see python-gammu)
+        elif self._is_opt_out(content):
+            # Kept in the timeline but not shown, the phone opts out once the event is recorded
+            self._logger.info('Opt out requested by %r: %r', phone, content)
         else: # message
-            logger.debug('Got Message in SMS: %r -> %r', filename, content)
-            self._add_message(sms_data['phone'], content)
-            sms_data['type'] = utils.EventTypes.message
-            sms_data['data'] = content
+            self._logger.debug('Got Message in SMS: %r -> %r', source, content)
+            self._moderate_message(sms_data['phone'], content)
         
         event = utils.Event(**sms_data)
-        self._add_event(event)
+        self._merge_event(event)
+        
+    def _summarize_suppressed(self):
+        if self._suppressed:
+            # Logged as a warning so that the summary is forwarded to the client
+            summary = ', '.join('+{} suppressed from {}'.format(count, phone) 
+                                for phone, count in self._suppressed.most_common(5))
+            others = len(self._suppressed) - 5
+            if others > 0:
+                summary += ' and {} other phones'.format(others)
+            self._logger.warning('Rate limit: %s', summary)
+            self._suppressed.clear()
+        evicted = sum(limit.evict_idle(self._sms_time) for limit in self._rate_limits.values())
+        self._logger.debug('Rate limit: %d idle phones evicted', evicted)
+        self._rate_summary = self._loop.call_later(self._rate_conf['summary_interval'], self._summarize_suppressed)
+        
+    def _merge_event(self, event):
+        # Events from all inboxes are held for a short window and released in time order
+        if not self._merge_window:
+            self._add_event(event)
+            return
+        heapq.heappush(self._merge_heap, (event, self._loop.time() + self._merge_window))
+        if self._merge_flush is None:
+            self._merge_flush = self._loop.call_at(self._merge_heap[0][1], self._flush_merged)
+            
+    def _flush_merged(self, release_all=False):
+        # Sliding hold: an event is released once it waited the whole window, and only
+        # when no earlier event is still held, then the timer is armed for the next one
+        self._merge_flush = None
+        heap = self._merge_heap
+        now = self._loop.time()
+        while heap and (release_all or heap[0][1] <= now):
+            self._add_event(heapq.heappop(heap)[0])
+        if heap:
+            self._merge_flush = self._loop.call_at(heap[0][1], self._flush_merged)
         
     def got_secret(self, port, peer):
-        if not self._connecting:
-            tcp_connection = self._loop.create_connection(lambda: self, host=peer[0], port=port)
-            self._connecting = self._loop.create_task(tcp_connection)
-            self._connecting.add_done_callback(self._connecting_done)
+        self._connect((peer[0], port))
         
-    def _connecting_done(self, task):
-        if task.exception():
-            logger.error('TCP Connection error: %r', task.exception())
+    def _connect(self, address):
+        self._reconnect = None
+        if self._connecting or self._peer_transport:
+            return
+        tcp_connection = self._loop.create_connection(lambda: self, host=address[0], port=address[1])
+        self._connecting = self._loop.create_task(tcp_connection)
+        self._connecting.add_done_callback(partial(self._connecting_done, address))
+        
+    def _connecting_done(self, address, task):
         self._connecting = None
+        if task.cancelled():
+            return
+        if task.exception():
+            self._logger.error('TCP Connection error: %r', task.exception())
+            if address == self._last_client and self._reconnect_left > 0 and not self._stopping:
+                self._reconnect_left -= 1
+                delay = self._server_conf['reconnect_delay']
+                self._reconnect = self._loop.call_later(delay, self._connect, address)
+        else:
+            self._last_client = address
         
-    @asyncio.coroutine
-    def rig_poll(self, choice, times):
+    async def rig_poll(self, choice, times):
         for _ in range(times):
             self.vote(choice)
-            yield from asyncio.sleep(0.1)
+            await asyncio.sleep(0.1)
 
     def vote(self, choice):
-        message = OSC_VRAI if choice else OSC_FAUX
-        self.send_to_display(message)
+        self.send_to_display(self._osc_votes[choice])
+        
+    def _moderate_message(self, phone, content):
+        flagged = self._moderator.flagged(content)
+        if flagged and self._moderator.hide:
+            self._logger.info('Hiding message from %r matching %r', phone, flagged)
+            return
         
-    def _add_message(self, phone, content, to_display=False, displayed=False):
+        if not self._moderator.collapse_duplicates:
+            self._add_message(phone, content, flagged=bool(flagged))
+            return
+        fingerprint = moderation.fingerprint(content)
+        index = self._fingerprints.get(fingerprint)
+        if index is None:
+            self._fingerprints[fingerprint] = self._add_message(phone, content, flagged=bool(flagged))
+            return
+        # Near-duplicate: only the count of the first message changes, and a
+        # deleted message stays deleted for all its duplicates
+        message = self._messages[index]
+        message[4] += 1
+        self._message_changed(index, transmit=False)
+        self._logger.debug('Collapsed duplicate of message %d from %r (%d copies)', index, phone, message[4])
+        if message[1] and index not in self._count_updates:
+            self._count_updates.add(index)
+            self._loop.call_later(COUNT_UPDATE_DELAY, self._transmit_count, index)
+            
+    def _transmit_count(self, index):
+        self._count_updates.discard(index)
+        message = self._messages[index]
+        if message[1] and self._peer_synced:
+            self.transmit_message(index, message)
+        
+    def _add_message(self, phone, content, to_display=False, displayed=False, flagged=False):
         index = len(self._messages)
-        message = [phone, content, to_display, displayed]
+        message = [phone, content, to_display, displayed, 1, flagged]
         self._messages.append(message)
-        if self._peer_transport:
-            self._loop.call_soon(self.transmit_message, index, message)
+        self._message_revs.append(0)
+        self._message_changed(index)
         return index
         
+    def _message_changed(self, index, transmit=True):
+        self._message_rev += 1
+        self._message_revs[index] = self._message_rev
+        if transmit and self._peer_synced:
+            self._loop.call_soon(self.transmit_message, index, self._messages[index])
+        
     def _add_event(self, event):
-        utils.insort_record(self._timeline, event)
-        if self._peer_transport:
+        seq = self._timeline.add(event)
+        if self._peer_synced:
             # Theoretical max size of a multipart SMS payload = 153 chars * 255 parts = 39015 bytes
-            self._loop.call_soon(self.transmit_event, event)
+            self._loop.call_soon(self.transmit_event, event, seq)
+        if event.phone != CLIENT_ID:
+            voter = self._phonebook.record(event, self._poll_id)
+            if voter and event.type == utils.EventTypes.message and self._is_opt_out(event.data):
+                voter = self._phonebook.update(event.phone, opt_out=True)
+            self._voter_changed(voter)
+            
+    def _is_opt_out(self, content):
+        return moderation.fingerprint(content) in self._opt_out_keywords
+            
+    def _voter_changed(self, voter):
+        if voter is None:
+            return
+        if self._phonebook_commit is None:
+            self._phonebook_commit = self._loop.call_later(1, self._commit_phonebook)
+        if self._peer_synced:
+            self._loop.call_soon(self.transmit_voter, voter)
+            
+    def _commit_phonebook(self):
+        self._phonebook_commit = None
+        self._phonebook.commit()
         
-    def transmit_event(self, event):
-        self.request_peer('/event', event)
+    def transmit_voter(self, voter):
+        self.request_peer('/voter', list(voter))
+        
+    def transmit_event(self, event, seq=None):
+        self.request_peer('/event', [seq] + list(event))
         
     def transmit_message(self, index, message):
-        self.request_peer('/message', [index] + list(message))
+        self.request_peer('/message', [index] + list(message) + [self._message_revs[index]])
+        
+    def forward_log(self, payload):
+        if self._peer_transport:
+            self.request_peer('/log', payload)
         
     def send_to_display(self, message):
-        logger.debug('Sending Osc over UDP to display %r', message)
+        self._logger.debug('Sending Osc over UDP to display %r', message)
         self._display_transport.sendto(message.dgram)
                             
     ###########################################################################
@@ -196,52 +464,109 @@ class Server(daemons.PickleStreamProtocol):
         index = payload[0]
         if index < len(self._messages):
             self._messages[index][1:4] = ['', False, False]
-            logger.debug('DELETE messsage with id: %r', index)
+            self._message_changed(index)
+            self._logger.debug('DELETE messsage with id: %r', index)
         else:
-            logger.error('Message index out of range in OSC erase command: %d', index)
+            self._logger.error('Message index out of range in OSC erase command: %d', index)
             
     def process_newmessage(self, payload, timestamp):
         content = payload[0]
         index = self._add_message(CLIENT_ID, content, to_display=True, displayed=False)
         sms = utils.Event(timestamp=timestamp, phone=CLIENT_ID, data=content, type=utils.EventTypes.message)
         self._add_event(sms)
-        logger.debug('NEW Message - id: %r, content: %r', index, content)
+        self._logger.debug('NEW Message - id: %r, content: %r', index, content)
         
     def process_to_display(self, payload, timestamp):
         id, to_display = payload
         self._messages[id][2] = to_display
+        self._message_changed(id)
 
     def process_messages(self, payload, timestamp):
-        displayed = '        '.join(self._messages[id][1] for id in payload)
+        displayed = MESSAGES_SEPARATOR.join(self._messages[id][1] for id in payload)
         msg = utils.CustomOscMessage('/messages', displayed or ' ')
         self.send_to_display(msg)
 
+        payload = set(payload)
         for id, msg in enumerate(self._messages):
-            msg[-1] = (id in payload)
+            if msg[3] != (id in payload):
+                msg[3] = not msg[3]
+                self._message_changed(id)
 
-        logger.debug('DISPLAYING Messages: %r', payload)
+        self._logger.debug('DISPLAYING Messages: %r', payload)
+                
+    def process_pedigree(self, payload, timestamp):
+        phone, pedigree = payload
+        self._voter_changed(self._phonebook.update(phone, pedigree=pedigree))
+        self._logger.debug('PEDIGREE for %r: %r', phone, pedigree)
+        
+    def process_opt_out(self, payload, timestamp):
+        phone, opt_out = payload
+        self._voter_changed(self._phonebook.update(phone, opt_out=opt_out))
+        self._logger.debug('OPT OUT for %r: %r', phone, opt_out)
+        
+    def process_select(self, payload, timestamp):
+        # Recipients of an SMS sent by a console: the phonebook of the server is the
+        # reference for opt outs, which a console may not have synced yet
+        request_id, criteria = payload
+        criteria = {key: value for key, value in criteria.items() if key in phonebook.SELECT_CRITERIA}
+        phones = self._phonebook.select(opt_out=False, **criteria)
+        self.request_peer('/selection', [request_id, phones])
+        self._logger.debug('SELECT %d phones matching %r', len(phones), criteria)
+        
+    def process_sync(self, payload, timestamp):
+        # A console of the same session only gets what it misses: the events after its
+        # last one and the messages and voters changed after its last revisions.
+        # Otherwise it drops its session and gets the recent events and all the messages
+        session_id, event_seq, message_rev, phonebook_rev = payload
+        tail = self._timeline.since(event_seq) if session_id == self._session_id else None
+        reset = tail is None
+        self.request_peer('/session', [self._session_id, reset])
+        if reset:
+            message_rev = 0
+            self.request_peer('/history_start', len(self._timeline.cold))
+            tail = self._timeline.hot
+        for event in tail:
+            self.transmit_event(event)
+        messages = 0
+        for index, message in enumerate(self._messages):
+            # Deleted messages are only sent to consoles that may still have them
+            if self._message_revs[index] > message_rev and (message[1] or not reset):
+                self.transmit_message(index, message)
+                messages += 1
+        voters = self._phonebook.changed_since(phonebook_rev)
+        for voter in voters:
+            self.transmit_voter(voter)
+        self.request_peer('/synced', [self._timeline.seq, self._message_rev])
+        self._peer_synced = True
+        self._logger.info('SYNC %s: %d events, %d messages, %d voters', 'reset' if reset else 'tail', 
+                    len(tail), messages, len(voters))
                 
     def process_sondage(self, payload, timestamp):
         titre, chrono = payload
-
-        if chrono <= 0:
-            chrono = -2
-        else:
-            _format = self._globals['timestamp_format']
-            seconds = time.mktime(time.strptime(timestamp, _format))
-            end_timestamp = time.strftime(_format, time.localtime(seconds + chrono))
-            self._poll = self._loop.call_later(chrono, self._record_finsondage, end_timestamp)
-            logger.debug('Scheduling FIN Sondage after %r seconds', chrono)
-
-        self.send_to_display(OSC_RESET)
-        self.send_to_display(utils.CustomOscMessage('/sondage', [titre, chrono]))
+        for message in self._encode_cue(cues.Cue(0, 'sondage', payload, titre)):
+            self.send_to_display(message)
+        self._start_poll(titre, chrono, timestamp)
+        self._logger.debug('SONDAGE {}, chrono:{}'.format(*payload))
+        
+    def _start_poll(self, titre, chrono, timestamp):
+        if self._poll:
+            self._poll.cancel()
+            self._poll = None
+        if chrono > 0:
+            # Deadline on the monotonic clock, the end is timestamped when it happens
+            self._poll = self._loop.call_at(self._loop.time() + chrono, self._end_poll)
+            self._logger.debug('Scheduling FIN Sondage after %r seconds', chrono)
 
         type = utils.EventTypes.sondage
         event = utils.Event(timestamp=timestamp, phone=CLIENT_ID, data=titre, type=type)
         self._add_event(event)
 
+        self._poll_id = timestamp + ' ' + titre
         self._poll_running = True
-        logger.debug('SONDAGE {}, chrono:{}'.format(*payload))
+        
+    def _end_poll(self):
+        self._poll = None
+        self._record_finsondage(time.strftime(self._globals['timestamp_format']))
         
     def process_finsondage(self, payload, timestamp):
         self.send_to_display(OSC_FINSONDAGE)
@@ -251,24 +576,155 @@ class Server(daemons.PickleStreamProtocol):
         if self._poll:
             self._poll.cancel()
             self._poll = None
+        # Votes received during the poll and still held by the merge count for it
+        if self._merge_flush:
+            self._merge_flush.cancel()
+            self._flush_merged(release_all=True)
 
         type = utils.EventTypes.fin_sondage
         event = utils.Event(timestamp=timestamp, phone=CLIENT_ID, data='FIN SONDAGE', type=type)
         self._add_event(event)
 
         self._poll_running = False
-        logger.debug('FIN SONDAGE')
+        results = self._phonebook.poll_votes(self._poll_id)
+        self._logger.info('FIN SONDAGE %r: %s', self._poll_id, 
+                    ', '.join('{} {} voters ({} votes)'.format(choice, voters, votes) 
+                              for choice, (voters, votes) in sorted(results.items())) or 'no votes')
+        # Votes until the next poll count for no poll
+        self._poll_id = ''
+        
+    def process_history(self, payload, timestamp):
+        # Page of older events requested by a console, before a position or a timestamp
+        before, limit = payload
+        start, events = self._timeline.history(before, min(limit, self._timeline_conf['history_page']))
+        self.request_peer('/history', [start, events])
+        self._logger.debug('HISTORY %d events from %d', len(events), start)
+        
+    ###########################################################################
+    # Cue list
+    ###########################################################################
+    def _encode_cue(self, cue):
+        if cue.action == 'sondage':
+            titre, chrono = cue.args
+            return [self._osc_reset, utils.CustomOscMessage('/sondage', [titre, float(chrono) if chrono > 0 else -2])]
+        if cue.action == 'finsondage':
+            return [OSC_FINSONDAGE]
+        if cue.action == 'messages':
+            return [utils.CustomOscMessage('/messages', MESSAGES_SEPARATOR.join(cue.args) or ' ')]
+        address, *params = cue.args
+        return [utils.CustomOscMessage(address, params)]
+        
+    def _fire_cue(self, index, cue):
+        # The display gets the encoded messages first, the session state follows
+        for message in self._cue_messages[index]:
+            self.send_to_display(message)
+        timestamp = time.strftime(self._globals['timestamp_format'])
+        if cue.action == 'sondage':
+            titre, chrono = cue.args
+            self._start_poll(titre, chrono, timestamp)
+        elif cue.action == 'finsondage':
+            self._record_finsondage(timestamp)
+        self._logger.info('CUE %d at %.1fs: %s', index, cue.at, cue.label)
+        
+    def _cue_state_changed(self, state):
+        if self._peer_transport:
+            self.request_peer('/cue_state', state)
+            
+    def process_cue(self, payload, timestamp):
+        command, *args = payload
+        if self._cues is None:
+            self._logger.warning('No cue list loaded, ignoring cue command %r', command)
+            return
+        if command not in cues.COMMANDS:
+            self._logger.error('Unknown cue command %r', command)
+            return
+        try:
+            getattr(self._cues, command)(*args)
+        except (TypeError, IndexError) as e:
+            self._logger.error('Invalid cue command %r: %r', payload, e)
+        self._logger.debug('CUE command %r', payload)
         
     ###########################################################################
     # asyncio.Protocol API
     ###########################################################################
     def connection_made(self, transport):
         super().connection_made(transport)
-        for index, record in enumerate(self._messages):
-            if record[1]: # skip erased or empty messages
-                self._loop.call_soon(self.transmit_message, index, record)
-        for event in self._timeline:
-            self._loop.call_soon(self.transmit_event, event)
+        # The session is sent once the console tells what it has, see process_sync
+        self._peer_synced = False
+        if self._cues:
+            self.request_peer('/cues', [[cue.at, cue.label] for cue in self._cues.cues])
+            self.request_peer('/cue_state', self._cues.state())
+            
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self._peer_synced = False
+        # Try the last client right away, broadcast discovery runs in parallel
+        if self._last_client and not self._stopping:
+            self._logger.info('Reconnecting directly to last client %r', self._last_client)
+            self._reconnect_left = self._server_conf['reconnect_attempts']
+            self._connect(self._last_client)
+        
+
+class SessionHost:
+    # Shows run by one process, one Server per session of the [sessions] section or a
+    # single one without it. The discovery listener, broadcast scanner, inbox watcher
+    # and worker processes are shared, consoles are routed to their session by secret
+    def __init__(self, loop, config):
+        self._loop = loop
+        sessions = config.get('sessions') or {'': config}
+        
+        self._pool = None
+        if config['server']['workers']:
+            # multiprocessing is only imported when workers are used
+            from concurrent.futures import ProcessPoolExecutor
+            readers = {name: (session['regex']['sms_pattern'], list(session['poll']['choices']), 
+                              list(session['poll']['patterns']), list(session['poll']['blocklist'])) 
+                       for name, session in sessions.items()}
+            self._pool = ProcessPoolExecutor(config['server']['workers'], 
+                                             initializer=classifier.init_worker, initargs=(readers,))
+        
+        self._listener = daemons.UDPBroadcastListener(loop=loop, endianness=config['globals']['endianness'])
+        self._scanner = daemons.BroadcastServer(loop=loop, protocol=self._listener, **config['globals'])
+        scanner = daemons.SharedScanner(self._scanner, len(sessions))
+        self.servers = []
+        inboxes = {}
+        for name, session in sessions.items():
+            server = Server(loop, session, name, scanner=scanner, pool=self._pool)
+            self._listener.add_route(server.secret_pattern, server.got_secret)
+            inboxes.update((directory, server.got_sms) for directory in session['server']['inbox'])
+            self.servers.append(server)
+            if name:
+                logger.info('Session %r: inbox %r, display %s:%d', name, session['server']['inbox'], 
+                            session['display']['addr'], session['display']['port'])
+        self._watcher = None
+        if inboxes:
+            self._watcher = daemons.SMSWatcher(inboxes, stats_interval=config['server']['inbox_stats_interval'])
+            
+    def __enter__(self):
+        self._loop.run_until_complete(self.setup())
+        return self
+        
+    def __exit__(self, type, value, traceback):
+        self._loop.run_until_complete(self.stop())
+        self._loop.close()
+        return isinstance(value, KeyboardInterrupt)
+        
+    async def setup(self):
+        for server in self.servers:
+            await server.setup()
+        if self._watcher:
+            await self._watcher.setup(self._loop)
+        self._scanner.start()
+        
+    async def stop(self):
+        # No new SMS while the sessions flush what they are reading
+        if self._watcher:
+            await self._watcher.stop()
+        for server in self.servers:
+            await server.stop()
+        if self._pool:
+            self._pool.shutdown()
+        await self._scanner.stop()
         
 
 if __name__ == '__main__':
@@ -276,9 +732,11 @@ if __name__ == '__main__':
     parser.add_argument('-l', '--loglevel', type=str, choices=list(logging._nameToLevel), default=DEFAULT_LOGLEVEL)
     parser.add_argument('-c', '--configfile', type=open, default=DEFAULT_CONFIGFILE)
     parser.add_argument('-s', '--specfile', type=open)
+    parser.add_argument('--profile-startup', action='store_true', 
+                        help='Report startup timings on stderr, see python -X importtime for the imports')
     args = parser.parse_args()
-    # TODO: send logging over TCP to client
-    logging.basicConfig(level=args.loglevel)
+    profile = utils.StartupProfile(args.profile_startup)
+    log_listener = utils.start_log_listener(args.loglevel)
     
     configfile = args.configfile
     if args.specfile:
@@ -291,17 +749,26 @@ if __name__ == '__main__':
             specfile = None
         
     try:
-        config = utils.parse_configfile(configfile, configspec=specfile)
-    except utils.ConfigObjError as e:
+        config = utils.load_config(configfile, specfile)
+    except utils.ConfigError as e:
         logger.critical('Error in configuration file', exc_info=True)
         sys.exit(e)
     finally:
         configfile.close()
         if specfile:
             specfile.close()
+    profile.mark('configuration')
         
-    loop = asyncio.get_event_loop()
-    loop.set_debug(True)
+    loop = utils.new_event_loop(config['globals']['event_loop'])
+    loop.set_debug(args.loglevel == 'DEBUG')
 
-    with Server(loop, config) as server:
-        loop.run_forever()
+    try:
+        host = SessionHost(loop, config)
+        profile.mark('server init')
+        with host:
+            profile.mark('server setup')
+            profile.report()
+            log_listener.handlers += tuple(server.log_handler for server in host.servers)
+            loop.run_forever()
+    finally:
+        log_listener.stop()
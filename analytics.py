@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) 2017 Benoit Bregeault
+
+# ---------------------------------------------------------------------
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Standard library
+import os
+import csv
+import gzip
+import json
+import time
+import zlib
+import os.path
+import argparse
+import logging
+
+# Third Party
+import numpy as np
+
+# Application
+import utils
+from utils import CLIENT_ID
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMESTAMP_FORMAT = '%Y%m%d_%H%M%S'
+VOTE_TYPES = np.array(utils.VOTE_TYPES, dtype=np.uint8)
+
+
+class Session:
+    # Columnar view of a session journal: one array per Event field
+    def __init__(self, name, timestamps, phones, data, types, timestamp_format=DEFAULT_TIMESTAMP_FORMAT):
+        self.name = name
+        ts_strings, ts_codes = np.unique(np.asarray(timestamps, dtype=str), return_inverse=True)
+        # Seconds repeat a lot during a show: parse each distinct timestamp only once
+        ts_values = np.array([time.mktime(time.strptime(s, timestamp_format)) for s in ts_strings], dtype=np.int64)
+        self.phone_categories, phone_codes = np.unique(np.asarray(phones, dtype=str), return_inverse=True)
+        self.data_categories, data_codes = np.unique(np.asarray(data, dtype=str), return_inverse=True)
+        columns = np.column_stack([ts_values[ts_codes] if len(ts_codes) else np.empty(0, dtype=np.int64),
+                                   np.asarray(types, dtype=np.int64),
+                                   phone_codes, data_codes]).astype(np.int64)
+        # The journal can hold the same event twice after a resync: keep unique rows, sorted by time
+        columns = np.unique(columns, axis=0) if len(columns) else columns.reshape(0, 4)
+        self.timestamps = columns[:, 0]
+        self.types = columns[:, 1].astype(np.uint8)
+        self.phones = columns[:, 2].astype(np.int32)
+        self.data = columns[:, 3].astype(np.int32)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @classmethod
+    def from_archive(cls, path, timestamp_format=DEFAULT_TIMESTAMP_FORMAT):
+        fields = ([], [], [], [])
+        with gzip.open(path, 'rt', encoding='utf8') as archive:
+            try:
+                for line in archive:
+                    try:
+                        kind, _, payload = json.loads(line)
+                    except ValueError:
+                        # Truncated last line of an archive written during a crash
+                        logger.warning('Skipping invalid line in %r', path)
+                        continue
+                    if kind == 'event':
+                        for column, value in zip(fields, payload):
+                            column.append(value)
+            except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+                # The gzip stream itself is cut short: keep the events read so far
+                logger.warning('Archive %r is truncated after %d events: %s', path, len(fields[0]), e)
+        name = os.path.basename(path).split('.')[0]
+        timestamps, phones, data, types = fields
+        return cls(name, timestamps, phones, data, types, timestamp_format)
+
+    def polls(self):
+        # Poll windows: from each poll start to the next end or start, whichever comes first
+        starts = np.flatnonzero(self.types == utils.EventTypes.sondage)
+        boundaries = np.flatnonzero((self.types == utils.EventTypes.sondage) |
+                                    (self.types == utils.EventTypes.fin_sondage))
+        next_boundary = np.searchsorted(boundaries, starts, side='right')
+        ends = np.full(len(starts), np.iinfo(np.int64).max, dtype=np.int64)
+        has_end = next_boundary < len(boundaries)
+        ends[has_end] = self.timestamps[boundaries[next_boundary[has_end]]]
+        titles = self.data_categories[self.data[starts]]
+        return self.timestamps[starts], ends, titles
+
+    def votes(self):
+        # Poll index of each vote, -1 for votes outside of any poll
+        starts, ends, _ = self.polls()
+        mask = np.isin(self.types, VOTE_TYPES)
+        ts = self.timestamps[mask]
+        poll = np.searchsorted(starts, ts, side='right') - 1
+        valid = poll >= 0
+        valid[valid] &= ts[valid] < ends[poll[valid]]
+        poll[~valid] = -1
+        return poll, ts, self.phones[mask], self.data[mask]
+
+    def vote_curves(self, bin_seconds=1):
+        starts, _, titles = self.polls()
+        poll, ts, _, choice = self.votes()
+        keep = poll >= 0
+        poll, offset, choice = poll[keep], (ts[keep] - starts[poll[keep]]) // bin_seconds, choice[keep]
+        rows = []
+        for p in range(len(starts)):
+            in_poll = poll == p
+            for c in np.unique(choice[in_poll]):
+                counts = np.bincount(offset[in_poll & (choice == c)])
+                cumulative = np.cumsum(counts)
+                label = self.data_categories[c]
+                rows.extend((self.name, p, titles[p], i * bin_seconds, label, n, total)
+                            for i, (n, total) in enumerate(zip(counts.tolist(), cumulative.tolist())))
+        return rows
+
+    def latencies(self):
+        starts, _, titles = self.polls()
+        poll, ts, _, _ = self.votes()
+        keep = poll >= 0
+        latency = ts[keep] - starts[poll[keep]]
+        poll = poll[keep]
+        rows = []
+        for p in range(len(starts)):
+            values = latency[poll == p]
+            if len(values):
+                p10, median, p90 = np.percentile(values, [10, 50, 90]).tolist()
+                rows.append((self.name, p, titles[p], len(values), int(values.min()), p10, median, p90,
+                             float(values.mean())))
+            else:
+                rows.append((self.name, p, titles[p], 0, '', '', '', '', ''))
+        return rows
+
+    def participants(self):
+        poll, _, phones, _ = self.votes()
+        n_phones = len(self.phone_categories)
+        votes = np.bincount(phones, minlength=n_phones)
+        # Distinct (phone, poll) pairs give the number of polls each phone took part in
+        pairs = np.unique(np.column_stack([phones[poll >= 0], poll[poll >= 0]]), axis=0)
+        polls = np.bincount(pairs[:, 0], minlength=n_phones) if len(pairs) else np.zeros(n_phones, dtype=np.int64)
+        messages = np.bincount(self.phones[self.types == utils.EventTypes.message], minlength=n_phones)
+        client = self.phone_categories == CLIENT_ID
+        return [(self.name, phone, int(p), int(v), int(m))
+                for phone, p, v, m, c in zip(self.phone_categories, polls, votes, messages, client) if not c]
+
+    def messages_per_minute(self):
+        mask = (self.types == utils.EventTypes.message) & (self.phone_categories[self.phones] != CLIENT_ID)
+        minutes, counts = np.unique(self.timestamps[mask] // 60, return_counts=True)
+        return [(self.name, time.strftime('%Y-%m-%d %H:%M', time.localtime(m * 60)), int(n))
+                for m, n in zip(minutes.tolist(), counts.tolist())]
+
+
+REPORTS = {'vote_curves': (('session', 'poll', 'title', 'offset_s', 'choice', 'votes', 'cumulative'),
+                           Session.vote_curves),
+           'poll_latency': (('session', 'poll', 'title', 'votes', 'first_s', 'p10_s', 'median_s', 'p90_s', 'mean_s'),
+                            Session.latencies),
+           'participants': (('session', 'phone', 'polls', 'votes', 'messages'),
+                            Session.participants),
+           'messages_per_minute': (('session', 'minute', 'messages'),
+                                   Session.messages_per_minute),
+           }
+
+
+def export_reports(sessions, directory):
+    os.makedirs(directory, exist_ok=True)
+    for name, (header, report) in REPORTS.items():
+        path = os.path.join(directory, name + '.csv')
+        with open(path, 'w', newline='', encoding='utf8') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for session in sessions:
+                writer.writerows(report(session))
+        logger.info('Wrote %r', path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Post-show statistics over session archives of the show #Vérité')
+    parser.add_argument('archives', nargs='+', help='Archives written by SMS_recorder.py')
+    parser.add_argument('-o', '--output', type=str, default='analytics')
+    parser.add_argument('-t', '--timestamp-format', type=str, default=DEFAULT_TIMESTAMP_FORMAT)
+    parser.add_argument('-l', '--loglevel', type=str, choices=list(logging._nameToLevel), default='INFO')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
+
+    start = time.perf_counter()
+    sessions = [Session.from_archive(path, args.timestamp_format) for path in args.archives]
+    logger.info('Loaded %d events from %d sessions in %.2fs', sum(map(len, sessions)), len(sessions),
+                time.perf_counter() - start)
+    export_reports(sessions, args.output)
+    logger.info('Done in %.2fs', time.perf_counter() - start)
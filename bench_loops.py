@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) 2017 Benoit Bregeault
+
+# ---------------------------------------------------------------------
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Standard library
+import time
+import argparse
+import asyncio
+
+# Application
+import utils
+import daemons
+
+
+PROTOCOL_ARGS = {'tcp_header_size': 4, 'endianness': 'big', 'timestamp_format': '%Y%m%d_%H%M%S', 
+                 'heartbeat_interval': 3600, 'heartbeat_timeout': 7200}
+EVENT = utils.Event('20171012_203000', '0612345678', 'VRAI', utils.EventTypes.vote)
+
+
+class NullScanner:
+    def pause(self):
+        pass
+        
+    def resume(self):
+        pass
+
+
+class Peer(daemons.PickleStreamProtocol):
+    # Both ends of a bench connection: counts /event packets until the expected number
+    def __init__(self, loop, expected=0):
+        super().__init__(loop, **PROTOCOL_ARGS)
+        self._scanner = NullScanner()
+        self.expected = expected
+        self.received = 0
+        self.done = loop.create_future()
+        self.connected = loop.create_future()
+        
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.connected.set_result(None)
+        
+    def process_event(self, payload, timestamp):
+        self.received += 1
+        if self.received == self.expected and not self.done.done():
+            self.done.set_result(None)
+
+
+async def connect_pairs(loop, n, expected):
+    receivers = []
+    def receiver():
+        receivers.append(Peer(loop, expected))
+        return receivers[-1]
+    server = await loop.create_server(receiver, host='127.0.0.1', port=0)
+    port = server.sockets[0].getsockname()[1]
+    senders = []
+    for _ in range(n):
+        _, sender = await loop.create_connection(lambda: Peer(loop), host='127.0.0.1', port=port)
+        senders.append(sender)
+    while len(receivers) < n:
+        await asyncio.sleep(0.01)
+    await asyncio.wait([r.connected for r in receivers])
+    return server, senders, receivers
+
+
+async def run(loop, connections, packets):
+    # One event loop sends every packet to every connection and receives them back:
+    # framing with a single connection, fan-out with several
+    server, senders, receivers = await connect_pairs(loop, connections, packets)
+    start = time.perf_counter()
+    for _ in range(packets):
+        for sender in senders:
+            sender.request_peer('/event', EVENT)
+        # Let the loop flush and dispatch, as the server does between SMS
+        await asyncio.sleep(0)
+    await asyncio.wait([r.done for r in receivers])
+    elapsed = time.perf_counter() - start
+    for sender in senders:
+        sender._peer_transport.close()
+    server.close()
+    await server.wait_closed()
+    return elapsed
+
+
+def loop_factories():
+    factories = {'asyncio': asyncio.new_event_loop}
+    try:
+        import uvloop
+    except ImportError:
+        print('uvloop is not installed, only the asyncio loop is benchmarked')
+    else:
+        factories['uvloop'] = uvloop.new_event_loop
+    return factories
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the event loop implementations on the TCP link')
+    parser.add_argument('-n', '--packets', type=int, default=20000)
+    parser.add_argument('-f', '--fanout', type=int, default=16, help='Connections of the fan-out benchmark')
+    args = parser.parse_args()
+
+    for name, factory in loop_factories().items():
+        for label, connections in (('framing', 1), ('fan-out', args.fanout)):
+            loop = factory()
+            asyncio.set_event_loop(loop)
+            try:
+                elapsed = loop.run_until_complete(run(loop, connections, args.packets))
+            finally:
+                loop.close()
+            total = connections * args.packets
+            print('{:>8} {:>8} x{:<3}: {:.3f}s, {:.0f} packets/s'.format(name, label, connections, elapsed, 
+                                                                       total / elapsed))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) 2017 Benoit Bregeault
+
+# ---------------------------------------------------------------------
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Standard library
+import re
+import os.path
+import unicodedata
+from collections import namedtuple
+
+# Application
+import utils
+
+
+# A classified SMS, or the reason why it was not read in error
+SMSRecord = namedtuple('SMSRecord', ('source', 'timestamp', 'phone', 'content', 'classification', 'error'))
+
+
+# Combining diacritical marks, except the grapheme joiner which is not one. Accented
+# latin letters decompose into these only, removed by one regex instead of a python loop
+DIACRITICS = re.compile('[\u0300-\u034e\u0350-\u036f]')
+
+def strip_accents(text):
+    decomposed = DIACRITICS.sub('', unicodedata.normalize('NFKD', text))
+    if decomposed.isascii():
+        return decomposed
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+def normalize(text):
+    # Case and accent insensitive form: 'Vrai', 'VRAI' and 'vraï' all give 'vrai'.
+    # Most SMS are plain ASCII and skip the unicode decomposition
+    if text.isascii():
+        return text.lower()
+    return strip_accents(text).lower()
+
+
+class Classifier:
+    BLOCKED = 'blocked'
+
+    def __init__(self, choices, patterns, blocklist=()):
+        if len(choices) != len(patterns):
+            raise ValueError('One pattern is needed per poll choice: {!r} {!r}'.format(choices, patterns))
+        self.choices = list(choices)
+        # Every rule is an alternative of a single regex: the name of the group that
+        # matched is the key of the dispatch table, so an SMS is classified in one pass.
+        # Patterns are matched on the normalized SMS and are written in lowercase
+        alternatives = []
+        self._rules = {}
+        if blocklist:
+            blocked = '|'.join('(?:{})'.format(strip_accents(pattern)) for pattern in blocklist)
+            alternatives.append('(?P<{}>{})'.format(self.BLOCKED, blocked))
+            self._rules[self.BLOCKED] = None
+        for index, (choice, pattern) in enumerate(zip(self.choices, patterns)):
+            name = 'c{}'.format(index)
+            alternatives.append('(?P<{}>{})'.format(name, strip_accents(pattern)))
+            self._rules[name] = (utils.EventTypes.vote, choice, index)
+        self._regex = re.compile('|'.join(alternatives), re.DOTALL)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__qualname__, self.choices)
+
+    def classify(self, content):
+        # Returns None for blocked SMS, (type, data, choice index) otherwise
+        match = self._regex.fullmatch(normalize(content))
+        if match is None:
+            return utils.EventTypes.message, content, None
+        return self._rules[match.lastgroup]
+
+    @classmethod
+    def from_config(cls, poll_config):
+        return cls(poll_config['choices'], poll_config['patterns'], poll_config['blocklist'])
+
+
+class SMSReader:
+    # From an inbox file to a classified SMS without any server state,
+    # so that it runs either in the server loop or in worker processes
+    def __init__(self, sms_pattern, classifier):
+        self._sms_pattern = re.compile(sms_pattern, re.I)
+        self.classifier = classifier
+
+    def read(self, path):
+        filename = os.path.basename(path)
+        metadata = self._sms_pattern.match(filename)
+        if metadata is None:
+            return SMSRecord(filename, None, None, None, None, 'Invalid SMS')
+        try:
+            with open(path) as f:
+                content = f.read()
+        except UnicodeDecodeError:
+            return SMSRecord(filename, None, None, None, None, 'Wrong encoding in SMS')
+        return self.record(filename, metadata.group('timestamp'), '0' + metadata.group('phone'), content)
+
+    def record(self, source, timestamp, phone, content):
+        content = content.strip().replace('\n', ' ')
+        return SMSRecord(source, timestamp, phone, content, self.classifier.classify(content), None)
+
+
+# Readers of each worker process of the server, one per session, built once by the pool initializer
+_worker_readers = {}
+
+def init_worker(sessions):
+    for session, (sms_pattern, choices, patterns, blocklist) in sessions.items():
+        _worker_readers[session] = SMSReader(sms_pattern, Classifier(choices, patterns, blocklist))
+
+def read_batch(session, paths):
+    reader = _worker_readers[session]
+    return [reader.read(path) for path in paths]
+
+
+if __name__ == '__main__':
+    # Benchmark against the previous path: re.match with the raw config strings on every SMS
+    import random
+    import argparse
+    import timeit
+
+    parser = argparse.ArgumentParser(description='Benchmark of the SMS classifier')
+    parser.add_argument('-n', '--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    vote_pattern = '^((?P<vrai>v(rai)?|o(ui)?)|f(aux)?|n(on)?)$'
+    notice_pattern = '.*ce correspondant a cherché à vous joindre.*'
+
+    def legacy(content):
+        if content == 'Delivered' or re.match(notice_pattern, content):
+            return None
+        vote_match = re.match(vote_pattern, content, re.I)
+        if vote_match:
+            return bool(vote_match.group('vrai'))
+        return content
+
+    classifier = Classifier(['VRAI', 'FAUX'], ['v(rai)?|o(ui)?', 'f(aux)?|n(on)?'], ['delivered', notice_pattern])
+    samples = ['Vrai', 'FAUX', 'oui', 'n', 'Delivered', 'Bravo pour le spectacle !',
+               'Ce correspondant a cherché à vous joindre 2 fois', 'Je pense que c\'est vrai mais pas sûr']
+    random.seed(0)
+    smss = [random.choice(samples) for _ in range(args.number)]
+    for name, function in (('legacy', legacy), ('classifier', classifier.classify)):
+        seconds = timeit.timeit(lambda: [function(sms) for sms in smss], number=1)
+        print('{:>10}: {:.3f}s, {:.2f}µs/SMS'.format(name, seconds, seconds / args.number * 1e6))
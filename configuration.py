@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) 2017 Benoit Bregeault
+
+# ---------------------------------------------------------------------
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Standard library
+import re
+import os.path
+
+# Third Party
+from configobj import ConfigObj, ConfigObjError
+from validate import VdtTypeError, VdtValueError, Validator
+
+
+https_re = r'https://.*\..*/.*\?'
+
+
+def validate_https_url(value):
+    if not isinstance(value, str):
+        raise VdtTypeError(value)
+    elif not re.fullmatch(https_re, value):
+        raise VdtValueError(value)
+    return value
+    
+def validate_directory(value):
+    if not isinstance(value, str):
+        raise VdtTypeError(value)
+    if not os.path.isdir(value):
+        raise VdtValueError(value)
+    return value
+    
+def validate_directory_list(value):
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list):
+        raise VdtTypeError(value)
+    return [validate_directory(directory) for directory in value]
+    
+def validate_re(value):
+    if not isinstance(value, str):
+        raise VdtTypeError(value)
+    try:
+        re.compile(value)
+    except Exception:
+        raise VdtValueError(value)
+    return value
+    
+check_functions = { 'https_url': validate_https_url, 
+                    'directory': validate_directory,
+                    'directory_list': validate_directory_list, 
+                    're': validate_re, 
+                  }
+custom_validator = Validator(check_functions)
+
+# Options of the process shared by all sessions, that a session cannot override
+SHARED_OPTIONS = {'globals': ('udp_port', 'interfaces', 'scan_interval', 'netlink', 'netlink_fallback_interval', 
+                              'event_loop'), 
+                  'server': ('workers', 'inbox_stats_interval'), 
+                  }
+# Options that must differ between sessions
+SESSION_KEYS = (('globals', 'secret'), ('server', 'phonebook_db'), ('server', 'sql_inbox'), ('timeline', 'segment'))
+# Options of earlier versions that would otherwise be silently ignored
+OBSOLETE_OPTIONS = {('regex', 'vote_pattern'): 'replaced by the choices and patterns of the [poll] section'}
+    
+def validate_config(config, name='config file'):
+    for (section, key), replacement in OBSOLETE_OPTIONS.items():
+        if key in config.get(section, ()):
+            raise ConfigObjError('Option {} of [{}] in {} is {}'.format(key, section, name, replacement))
+    passed = config.validate(custom_validator)
+    if passed is not True:
+        sections = [k for k, v in passed.items() if v is not True]
+        raise ConfigObjError('Error in {} sections {}'.format(name, sections))
+    return config
+    
+def parse_sessions(template, sessions, configspec):
+    # Each session of the [sessions] section is the rest of the file with its own
+    # sections merged over it, validated as a whole
+    parsed = {}
+    for name, overrides in sessions.items():
+        for section, options in SHARED_OPTIONS.items():
+            overridden = set(options).intersection(overrides.get(section, ()))
+            if overridden:
+                raise ConfigObjError('Session {!r} cannot override shared options {}'.format(name, sorted(overridden)))
+        session = ConfigObj(template, configspec=configspec, interpolation=False, encoding='utf8')
+        session.merge(overrides)
+        parsed[name] = validate_config(session, 'session {!r}'.format(name)).dict()
+    for section, key in SESSION_KEYS + (('server', 'inbox'),):
+        seen = {}
+        for name, session in parsed.items():
+            values = session[section][key]
+            for value in values if isinstance(values, list) else [values]:
+                # An empty option is unused, e.g. no SQL inbox
+                if not value:
+                    continue
+                if value in seen:
+                    raise ConfigObjError('Sessions {!r} and {!r} share {} {!r}'.format(seen[value], name, key, value))
+                seen[value] = name
+    return parsed
+    
+def parse_configfile(configfile, configspec):
+    config = ConfigObj(configfile, configspec=configspec, interpolation=False, encoding='utf8')
+    sessions = config.pop('sessions', None)
+    template = config.dict()
+    validate_config(config)
+    if sessions:
+        config['sessions'] = parse_sessions(template, sessions.dict(), configspec)
+    return config
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) 2017 Benoit Bregeault
+
+# ---------------------------------------------------------------------
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Standard library
+import json
+import logging
+from collections import namedtuple
+
+
+logger = logging.getLogger(__name__)
+
+# at: show time in seconds, args: arguments of the action as in the console requests
+Cue = namedtuple('Cue', ('at', 'action', 'args', 'label'))
+ACTIONS = ('sondage', 'finsondage', 'messages', 'osc')
+# Methods of the scheduler available to the console
+COMMANDS = ('start', 'pause', 'resume', 'skip', 'jump')
+
+
+def load_cues(path):
+    # A JSON list of {"at": 90, "action": "sondage", "args": ["Titre", 30], "label": "Poll 1"}
+    with open(path, encoding='utf8') as f:
+        items = json.load(f)
+    cues = []
+    for index, item in enumerate(items):
+        action = item.get('action')
+        if action not in ACTIONS:
+            raise ValueError('Unknown action {!r} in cue {} of {!r}'.format(action, index, path))
+        args = list(item.get('args', []))
+        label = item.get('label') or '{} {}'.format(action, ' '.join(map(str, args))).strip()
+        cues.append(Cue(float(item['at']), action, args, label))
+    cues.sort(key=lambda cue: cue.at)
+    logger.info('Loaded %d cues from %r', len(cues), path)
+    return cues
+
+
+class CueScheduler:
+    # Every cue is scheduled with call_at on the loop monotonic clock, at the show
+    # origin plus its time: a late cue never delays the following ones
+    def __init__(self, loop, cues, fire, state_changed=None, late_warning=0.05, logger=logger):
+        self._loop = loop
+        self._logger = logger
+        self.cues = list(cues)
+        self._fire_cb = fire
+        self._state_changed = state_changed
+        self._late_warning = late_warning
+        self.position = 0
+        self._origin = None
+        self._paused_at = 0
+        self._handle = None
+        self.max_lateness = 0
+
+    def __repr__(self):
+        return '{}({} cues, position {})'.format(self.__class__.__qualname__, len(self.cues), self.position)
+
+    @property
+    def running(self):
+        return self._origin is not None
+
+    def show_time(self):
+        return self._loop.time() - self._origin if self.running else self._paused_at
+
+    def state(self):
+        return [self.position, self.running, self.show_time()]
+
+    def start(self):
+        self.pause()
+        self.position = 0
+        self._paused_at = 0
+        self.resume()
+
+    def resume(self):
+        if not self.running:
+            self._origin = self._loop.time() - self._paused_at
+            self._schedule()
+
+    def pause(self):
+        if self.running:
+            self._paused_at = self.show_time()
+            self._origin = None
+            self._schedule()
+
+    def skip(self):
+        if self.position < len(self.cues):
+            self._logger.info('Skipping cue %d: %s', self.position, self.cues[self.position].label)
+            self.position += 1
+            self._schedule()
+
+    def jump(self, index):
+        # The show clock moves to the time of the cue, which fires right away if running
+        if not 0 <= index < len(self.cues):
+            raise IndexError('No cue {} in {!r}'.format(index, self))
+        self.position = index
+        if self.running:
+            self._origin = self._loop.time() - self.cues[index].at
+        else:
+            self._paused_at = self.cues[index].at
+        self._schedule()
+
+    def _schedule(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self.running and self.position < len(self.cues):
+            deadline = self._origin + self.cues[self.position].at
+            self._handle = self._loop.call_at(deadline, self._fire, deadline)
+        if self._state_changed is not None:
+            self._state_changed(self.state())
+
+    def _fire(self, deadline):
+        self._handle = None
+        lateness = self._loop.time() - deadline
+        self.max_lateness = max(self.max_lateness, lateness)
+        index = self.position
+        cue = self.cues[index]
+        self.position += 1
+        if lateness > self._late_warning:
+            self._logger.warning('Cue %d %r fired %.0f ms late', index, cue.label, lateness * 1000)
+        self._fire_cb(index, cue)
+        self._schedule()
@@ -22,9 +22,14 @@
 
 # Standard library
 import os.path
+import errno
 import glob
 import time
+import struct
+import zlib
 import pickle
+import socket
+import sqlite3
 import logging
 import asyncio
 from re import fullmatch
@@ -33,40 +38,133 @@ from re import fullmatch
 import aionotify
 import netifaces
 
+# Application
+import utils
+
 
 logger = logging.getLogger(__name__)
 
+# First byte of compressed frames, never the first byte of a pickle
+COMPRESSED = b'\x01'
+COMPRESSED_ZDICT = b'\x02'
+
+# Preset dictionary of the compressed link, so that the first frames of a
+# connection compress as well as the following ones
+ZDICT = b''.join(pickle.dumps(frame) for frame in (
+    ['/voter', ['0600000000', '20170101_000000', '20170101_000000', 0, 0, '', 0, 0]],
+    ['/message', [0, '0600000000', 'message', False, False, 1, False, 0]],
+    ['/event', [0, '20170101_000000', utils.CLIENT_ID, 'message', utils.EventTypes.message]],
+    ['/event', [None, '20170101_000000', '0600000000', 'VRAI', utils.EventTypes.vote]],
+    ))
+ZDICT_CRC = zlib.crc32(ZDICT)
+
 
 class UDPBroadcastListener(asyncio.DatagramProtocol):
-    def __init__(self, loop, secret_pattern, callback=None, endianness='big'):
+    # Consoles are routed to the callback of the first secret pattern they match
+    def __init__(self, loop, secret_pattern=None, callback=None, endianness='big'):
         self._loop = loop
-        self._secret_pattern = secret_pattern
-        self._callback = callback
+        self._routes = []
         self._endianness = endianness
+        if secret_pattern is not None:
+            self.add_route(secret_pattern, callback)
+            
+    def add_route(self, secret_pattern, callback):
+        self._routes.append((secret_pattern, callback))
 
     def datagram_received(self, data, peer):
-        secret_match = fullmatch(self._secret_pattern, data)
-        if secret_match:
-            port = secret_match.group('port')
-            port = int.from_bytes(port, self._endianness)
-            logger.info('UDP Got Secret message with port %d from %r', port, peer)
-            if self._callback is not None:
-                self._loop.call_soon(self._callback, port, peer)
+        for secret_pattern, callback in self._routes:
+            secret_match = fullmatch(secret_pattern, data)
+            if secret_match:
+                break
         else:
             logger.debug('UDP Wrong secret received: %r from %r', data, peer)
+            return
+        port = secret_match.group('port')
+        port = int.from_bytes(port, self._endianness)
+        logger.info('UDP Got Secret message with port %d from %r', port, peer)
+        if callback is not None:
+            self._loop.call_soon(callback, port, peer)
+
+
+class NetlinkMonitor:
+    # rtnetlink multicast groups and message types, see linux/rtnetlink.h
+    RTMGRP_LINK = 0x1
+    RTMGRP_IPV4_IFADDR = 0x10
+    RTM_TYPES = {16: 'NEWLINK', 17: 'DELLINK', 20: 'NEWADDR', 21: 'DELADDR'}
+    NLMSGHDR = struct.Struct('=LHHLL')
+    
+    def __init__(self, loop, callback):
+        self._loop = loop
+        self._callback = callback
+        self._sock = None
+        
+    def start(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        except (AttributeError, OSError) as e:
+            logger.info('Netlink unavailable, falling back to interface polling: %r', e)
+            return False
+        sock.setblocking(False)
+        sock.bind((0, self.RTMGRP_LINK | self.RTMGRP_IPV4_IFADDR))
+        self._sock = sock
+        self._loop.add_reader(sock.fileno(), self._read)
+        logger.debug('Listening to netlink address changes')
+        return True
+        
+    def stop(self):
+        if self._sock is not None:
+            self._loop.remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+        
+    def _read(self):
+        changes = []
+        while True:
+            try:
+                data = self._sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # ENOBUFS: the kernel dropped messages, whatever they said calls for a rescan
+                if e.errno == errno.ENOBUFS:
+                    changes.append('OVERFLOW')
+                    continue
+                logger.warning('Netlink read failed, rescanning: %r', e)
+                changes.append('ERROR')
+                break
+            offset = 0
+            while offset + self.NLMSGHDR.size <= len(data):
+                length, msg_type, _, _, _ = self.NLMSGHDR.unpack_from(data, offset)
+                if msg_type in self.RTM_TYPES:
+                    changes.append(self.RTM_TYPES[msg_type])
+                if length < self.NLMSGHDR.size:
+                    break
+                # Netlink messages are 4 bytes aligned
+                offset += (length + 3) & ~3
+        if changes:
+            logger.debug('Netlink changes: %r', changes)
+            self._callback()
 
 
 class BroadcastsScanner:
-    def __init__(self, loop, udp_port, interfaces, *args, **kwargs):
+    def __init__(self, loop, udp_port, interfaces, *args, scan_interval=1, netlink=True, 
+                 netlink_fallback_interval=30, **kwargs):
         self._loop = loop
         self._interfaces = interfaces
         self._server_port = udp_port
         self._transports = {}
-        self._waiter = asyncio.Future(loop=loop)
-        self._running = asyncio.Event(loop=loop)
+        self._waiter = loop.create_future()
+        self._running = asyncio.Event()
+        self._changed = asyncio.Event()
         self._task = None
+        self._scan_interval = scan_interval
+        self._fallback_interval = netlink_fallback_interval
+        self._netlink = NetlinkMonitor(loop, self._changed.set) if netlink else None
+        self._netlink_active = False
         
     def start(self):
+        if self._netlink is not None:
+            self._netlink_active = self._netlink.start()
         self._task = self._loop.create_task(self.scan_available_broadcasts())
         self._task.add_done_callback(self._task_done)
         self._running.set()
@@ -76,10 +174,11 @@ class BroadcastsScanner:
         if not task.cancelled() and task.exception():
             logger.error('Error in Scanner task %r', task.exception())
         
-    @asyncio.coroutine
-    def stop(self):
+    async def stop(self):
         self._task.cancel()
-        yield from self._waiter
+        await self._waiter
+        if self._netlink is not None:
+            self._netlink.stop()
         self._close_transports()
         
     def _close_transports(self, addr_set=None):
@@ -95,26 +194,36 @@ class BroadcastsScanner:
         
     def resume(self):
         self._running.set()
+        
+    def _next_interval(self):
+        # With netlink, scans are triggered by address changes and polling is only a safety net
+        return self._fallback_interval if self._netlink_active else self._scan_interval
+        
+    def _broadcast_addresses(self):
+        bcast_addresses = set()
+        available = netifaces.interfaces()
+        for iface in self._interfaces:
+            if iface not in available:
+                logger.warning('%s not in %r', iface, available)
+                continue
+            addresses = netifaces.ifaddresses(iface)
+            bcast_addresses.update([dic['broadcast'] for dic in addresses.get(netifaces.AF_INET, []) 
+                                    if 'broadcast' in dic])
+        return bcast_addresses
 
-    @asyncio.coroutine
-    def scan_available_broadcasts(self):
+    async def scan_available_broadcasts(self):
         while True:
             if not self._running.is_set():
                 self._close_transports()
-                yield from self._running.wait()
-            bcast_addresses = set()
-            for iface in self._interfaces:
-                if iface not in netifaces.interfaces():
-                    logger.warning('%s not in %r', iface, netifaces.interfaces())
-                    continue
-                addresses = netifaces.ifaddresses(iface)
-                bcast_addresses.update([dic['broadcast'] for dic in addresses.get(netifaces.AF_INET, [])])
-#            logger.debug('Sending addresses for setup: %r', bcast_addresses)
-            yield from self._setup_broadcasts(bcast_addresses)
-            yield from asyncio.sleep(1)
-        
-    @asyncio.coroutine
-    def _setup_broadcasts(self, addresses):
+                await self._running.wait()
+            self._changed.clear()
+            await self._setup_broadcasts(self._broadcast_addresses())
+            try:
+                await asyncio.wait_for(self._changed.wait(), self._next_interval())
+            except asyncio.TimeoutError:
+                pass
+        
+    async def _setup_broadcasts(self, addresses):
         raise NotImplementedError
         
         
@@ -126,33 +235,61 @@ class BroadcastServer(BroadcastsScanner):
     def _get_protocol(self):
         return self._protocol
         
-    @asyncio.coroutine
-    def _setup_broadcasts(self, addresses):
+    async def _setup_broadcasts(self, addresses):
         running = set(self._transports)
         if addresses != running:
             for addr in addresses - running:
-                transport, _ = yield from self._loop.create_datagram_endpoint(self._get_protocol, local_addr=(addr, self._server_port))
+                transport, _ = await self._loop.create_datagram_endpoint(self._get_protocol, local_addr=(addr, self._server_port))
                 self._transports[addr] = transport
                 logger.info('Added server listening to %r', transport.get_extra_info('sockname'))
             self._close_transports(running - addresses)
 
 
+class SharedScanner:
+    # Scanner of several sessions: it only pauses once all of them have their peer
+    def __init__(self, scanner, sessions):
+        self._scanner = scanner
+        self._sessions = sessions
+        self._connected = 0
+        
+    def pause(self):
+        self._connected += 1
+        if self._connected == self._sessions:
+            self._scanner.pause()
+            
+    def resume(self):
+        if self._connected == self._sessions:
+            self._scanner.resume()
+        self._connected -= 1
+
+
 class BroadcastClient(BroadcastsScanner):
-    def __init__(self, *args, secret_message, tcp_port, **kwargs):
+    def __init__(self, *args, secret_message, tcp_port, min_interval=0.2, max_interval=5, backoff=1.5, **kwargs):
         super().__init__(*args, **kwargs)
         self._secret_message = secret_message
         self._tcp_port = tcp_port
-        self._connection = asyncio.async(self._loop.create_datagram_endpoint(
-                                                        asyncio.DatagramProtocol, 
-                                                        family=netifaces.AF_INET, 
-                                                        allow_broadcast=True)
-                                        )
-        
-    @asyncio.coroutine
-    def _setup_broadcasts(self, addresses):
+        # Secrets are sent fast right after startup, disconnection or address change, then less often
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._backoff = backoff
+        self._interval = min_interval
+        
+    def resume(self):
+        self._interval = self._min_interval
+        super().resume()
+        self._changed.set()
+        
+    def _next_interval(self):
+        if self._changed.is_set():
+            self._interval = self._min_interval
+        interval = self._interval
+        self._interval = min(self._interval * self._backoff, self._max_interval)
+        return interval
+        
+    async def _setup_broadcasts(self, addresses):
         if 'client' not in self._transports:
             logger.debug('Creating transport for secret broadcast')
-            self._transports['client'], _ = yield from self._loop.create_datagram_endpoint(
+            self._transports['client'], _ = await self._loop.create_datagram_endpoint(
                                                                 asyncio.DatagramProtocol, 
                                                                 family=netifaces.AF_INET, 
                                                                 allow_broadcast=True)
@@ -163,6 +300,9 @@ class BroadcastClient(BroadcastsScanner):
 
 
 class TCPPacketProtocol(asyncio.Protocol):
+    # Subclasses serving one session log through an adapter tagging its records
+    _logger = logger
+    
     def __init__(self, loop, tcp_header_size, endianness, timestamp_format, *args, **kwargs):
         self._peer_transport = None
         self._packet_len = 0
@@ -171,7 +311,8 @@ class TCPPacketProtocol(asyncio.Protocol):
         self._tcp_header_size = tcp_header_size
         self._endianness = endianness
         self._timestamp_format = timestamp_format
-        logger.info('%s initialized successfully', self.__class__.__name__)
+        self._last_received = 0
+        self._logger.info('%s initialized successfully', self.__class__.__name__)
         
     def __enter__(self):
         self._loop.run_until_complete(self.setup())
@@ -190,17 +331,20 @@ class TCPPacketProtocol(asyncio.Protocol):
         
     def connection_made(self, transport):
         self._peer_transport = transport
+        # The heartbeat timeout counts from the connection, not from the loop start
+        self._last_received = self._loop.time()
         peername = transport.get_extra_info('peername')
-        logger.info('TCP Connection established with %r', peername)
+        self._logger.info('TCP Connection established with %r', peername)
         self._scanner.pause()
         
     def connection_lost(self, exc):
         self._peer_transport.close()
         self._peer_transport = None
-        logger.info("TCP Socket closed with error %r", exc)
+        self._logger.info("TCP Socket closed with error %r", exc)
         self._scanner.resume()
         
     def data_received(self, data):
+        self._last_received = self._loop.time()
         while data:
             if self._packet_len == 0:
                 c = self._tcp_header_size - len(self._buffer)
@@ -209,7 +353,7 @@ class TCPPacketProtocol(asyncio.Protocol):
                 if len(self._buffer) == self._tcp_header_size:
                     self._packet_len = int.from_bytes(self._buffer, self._endianness)
                     self._buffer = b''
-#                    logger.debug('Got header : size={} bytes'.format(self._packet_len))
+#                    self._logger.debug('Got header : size={} bytes'.format(self._packet_len))
                     
             if self._packet_len > 0:
                 c = self._packet_len - len(self._buffer)
@@ -218,7 +362,7 @@ class TCPPacketProtocol(asyncio.Protocol):
                 if len(self._buffer) == self._packet_len:
                     timestamp = time.strftime(self._timestamp_format)
                     self._loop.call_soon(self._handle_packet, self._buffer, timestamp)
-#                    logger.debug('Got OSC datagram size=%r bytes : %r', self._packet_len, self._buffer)
+#                    self._logger.debug('Got OSC datagram size=%r bytes : %r', self._packet_len, self._buffer)
                     self._packet_len = 0
                     self._buffer = b''
                     
@@ -229,81 +373,354 @@ class TCPPacketProtocol(asyncio.Protocol):
         if not all(isinstance(p, bytes) for p in packets):
             raise TypeError('All packets must be bytes instances')
         if not self._peer_transport:
-            logger.error('Attempting to send packets to TCP client without a connection !')
+            self._logger.error('Attempting to send packets to TCP client without a connection !')
             return
             
+        debug = self._logger.isEnabledFor(logging.DEBUG)
         for packet in packets:
             header = len(packet).to_bytes(self._tcp_header_size, self._endianness)
-            logger.debug('Sending packet over TCP to client: %r', packet)
+            if debug:
+                self._logger.debug('Sending packet over TCP to client: %d bytes', len(packet))
             self._peer_transport.write(header + packet)
 
 
+class LinkStats:
+    # RTT smoothing and jitter estimation as in RFC 6298 and RFC 3550
+    def __init__(self):
+        self.reset()
+        
+    def reset(self):
+        self.rtt = None
+        self.srtt = None
+        self.jitter = 0
+        self.min_rtt = None
+        self.max_rtt = None
+        self.pongs = 0
+        self.pings = 0
+        # Frame bytes before compression and on the wire, TCP headers excluded
+        self.raw_sent = 0
+        self.wire_sent = 0
+        self.raw_received = 0
+        self.wire_received = 0
+        
+    def add(self, rtt):
+        if self.rtt is not None:
+            self.jitter += (abs(rtt - self.rtt) - self.jitter) / 16
+        self.srtt = rtt if self.srtt is None else self.srtt + (rtt - self.srtt) / 8
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.max_rtt = rtt if self.max_rtt is None else max(self.max_rtt, rtt)
+        self.rtt = rtt
+        self.pongs += 1
+        
+    def as_dict(self):
+        return {'rtt': self.rtt, 'srtt': self.srtt, 'jitter': self.jitter, 'min_rtt': self.min_rtt, 
+                'max_rtt': self.max_rtt, 'lost': self.pings - self.pongs, 
+                'raw_sent': self.raw_sent, 'wire_sent': self.wire_sent, 
+                'raw_received': self.raw_received, 'wire_received': self.wire_received}
+
+
 class PickleStreamProtocol(TCPPacketProtocol):
+    def __init__(self, loop, *args, heartbeat_interval=1, heartbeat_timeout=3.5, 
+                 compression_level=6, compression_min_size=64, **kwargs):
+        super().__init__(loop, *args, **kwargs)
+        self._heartbeat_interval = heartbeat_interval
+        self._heartbeat_timeout = heartbeat_timeout
+        self._heartbeat = None
+        self.link_stats = LinkStats()
+        # One zlib stream per direction and connection: each frame is compressed
+        # with the history of the previous ones and ends with a sync flush
+        self._compression_level = compression_level
+        self._compression_min_size = compression_min_size
+        self._compressor = None
+        self._compressor_flag = None
+        self._decompressor = None
+        
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.link_stats.reset()
+        self._compressor = None
+        self._decompressor = None
+        # Frames are sent raw until the peer tells it can decompress them
+        self.request_peer('/hello', {'compression': ['zlib'] if self._compression_level else [], 
+                                     'zdict': ZDICT_CRC})
+        self._heartbeat = self._loop.call_later(self._heartbeat_interval, self._send_heartbeat)
+        
+    def connection_lost(self, exc):
+        if self._heartbeat:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        stats = self.link_stats
+        if stats.wire_sent or stats.wire_received:
+            self._logger.info('Link traffic: sent %d bytes (%d on the wire), received %d bytes (%d on the wire)', 
+                        stats.raw_sent, stats.wire_sent, stats.raw_received, stats.wire_received)
+        super().connection_lost(exc)
+        
+    def process_hello(self, payload, timestamp):
+        if not self._compression_level or 'zlib' not in payload.get('compression', ()):
+            return
+        if payload.get('zdict') == ZDICT_CRC:
+            self._compressor = zlib.compressobj(self._compression_level, zdict=ZDICT)
+            self._compressor_flag = COMPRESSED_ZDICT
+        else:
+            self._compressor = zlib.compressobj(self._compression_level)
+            self._compressor_flag = COMPRESSED
+        self._logger.info('Compressing frames of at least %d bytes to peer, zlib level %d', 
+                    self._compression_min_size, self._compression_level)
+        
+    def _encode(self, packet):
+        self.link_stats.raw_sent += len(packet)
+        if self._compressor is not None and len(packet) >= self._compression_min_size:
+            packet = b''.join((self._compressor_flag, self._compressor.compress(packet), 
+                               self._compressor.flush(zlib.Z_SYNC_FLUSH)))
+        self.link_stats.wire_sent += len(packet)
+        return packet
+        
+    def _decode(self, packet):
+        self.link_stats.wire_received += len(packet)
+        flag = packet[:1]
+        if flag == COMPRESSED or flag == COMPRESSED_ZDICT:
+            if self._decompressor is None:
+                self._decompressor = zlib.decompressobj(zdict=ZDICT) if flag == COMPRESSED_ZDICT else zlib.decompressobj()
+            packet = self._decompressor.decompress(packet[1:])
+        self.link_stats.raw_received += len(packet)
+        return packet
+        
+    def _send_heartbeat(self):
+        now = self._loop.time()
+        silence = now - self._last_received
+        if silence > self._heartbeat_timeout:
+            self._logger.warning('No data from peer for %.2fs, closing connection', silence)
+            self._heartbeat = None
+            self._peer_transport.abort()
+            return
+        self.link_stats.pings += 1
+        self.request_peer('/ping', [now])
+        self._heartbeat = self._loop.call_later(self._heartbeat_interval, self._send_heartbeat)
+        
+    def process_ping(self, payload, timestamp):
+        self.request_peer('/pong', payload)
+        
+    def process_pong(self, payload, timestamp):
+        self.link_stats.add(self._loop.time() - payload[0])
+        self.link_stats_changed()
+        
+    def link_stats_changed(self):
+        pass
+        
     def _handle_packet(self, packet, timestamp):
+        try:
+            packet = self._decode(packet)
+        except zlib.error as e:
+            # The rest of the stream cannot be decompressed either
+            self._logger.error('Invalid compressed packet: %r, closing connection', e)
+            self._peer_transport.abort()
+            return
         try:
             command, payload = pickle.loads(packet)
         except ValueError:
-            logger.error('Invalid Packet received: %r', pickle.loads(packet))
+            self._logger.error('Invalid Packet received: %r', pickle.loads(packet))
             return
         handler_name = 'process_' + command.lstrip('/')
         handler = getattr(self, handler_name, None)
         if handler:
             self._loop.call_soon(handler, payload, timestamp)
         else:
-            logger.error('Unknown handler for Packet type %r', command)
+            self._logger.error('Unknown handler for Packet type %r', command)
             
     def send_to_peer(self, *packets):
-        super().send_to_peer(*(pickle.dumps(p) for p in packets))
+        super().send_to_peer(*(self._encode(pickle.dumps(p)) for p in packets))
         
     def request_peer(self, command, params):
         packet = pickle.dumps([command, params])
-        super().send_to_peer(packet)
+        super().send_to_peer(self._encode(packet))
+
+
+class PeerLogHandler(logging.Handler):
+    # Runs in the logging listener thread: records are rate limited there and
+    # only the accepted ones are handed over to the event loop
+    def __init__(self, loop, callback, level=logging.WARNING, rate=10, burst=50, session=None):
+        super().__init__(level)
+        self._loop = loop
+        self._callback = callback
+        self._session = session
+        self._bucket = utils.TokenBucket(rate, burst)
+        self._dropped = 0
+
+    def filter(self, record):
+        # Records of another session stay out, records shared by all sessions go to every console
+        return getattr(record, 'session', self._session) == self._session and super().filter(record)
+
+    def emit(self, record):
+        if not self._bucket.consume():
+            self._dropped += 1
+            return
+        try:
+            payload = [record.levelno, record.name, self.format(record), self._dropped]
+            self._dropped = 0
+            self._loop.call_soon_threadsafe(self._callback, payload)
+        except RuntimeError: # loop closed
+            pass
+        except Exception:
+            self.handleError(record)
 
 
 class SMSWatcher(aionotify.Watcher):
-    def __init__(self, directory, callback):
+    # A single inotify instance watching every inbox directory, one per modem and
+    # session. SMS of each directory go to its callback
+    def __init__(self, inboxes, stats_interval=60):
         super().__init__()
-        self.directory = directory
-        self._callback = callback
+        self.directories = list(inboxes)
+        self._callbacks = dict(inboxes)
         self._task = None
-        self._waiter = asyncio.Future()
+        self._waiter = None
+        self.counts = {directory: 0 for directory in self.directories}
+        self._stats_interval = stats_interval
+        self._stats_handle = None
+        self._reported = dict(self.counts)
+        self._report_time = None
 
     def __repr__(self):
-        return "{}('{directory}', {_callback.__qualname__})".format(self.__class__.__qualname__, **self.__dict__)
+        return "{}({directories!r})".format(self.__class__.__qualname__, **self.__dict__)
     
-    @asyncio.coroutine
-    def setup(self, *args, **kwargs):
-        yield from super().setup(*args, **kwargs)
-        self.watch(alias='sms', path=self.directory, flags=aionotify.Flags.CREATE)
+    async def setup(self, *args, **kwargs):
+        await super().setup(*args, **kwargs)
+        self._waiter = self._loop.create_future()
+        for directory in self.directories:
+            self.watch(alias=directory, path=directory, flags=aionotify.Flags.CREATE)
         self._task = self._loop.create_task(self.listen_to_inotify())
         self._task.add_done_callback(self._task_done)
+        if self._stats_interval:
+            self._report_time = self._loop.time()
+            self._stats_handle = self._loop.call_later(self._stats_interval, self._report_stats)
         logger.debug('Leaving setup of %r', self)
 
     def _task_done(self, task):
         self._waiter.set_result(None)
         if not task.cancelled() and task.exception():
             logger.error('Error in Watcher task %r', task.exception())
+            
+    def _report_stats(self):
+        now = self._loop.time()
+        elapsed = now - self._report_time
+        for directory, count in self.counts.items():
+            rate = (count - self._reported[directory]) * 60 / elapsed
+            logger.info('Inbox %r: %d SMS, %.1f SMS/min', directory, count, rate)
+        self._reported = dict(self.counts)
+        self._report_time = now
+        self._stats_handle = self._loop.call_later(self._stats_interval, self._report_stats)
+
+    def _found(self, directory, smsfile):
+        self.counts[directory] += 1
+        self._loop.call_soon(self._callbacks[directory], smsfile)
 
     def scan_directory(self):
-        for smsfile in glob.iglob(os.path.join(self.directory, '*.txt')):
-            self._loop.call_soon(self._callback, smsfile)
+        for directory in self.directories:
+            for smsfile in glob.iglob(os.path.join(directory, '*.txt')):
+                self._found(directory, smsfile)
             
-    @asyncio.coroutine
-    def stop(self):
+    async def stop(self):
+        if self._stats_handle:
+            self._stats_handle.cancel()
         self._task.cancel()
-        yield from self._waiter
+        await self._waiter
         super().close()
 
-    @asyncio.coroutine
-    def listen_to_inotify(self):
+    async def listen_to_inotify(self):
         self.scan_directory()
         while True:
-            event = yield from self.get_event()
-            logger.debug('File event: %r', event.name)
+            event = await self.get_event()
+            logger.debug('File event: %r in %r', event.name, event.alias)
             
             # If it's a directory, skip
             if event.flags & aionotify.Flags.ISDIR:
                 logger.debug('Skip directory event: %r', event.name)
                 continue
                 
-            self._loop.call_soon(self._callback, os.path.join(self.directory, event.name))
+            self._found(event.alias, os.path.join(event.alias, event.name))
+
+
+class SQLInboxWatcher:
+    # Reads new rows of a gammu-smsd SQLite inbox by increasing ID, in batches
+    QUERY = 'SELECT ID, ReceivingDateTime, SenderNumber, TextDecoded FROM inbox WHERE ID > ? ORDER BY ID LIMIT ?'
+    # The query runs on the loop: a database locked by gammu-smsd is read again on the next tick
+    LOCK_TIMEOUT = 0.05
+    
+    def __init__(self, path, callback, poll_interval=0.5, batch_size=500, last_id=0, logger=logger):
+        self.path = path
+        self._callback = callback
+        self._logger = logger
+        self._poll_interval = poll_interval
+        self._batch_size = batch_size
+        self.last_id = last_id
+        self.count = 0
+        self._db = None
+        self._loop = None
+        self._notifier = None
+        self._changed = None
+        self._task = None
+        self._waiter = None
+        
+    def __repr__(self):
+        return "{}('{path}', {_callback.__qualname__})".format(self.__class__.__qualname__, **self.__dict__)
+        
+    async def setup(self, loop):
+        self._loop = loop
+        self._changed = asyncio.Event()
+        self._waiter = loop.create_future()
+        self._db = sqlite3.connect('file:{}?mode=ro'.format(self.path), uri=True, timeout=self.LOCK_TIMEOUT)
+        # gammu-smsd writes to the database, its WAL file or its journal: any of them means new rows
+        directory, name = os.path.split(os.path.abspath(self.path))
+        self._names = {name, name + '-wal', name + '-journal'}
+        self._notifier = aionotify.Watcher()
+        self._notifier.watch(alias='sql', path=directory, flags=aionotify.Flags.MODIFY | aionotify.Flags.CREATE)
+        await self._notifier.setup(loop)
+        self._task = loop.create_task(self.listen_to_database())
+        self._task.add_done_callback(self._task_done)
+        self._logger.debug('Leaving setup of %r', self)
+        
+    def _task_done(self, task):
+        self._waiter.set_result(None)
+        if not task.cancelled() and task.exception():
+            self._logger.error('Error in SQL inbox task %r', task.exception())
+            
+    async def stop(self):
+        self._task.cancel()
+        await self._waiter
+        self._notifier.close()
+        self._db.close()
+        
+    def fetch(self):
+        while True:
+            rows = self._db.execute(self.QUERY, (self.last_id, self._batch_size)).fetchall()
+            for sms_id, received, sender, content in rows:
+                # Moved past before the callback: a row it fails on is never read again
+                self.last_id = sms_id
+                self._callback(sms_id, received, sender, content)
+            if rows:
+                self.count += len(rows)
+                self._logger.debug('Read %d SMS from %r up to ID %d', len(rows), self.path, self.last_id)
+            if len(rows) < self._batch_size:
+                return
+                
+    async def _listen_to_inotify(self):
+        while True:
+            event = await self._notifier.get_event()
+            if event.name in self._names:
+                self._changed.set()
+                
+    async def listen_to_database(self):
+        notifications = self._loop.create_task(self._listen_to_inotify())
+        try:
+            while True:
+                self._changed.clear()
+                try:
+                    self.fetch()
+                except sqlite3.OperationalError as e:
+                    self._logger.warning('Cannot read %r now, will retry: %s', self.path, e)
+                try:
+                    await asyncio.wait_for(self._changed.wait(), self._poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            notifications.cancel()
+
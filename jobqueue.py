@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) 2017 Benoit Bregeault
+
+# ---------------------------------------------------------------------
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Standard library
+import sys
+import csv
+import time
+import sqlite3
+import logging
+import argparse
+
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+# Caught in flight by a crash or a stop: maybe sent and charged, kept for the audit
+INTERRUPTED = 'interrupted'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created REAL NOT NULL,
+    sender TEXT NOT NULL,
+    content TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS recipients (
+    job_id INTEGER NOT NULL REFERENCES jobs(id),
+    phone TEXT NOT NULL,
+    state TEXT NOT NULL,
+    response TEXT,
+    updated REAL,
+    PRIMARY KEY (job_id, phone)
+);
+CREATE INDEX IF NOT EXISTS recipients_state ON recipients(state, job_id);
+"""
+
+
+class SMSJobQueue:
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        # WAL with synchronous=NORMAL survives a crash of the client process
+        # without paying an fsync for every recipient update
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._recover()
+
+    def __repr__(self):
+        return "{}('{}')".format(self.__class__.__qualname__, self.path)
+
+    def _recover(self):
+        # A recipient caught in flight may or may not have been charged by the
+        # provider: never send it again automatically, keep it for the audit
+        with self._db:
+            cursor = self._db.execute('UPDATE recipients SET state=?, updated=? WHERE state=?',
+                                      (INTERRUPTED, time.time(), SENDING))
+        if cursor.rowcount:
+            logger.warning('%d SMS interrupted during sending, not sent again', cursor.rowcount)
+
+    def close(self):
+        self._db.close()
+
+    def create_job(self, sender, content, phonelist):
+        with self._db:
+            cursor = self._db.execute('INSERT INTO jobs (created, sender, content) VALUES (?, ?, ?)',
+                                      (time.time(), sender, content))
+            job_id = cursor.lastrowid
+            self._db.executemany('INSERT OR IGNORE INTO recipients (job_id, phone, state) VALUES (?, ?, ?)',
+                                 ((job_id, phone, PENDING) for phone in phonelist))
+        logger.debug('Created SMS job %d for %d recipients', job_id, len(phonelist))
+        return job_id
+
+    def pending_jobs(self):
+        jobs = self._db.execute('SELECT id, sender, content FROM jobs WHERE id IN '
+                                '(SELECT DISTINCT job_id FROM recipients WHERE state=?) ORDER BY id',
+                                (PENDING,)).fetchall()
+        for job_id, sender, content in jobs:
+            phones = [row[0] for row in self._db.execute('SELECT phone FROM recipients WHERE job_id=? AND state=?',
+                                                         (job_id, PENDING))]
+            yield job_id, sender, content, phones
+
+    def mark_sending(self, job_id, phone):
+        with self._db:
+            self._db.execute('UPDATE recipients SET state=?, updated=? WHERE job_id=? AND phone=?',
+                             (SENDING, time.time(), job_id, phone))
+
+    def record(self, job_id, phone, sent, response):
+        state = SENT if sent else FAILED
+        with self._db:
+            self._db.execute('UPDATE recipients SET state=?, response=?, updated=? WHERE job_id=? AND phone=?',
+                             (state, response, time.time(), job_id, phone))
+
+    def receipts(self, job_id=None):
+        query = ('SELECT jobs.id, jobs.created, jobs.sender, jobs.content, phone, state, response, updated '
+                 'FROM recipients JOIN jobs ON jobs.id = recipients.job_id')
+        if job_id is None:
+            return self._db.execute(query + ' ORDER BY jobs.id, phone')
+        return self._db.execute(query + ' WHERE jobs.id=? ORDER BY phone', (job_id,))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Dump SMS delivery receipts as CSV')
+    parser.add_argument('database', type=str)
+    parser.add_argument('-j', '--job', type=int)
+    args = parser.parse_args()
+
+    queue = SMSJobQueue(args.database)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(['job', 'created', 'sender', 'content', 'phone', 'state', 'response', 'updated'])
+    writer.writerows(queue.receipts(args.job))
+    queue.close()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) 2017 Benoit Bregeault
+
+# ---------------------------------------------------------------------
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Standard library
+import re
+import logging
+from collections import deque
+
+# Application
+from classifier import normalize
+
+
+logger = logging.getLogger(__name__)
+
+FLAG = 'flag'
+HIDE = 'hide'
+
+
+class WordMatcher:
+    # Aho-Corasick automaton: every word of the list is searched in a single pass over the SMS
+    def __init__(self, words):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+        for word in words:
+            self._add(word)
+        self._build()
+
+    def __len__(self):
+        return sum(1 for output in self._output if output)
+
+    def _add(self, word):
+        state = 0
+        for char in word:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            state = next_state
+        self._output[state] = (word,)
+
+    def _build(self):
+        # Breadth first, so that the failure state of a node is complete before its children
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] += self._output[self._fail[child]]
+
+    def finditer(self, text):
+        state = 0
+        goto, fail, output = self._goto, self._fail, self._output
+        for end, char in enumerate(text, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for word in output[state]:
+                yield end - len(word), end, word
+
+    def search(self, text):
+        # First word of the list found as a whole word in text, None otherwise
+        for start, end, word in self.finditer(text):
+            if (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum()):
+                return word
+        return None
+
+
+def fingerprint(content):
+    # Messages differing only by case, accents, punctuation, spacing or
+    # repeated letters ('Looool !!', 'lol') share the same fingerprint
+    words = re.findall(r'\w+', normalize(content))
+    return re.sub(r'(.)\1+', r'\1', ' '.join(words))
+
+
+class Moderator:
+    def __init__(self, words=(), action=FLAG, collapse_duplicates=True):
+        if action not in (FLAG, HIDE):
+            raise ValueError('Unknown moderation action: {!r}'.format(action))
+        words = {' '.join(normalize(word).split()) for word in words}
+        words.discard('')
+        self._matcher = WordMatcher(words) if words else None
+        self.hide = action == HIDE
+        self.collapse_duplicates = collapse_duplicates
+        logger.info('Moderation of %d words (%s), duplicates %s', len(words), action,
+                    'collapsed' if collapse_duplicates else 'kept')
+
+    def flagged(self, content):
+        if self._matcher is None:
+            return None
+        return self._matcher.search(' '.join(normalize(content).split()))
+
+    @classmethod
+    def from_config(cls, moderation_config):
+        words = list(moderation_config['words'])
+        if moderation_config['words_file']:
+            with open(moderation_config['words_file'], encoding='utf8') as f:
+                words.extend(line for line in f if not line.startswith('#'))
+        return cls(words, moderation_config['action'], moderation_config['collapse_duplicates'])
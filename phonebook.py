@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) 2017 Benoit Bregeault
+
+# ---------------------------------------------------------------------
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Standard library
+import sqlite3
+import logging
+from collections import namedtuple
+
+# Application
+import utils
+
+
+logger = logging.getLogger(__name__)
+
+# Revisions reserved at once in the database
+REV_BLOCK = 1000
+# Criteria of select() a console may ask for, opt outs always excluded
+SELECT_CRITERIA = ('seen_since', 'min_messages', 'poll', 'choice')
+
+Voter = namedtuple('Voter', ('phone', 'first_seen', 'last_seen', 'messages', 'votes', 'pedigree', 'opt_out', 'rev'))
+VOTER_COLUMNS = ', '.join(Voter._fields)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS phones (
+    phone TEXT PRIMARY KEY,
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL,
+    messages INTEGER NOT NULL DEFAULT 0,
+    votes INTEGER NOT NULL DEFAULT 0,
+    pedigree TEXT NOT NULL DEFAULT '',
+    opt_out INTEGER NOT NULL DEFAULT 0,
+    rev INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS phones_rev ON phones(rev);
+CREATE INDEX IF NOT EXISTS phones_last_seen ON phones(last_seen);
+CREATE INDEX IF NOT EXISTS phones_opt_out ON phones(opt_out, last_seen);
+
+CREATE TABLE IF NOT EXISTS poll_votes (
+    poll TEXT NOT NULL,
+    choice TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (poll, choice, phone)
+);
+CREATE INDEX IF NOT EXISTS poll_votes_phone ON poll_votes(phone);
+
+-- Every recorded SMS, so that replaying the inbox on restart is idempotent
+CREATE TABLE IF NOT EXISTS events (
+    timestamp TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (phone, timestamp, data)
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+class PhonebookStore:
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        reserved = self._db.execute("SELECT value FROM meta WHERE key='rev'").fetchone()
+        self.rev = max(reserved[0] if reserved else 0,
+                       self._db.execute('SELECT COALESCE(MAX(rev), 0) FROM phones').fetchone()[0])
+        self._reserved_rev = self.rev
+        logger.info('Phonebook %r loaded at revision %d', path, self.rev)
+
+    def __repr__(self):
+        return "{}('{}')".format(self.__class__.__qualname__, self.path)
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM phones').fetchone()[0]
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    def _next_rev(self):
+        # Revisions are sent to the consoles before the batch is committed: they are reserved
+        # by blocks, committed with the pending changes, so that a crash never reuses one
+        self.rev += 1
+        if self.rev > self._reserved_rev:
+            self._reserved_rev = self.rev + REV_BLOCK
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rev', ?)", (self._reserved_rev,))
+            self._db.commit()
+        return self.rev
+
+    def get(self, phone):
+        row = self._db.execute('SELECT {} FROM phones WHERE phone=?'.format(VOTER_COLUMNS), (phone,)).fetchone()
+        return Voter(*row) if row else None
+
+    def record(self, event, poll=''):
+        # Statements run in an open transaction, committed in batches by the owner
+        cursor = self._db.execute('INSERT OR IGNORE INTO events (timestamp, phone, data) VALUES (?, ?, ?)',
+                                  (event.timestamp, event.phone, event.data))
+        if not cursor.rowcount:
+            return None
+
+        is_vote = event.type in utils.VOTE_TYPES
+        is_message = event.type == utils.EventTypes.message
+        rev = self._next_rev()
+        self._db.execute('INSERT OR IGNORE INTO phones (phone, first_seen, last_seen, rev) VALUES (?, ?, ?, ?)',
+                         (event.phone, event.timestamp, event.timestamp, rev))
+        self._db.execute('UPDATE phones SET first_seen=MIN(first_seen, :ts), last_seen=MAX(last_seen, :ts), '
+                         'messages=messages+:message, votes=votes+:vote, rev=:rev WHERE phone=:phone',
+                         {'ts': event.timestamp, 'message': int(is_message), 'vote': int(is_vote),
+                          'rev': rev, 'phone': event.phone})
+        if is_vote and poll:
+            self._db.execute('INSERT OR IGNORE INTO poll_votes (poll, choice, phone) VALUES (?, ?, ?)',
+                             (poll, event.data, event.phone))
+            self._db.execute('UPDATE poll_votes SET count=count+1 WHERE poll=? AND choice=? AND phone=?',
+                             (poll, event.data, event.phone))
+        return self.get(event.phone)
+
+    def update(self, phone, pedigree=None, opt_out=None):
+        voter = self.get(phone)
+        if voter is None:
+            return None
+        pedigree = voter.pedigree if pedigree is None else pedigree
+        opt_out = voter.opt_out if opt_out is None else int(opt_out)
+        self._db.execute('UPDATE phones SET pedigree=?, opt_out=?, rev=? WHERE phone=?',
+                         (pedigree, opt_out, self._next_rev(), phone))
+        return self.get(phone)
+
+    def changed_since(self, rev):
+        query = 'SELECT {} FROM phones WHERE rev > ? ORDER BY rev'.format(VOTER_COLUMNS)
+        return [Voter(*row) for row in self._db.execute(query, (rev,))]
+
+    def poll_votes(self, poll):
+        query = 'SELECT choice, COUNT(*), SUM(count) FROM poll_votes WHERE poll=? GROUP BY choice'
+        return {choice: (voters, votes) for choice, voters, votes in self._db.execute(query, (poll,))}
+
+    def select(self, opt_out=False, seen_since=None, min_messages=0, poll=None, choice=None):
+        clauses, params = ['opt_out=?', 'messages>=?'], [int(opt_out), min_messages]
+        if seen_since is not None:
+            clauses.append('last_seen>=?')
+            params.append(seen_since)
+        if poll is not None:
+            subquery = 'phone IN (SELECT phone FROM poll_votes WHERE poll=?{})'
+            subquery = subquery.format('' if choice is None else ' AND choice=?')
+            clauses.append(subquery)
+            params.extend([poll] if choice is None else [poll, choice])
+        query = 'SELECT phone FROM phones WHERE {} ORDER BY phone'.format(' AND '.join(clauses))
+        return [row[0] for row in self._db.execute(query, params)]
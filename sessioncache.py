@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) 2017 Benoit Bregeault
+
+# ---------------------------------------------------------------------
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# Standard library
+import sqlite3
+import logging
+
+# Application
+import utils
+from phonebook import Voter, VOTER_COLUMNS
+
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_COLUMNS = 'id, phone, content, to_display, displayed, count, flagged'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS events (
+    timestamp TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    data TEXT NOT NULL,
+    type INTEGER NOT NULL,
+    PRIMARY KEY (timestamp, phone, data, type)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    phone TEXT,
+    content TEXT NOT NULL,
+    to_display INTEGER NOT NULL,
+    displayed INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    flagged INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS voters (
+    phone TEXT PRIMARY KEY,
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL,
+    messages INTEGER NOT NULL,
+    votes INTEGER NOT NULL,
+    pedigree TEXT NOT NULL,
+    opt_out INTEGER NOT NULL,
+    rev INTEGER NOT NULL
+);
+"""
+
+# Position of the console in the server session, saved with each commit
+META_DEFAULTS = {'session_id': '', 'event_seq': 0, 'message_rev': 0, 'phonebook_rev': 0, 'history_start': 0}
+
+
+class SessionCache:
+    # Copy of the server session kept by a console, so that it renders at once on
+    # restart and only asks the server for what it missed
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self.meta = dict(META_DEFAULTS)
+        self.meta.update(self._db.execute('SELECT key, value FROM meta'))
+        logger.info('Session cache %r loaded: %r', path, self.meta)
+
+    def __repr__(self):
+        return "{}('{}')".format(self.__class__.__qualname__, self.path)
+
+    def commit(self):
+        # The position is written in the same transaction as the data it refers to
+        self._db.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', self.meta.items())
+        self._db.commit()
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+    def clear(self):
+        # Events and messages belong to a server session, the phonebook outlives it
+        self._db.execute('DELETE FROM events')
+        self._db.execute('DELETE FROM messages')
+
+    def add_events(self, events):
+        self._db.executemany('INSERT OR IGNORE INTO events (timestamp, phone, data, type) VALUES (?, ?, ?, ?)', 
+                             (tuple(event) for event in events))
+
+    def put_message(self, message):
+        if message[2]:
+            self._db.execute('INSERT OR REPLACE INTO messages ({}) VALUES (?, ?, ?, ?, ?, ?, ?)'.format(MESSAGE_COLUMNS), 
+                             message)
+        else:
+            # Empty content is a deleted message
+            self._db.execute('DELETE FROM messages WHERE id=?', (message[0],))
+
+    def put_voter(self, voter):
+        self._db.execute('INSERT OR REPLACE INTO voters ({}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(VOTER_COLUMNS), 
+                         voter)
+
+    def events(self):
+        query = 'SELECT timestamp, phone, data, type FROM events ORDER BY timestamp'
+        return [utils.Event(timestamp, phone, data, utils.EventTypes(type)) 
+                for timestamp, phone, data, type in self._db.execute(query)]
+
+    def messages(self):
+        query = 'SELECT {} FROM messages ORDER BY id'.format(MESSAGE_COLUMNS)
+        return [[id, phone, content, bool(to_display), bool(displayed), count, bool(flagged)] 
+                for id, phone, content, to_display, displayed, count, flagged in self._db.execute(query)]
+
+    def voters(self):
+        query = 'SELECT {} FROM voters ORDER BY rev'.format(VOTER_COLUMNS)
+        return [Voter(*row) for row in self._db.execute(query)]
@@ -0,0 +1,74 @@
+# Shared fixtures of the test suite, run with python -m pytest from the repository root
+
+import os
+import sys
+import asyncio
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import utils
+from SMS_server import Server
+
+CONFIG = '''
+[globals]
+udp_port = 54321
+interfaces = lo,
+secret = test
+netlink = False
+
+[server]
+phonebook_db = {tmp}/phonebook.sqlite
+
+[timeline]
+segment = {tmp}/timeline.seg
+
+[display]
+addr = 127.0.0.1
+port = 5005
+
+[client]
+jobs_db = {tmp}/jobs.sqlite
+session_cache = ''
+
+[sms_service]
+fastapi_url = https://sms.example.com/send?
+credits_url = https://sms.example.com/credits?
+
+    [[credentials]]
+    accountid = test
+    password = 12345678
+
+    [[send_options]]
+    datacoding = 8
+'''
+
+
+def load_config(tmp_path, extra=''):
+    path = tmp_path / 'verite.conf'
+    path.write_text(CONFIG.format(tmp=tmp_path) + extra)
+    with open(path) as configfile, open(os.path.join(ROOT, 'verite.spec')) as specfile:
+        return utils.load_config(configfile, specfile)
+
+
+@pytest.fixture
+def config(tmp_path):
+    return load_config(tmp_path)
+
+
+@pytest.fixture
+def server(config):
+    # A session server without network, the messages for its console and display are collected
+    config['server']['merge_window'] = 0
+    loop = asyncio.new_event_loop()
+    server = Server(loop, config)
+    server.sent = []
+    server.request_peer = lambda command, params: server.sent.append((command, params))
+    server.displayed = []
+    server.send_to_display = server.displayed.append
+    yield server
+    server._phonebook.close()
+    server._timeline.close()
+    loop.close()
@@ -0,0 +1,34 @@
+import gzip
+import json
+import logging
+
+import utils
+from analytics import Session
+
+
+def write_archive(path, count):
+    lines = (json.dumps(['event', 0, ['20170101_2000{:02d}'.format(i % 60), '0600000{:03d}'.format(i), 'VRAI',
+                                      int(utils.EventTypes.vote)]])
+             for i in range(count))
+    with gzip.open(path, 'wt', encoding='utf8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def test_truncated_archive_keeps_events_read(tmp_path, caplog):
+    path = str(tmp_path / 'Verite_Session_1.jsonl.gz')
+    write_archive(path, 2000)
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:len(data) * 3 // 4])
+
+    with caplog.at_level(logging.WARNING):
+        session = Session.from_archive(path)
+    assert 0 < len(session) < 2000
+    assert any('truncated' in record.getMessage() for record in caplog.records)
+
+
+def test_complete_archive(tmp_path):
+    path = str(tmp_path / 'Verite_Session_2.jsonl.gz')
+    write_archive(path, 50)
+    assert len(Session.from_archive(path)) == 50
@@ -0,0 +1,18 @@
+import unicodedata
+
+import utils
+import classifier
+
+
+def test_strip_accents_matches_the_unicode_decomposition():
+    for text in ('Vraï', 'à bientôt, Noël', 'Œuvre ﬁnale²', 'a͏b', 'Ça va 😀', 'ñ ü ø ł'):
+        decomposed = unicodedata.normalize('NFKD', text)
+        assert classifier.strip_accents(text) == ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def test_classify():
+    rules = classifier.Classifier(['A', 'B'], ['a|1', 'b|2'], ['delivered', '.*cherche a vous joindre.*'])
+    assert rules.classify('À') == (utils.EventTypes.vote, 'A', 0)
+    assert rules.classify('2') == (utils.EventTypes.vote, 'B', 1)
+    assert rules.classify('Il a cherché à vous joindre') is None
+    assert rules.classify('Bravo') == (utils.EventTypes.message, 'Bravo', None)
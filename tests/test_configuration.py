@@ -0,0 +1,43 @@
+import os
+import stat
+
+import pytest
+
+import utils
+import configuration
+from conftest import load_config
+
+
+def test_obsolete_vote_pattern(tmp_path):
+    with pytest.raises(utils.ConfigError, match='vote_pattern'):
+        load_config(tmp_path, "\n[regex]\nvote_pattern = '^(?P<vrai>v)|f$'\n")
+
+
+def test_cached_config_checks_inboxes(tmp_path):
+    inbox = tmp_path / 'inbox'
+    inbox.mkdir()
+    extra = '\n[sessions]\n    [[salle1]]\n        [[[server]]]\n        inbox = {},\n'.format(inbox)
+    config = load_config(tmp_path, extra)
+    assert config['sessions']['salle1']['server']['inbox'] == [str(inbox)]
+    assert load_config(tmp_path, extra) == config
+
+    inbox.rmdir()
+    with pytest.raises(utils.ConfigError):
+        load_config(tmp_path, extra)
+
+
+def test_cache_is_private_and_tied_to_the_validation_code(tmp_path, monkeypatch):
+    module = tmp_path / 'configuration.py'
+    module.write_text('# version 1\n')
+    monkeypatch.setattr(utils, 'CONFIGURATION_MODULE', str(module))
+    parses = []
+    parse_configfile = configuration.parse_configfile
+    monkeypatch.setattr(configuration, 'parse_configfile', lambda *args: parses.append(1) or parse_configfile(*args))
+
+    load_config(tmp_path)
+    assert stat.S_IMODE(os.stat(str(tmp_path / 'verite.conf.cache')).st_mode) == 0o600
+    load_config(tmp_path)
+    assert len(parses) == 1
+    module.write_text('# version 2\n')
+    load_config(tmp_path)
+    assert len(parses) == 2
@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+import cues
+
+
+class Handle:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        
+    def cancel(self):
+        self.cancelled = True
+
+
+class ManualLoop:
+    # Only the clock and call_at of an event loop, the time moves when told to
+    def __init__(self):
+        self.now = 1000.0
+        self.handles = []
+        
+    def time(self):
+        return self.now
+        
+    def call_at(self, when, callback, *args):
+        handle = Handle(when, callback, args)
+        self.handles.append(handle)
+        return handle
+        
+    def advance(self, delay):
+        end = self.now + delay
+        while True:
+            pending = [handle for handle in self.handles if not handle.cancelled and handle.when <= end]
+            if not pending:
+                break
+            handle = min(pending, key=lambda handle: handle.when)
+            self.handles.remove(handle)
+            self.now = max(self.now, handle.when)
+            handle.callback(*handle.args)
+        self.now = end
+
+
+def scheduler(handler_time=None):
+    loop = ManualLoop()
+    fired = []
+    
+    def fire(index, cue):
+        fired.append((index, loop.now))
+        if handler_time:
+            loop.now += handler_time.get(index, 0)
+        
+    show = cues.CueScheduler(loop, [cues.Cue(at, 'osc', [], str(at)) for at in (1, 2, 3, 10)], fire)
+    return loop, show, fired
+
+
+def test_slow_cues_do_not_delay_the_next_ones():
+    loop, show, fired = scheduler({0: 0.5, 1: 1.4})
+    show.start()
+    loop.advance(4)
+    assert fired == [(0, 1001), (1, 1002), (2, 1003.4)]
+    assert show.max_lateness == pytest.approx(0.4)
+    assert show.position == 3
+
+
+def test_pause_skip_and_jump():
+    loop, show, fired = scheduler()
+    show.start()
+    loop.advance(1.5)
+    show.pause()
+    loop.advance(5)
+    assert show.state() == [1, False, 1.5]
+    show.skip()
+    show.resume()
+    loop.advance(2)
+    assert fired == [(0, 1001), (2, 1008)]
+    show.jump(1)
+    assert show.show_time() == 2
+    loop.advance(0)
+    assert fired[-1] == (1, 1008.5)
+    assert show.position == 2
+    with pytest.raises(IndexError):
+        show.jump(4)
+
+
+def test_load_cues(tmp_path):
+    path = tmp_path / 'cues.json'
+    path.write_text(json.dumps([{'at': 90, 'action': 'finsondage'}, 
+                                {'at': 30, 'action': 'sondage', 'args': ['Titre', 30]}]))
+    assert cues.load_cues(str(path)) == [cues.Cue(30, 'sondage', ['Titre', 30], 'sondage Titre 30'), 
+                                         cues.Cue(90, 'finsondage', [], 'finsondage')]
+    path.write_text(json.dumps([{'at': 1, 'action': 'reboot'}]))
+    with pytest.raises(ValueError, match='reboot'):
+        cues.load_cues(str(path))
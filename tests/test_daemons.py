@@ -0,0 +1,100 @@
+import errno
+import asyncio
+
+import daemons
+
+
+class OverflowingSocket:
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        
+    def recv(self, size):
+        raise self.errors.pop(0)
+
+
+def test_netlink_overflow_triggers_a_rescan():
+    changes = []
+    monitor = daemons.NetlinkMonitor(None, lambda: changes.append(True))
+    monitor._sock = OverflowingSocket(OSError(errno.ENOBUFS, 'No buffer space available'), BlockingIOError())
+    monitor._read()
+    assert changes == [True]
+
+
+class Peer(daemons.PickleStreamProtocol):
+    def __init__(self, loop, config, **kwargs):
+        super().__init__(loop, **dict(config['globals'], **kwargs))
+        self._scanner = self
+        self.received = []
+        self.wire = []
+        
+    def pause(self):
+        pass
+        
+    def process_message(self, payload, timestamp):
+        self.received.append(payload)
+
+
+class Wire:
+    # Transport handing the written bytes straight to the other end
+    def __init__(self, sender, receiver):
+        self.sender = sender
+        self.receiver = receiver
+        
+    def write(self, data):
+        self.sender.wire.append(data)
+        self.receiver.data_received(data)
+        
+    def get_extra_info(self, name):
+        return None
+
+
+def connect(config, **options):
+    loop = asyncio.new_event_loop()
+    first = Peer(loop, config, **options.get('first', {}))
+    second = Peer(loop, config, **options.get('second', {}))
+    first.connection_made(Wire(first, second))
+    second.connection_made(Wire(second, first))
+    loop.run_until_complete(asyncio.sleep(0))
+    return loop, first, second
+
+
+def exchange(loop, sender, receiver, messages):
+    del sender.wire[:]
+    for message in messages:
+        sender.request_peer('/message', message)
+    loop.run_until_complete(asyncio.sleep(0))
+    assert receiver.received[-len(messages):] == messages
+    # First byte of each frame after its length header
+    header = sender._tcp_header_size
+    return [frame[header:header + 1] for frame in sender.wire]
+
+
+MESSAGES = [[index, '06000000{:02d}'.format(index), 'Bravo pour ce spectacle ! ' * 3, False, False, 1, False, index] 
+            for index in range(5)]
+
+
+def test_compression_with_the_preset_dictionary(config):
+    loop, first, second = connect(config)
+    assert exchange(loop, first, second, MESSAGES) == [daemons.COMPRESSED_ZDICT] * 5
+    assert exchange(loop, second, first, MESSAGES[:1]) == [daemons.COMPRESSED_ZDICT]
+    # Later frames refer to the earlier ones of the stream
+    assert max(map(len, first.wire[1:])) < len(first.wire[0]) / 2
+    assert first.link_stats.wire_sent < first.link_stats.raw_sent / 3
+    # Frames too small to be worth it are sent raw
+    first.request_peer('/ping', [0])
+    assert first.wire[-1][first._tcp_header_size:][:1] not in (daemons.COMPRESSED, daemons.COMPRESSED_ZDICT)
+    loop.close()
+
+
+def test_compression_is_negotiated(config):
+    loop, first, second = connect(config, second={'compression_level': 0})
+    # The second peer neither compresses nor asks for compressed frames: raw pickles both ways
+    assert exchange(loop, first, second, MESSAGES[:2]) == [b'\x80'] * 2
+    assert exchange(loop, second, first, MESSAGES[:2]) == [b'\x80'] * 2
+    loop.close()
+
+    loop, first, second = connect(config)
+    # A peer with another dictionary gets frames compressed without it
+    first.process_hello({'compression': ['zlib'], 'zdict': 0}, None)
+    assert exchange(loop, first, second, MESSAGES) == [daemons.COMPRESSED] * 5
+    loop.close()
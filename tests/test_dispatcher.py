@@ -0,0 +1,99 @@
+import time
+import asyncio
+
+import pytest
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web
+
+from SMS_client import SMSDispatcher, sms_accepted
+
+BACKOFF = 0.05
+
+
+def run_with_stub(answers, test, delay=0):
+    # Serve the answers in order, one per request, then '1000' for any further request
+    hits = []
+
+    async def handler(request):
+        hits.append((time.monotonic(), request.query.get('to')))
+        status, text = answers.pop(0) if answers else (200, '1000')
+        if delay:
+            await asyncio.sleep(delay)
+        return web.Response(status=status, text=text)
+
+    async def main():
+        app = web.Application()
+        app.router.add_get('/send', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        dispatcher = SMSDispatcher(asyncio.get_running_loop(), concurrency=2, rate=1000, 
+                                   retries=3, timeout=0.5, backoff=BACKOFF)
+        try:
+            return await test(dispatcher, 'http://127.0.0.1:{}/send?to='.format(port))
+        finally:
+            await dispatcher.close()
+            await runner.cleanup()
+
+    return asyncio.run(main()), hits
+
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_refusals_are_retried_with_backoff(status):
+    result, hits = run_with_stub([(status, 'busy'), (status, 'busy')], lambda d, url: d.get(url + '1'))
+    assert result == '1000'
+    assert len(hits) == 3
+    # Exponential backoff with jitter: base * 2**attempt * [1, 2)
+    assert hits[1][0] - hits[0][0] >= BACKOFF
+    assert hits[2][0] - hits[1][0] >= 2 * BACKOFF
+
+
+def test_retries_are_bounded():
+    async def test(dispatcher, url):
+        with pytest.raises(aiohttp.ClientResponseError) as e:
+            await dispatcher.get(url + '1')
+        return e.value.status
+    status, hits = run_with_stub([(503, 'busy')] * 10, test)
+    assert status == 503
+    assert len(hits) == 4
+
+
+def test_server_errors_are_not_retried():
+    async def test(dispatcher, url):
+        with pytest.raises(aiohttp.ClientResponseError):
+            await dispatcher.get(url + '1')
+    _, hits = run_with_stub([(500, 'oops')], test)
+    assert len(hits) == 1
+
+
+def test_timeouts_are_not_retried():
+    async def test(dispatcher, url):
+        with pytest.raises(asyncio.TimeoutError):
+            await dispatcher.get(url + '1')
+    _, hits = run_with_stub([], test, delay=1)
+    assert len(hits) == 1
+
+
+def test_connection_errors_are_retried():
+    async def main():
+        dispatcher = SMSDispatcher(asyncio.get_running_loop(), rate=1000, retries=2, backoff=BACKOFF)
+        start = time.monotonic()
+        try:
+            with pytest.raises(aiohttp.ClientConnectorError):
+                # Nothing listens on the discard port
+                await dispatcher.get('http://127.0.0.1:9/send')
+        finally:
+            await dispatcher.close()
+        return time.monotonic() - start
+    assert asyncio.run(main()) >= 3 * BACKOFF
+
+
+def test_dispatch_reports_failures():
+    results = {}
+    result, hits = run_with_stub([(500, 'oops')], 
+                                 lambda d, url: d.dispatch(url, ['1', '2', '3'], results.__setitem__))
+    assert result == results
+    assert sorted(sms_accepted(r) for r in results.values()) == [False, True, True]
+    assert len(hits) == 3
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+import jobqueue
+from SMS_client import Client
+
+
+def test_sending_recipients_are_never_sent_again(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite')
+    jobs = jobqueue.SMSJobQueue(path)
+    job_id = jobs.create_job('Verite', 'Bonsoir', ['0600000001', '0600000002', '0600000003'])
+    jobs.mark_sending(job_id, '0600000001')
+    jobs.mark_sending(job_id, '0600000002')
+    jobs.record(job_id, '0600000002', True, '1000')
+    jobs.close()
+
+    jobs = jobqueue.SMSJobQueue(path)
+    assert list(jobs.pending_jobs()) == [(job_id, 'Verite', 'Bonsoir', ['0600000003'])]
+    states = {row[4]: row[5] for row in jobs.receipts(job_id)}
+    assert states == {'0600000001': jobqueue.INTERRUPTED, '0600000002': jobqueue.SENT, 
+                      '0600000003': jobqueue.PENDING}
+    jobs.close()
+
+
+def test_stop_cancels_jobs_before_closing_the_queue(config):
+    web = pytest.importorskip('aiohttp.web')
+    loop = asyncio.new_event_loop()
+
+    async def handler(request):
+        await asyncio.sleep(2)
+
+    async def serve():
+        app = web.Application()
+        app.router.add_get('/send', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        return runner, site._server.sockets[0].getsockname()[1]
+
+    runner, port = loop.run_until_complete(serve())
+    client = Client(loop, config, {})
+    loop.run_until_complete(client.setup())
+    client._base_sms_url = 'http://127.0.0.1:{}/send?'.format(port)
+
+    async def select_recipients(**criteria):
+        return ['0600000001', '0600000002']
+    client.select_recipients = select_recipients
+    # One recipient at a time: the second one is still pending when the first is cut
+    client._dispatcher._concurrency = 1
+    task = client._start_job(client.async_send_sms('Verite', 'Bonsoir', ['0600000001', '0600000002']))
+    loop.run_until_complete(asyncio.sleep(0.3))
+    loop.run_until_complete(client.stop())
+    assert task.cancelled()
+    loop.run_until_complete(runner.cleanup())
+    loop.close()
+
+    # The request in flight may have been billed: only the recipient never tried is resumed
+    jobs = jobqueue.SMSJobQueue(config['client']['jobs_db'])
+    assert [job[3] for job in jobs.pending_jobs()] == [['0600000002']]
+    assert {row[4]: row[5] for row in jobs.receipts()}['0600000001'] == jobqueue.INTERRUPTED
+    jobs.close()
@@ -0,0 +1,40 @@
+import pytest
+
+import moderation
+
+
+def test_word_matcher_finds_overlapping_words_in_one_pass():
+    matcher = moderation.WordMatcher(['he', 'she', 'his', 'hers'])
+    assert len(matcher) == 4
+    assert sorted(matcher.finditer('ushers')) == [(1, 4, 'she'), (2, 4, 'he'), (2, 6, 'hers')]
+    assert list(matcher.finditer('ahis')) == [(1, 4, 'his')]
+
+
+def test_word_matcher_only_matches_whole_words():
+    matcher = moderation.WordMatcher(['con', 'gros mot'])
+    assert matcher.search('quel concert') is None
+    assert matcher.search('un gros moteur') is None
+    assert matcher.search('espece de con!') == 'con'
+    assert matcher.search('un gros mot, deux') == 'gros mot'
+
+
+def test_moderator_ignores_case_accents_and_spacing():
+    moderator = moderation.Moderator(['Crétin', 'gros  mot', ' '])
+    assert moderator.flagged('Quel CRETIN') == 'cretin'
+    assert moderator.flagged('un Gros\n mot') == 'gros mot'
+    assert moderator.flagged('Bravo') is None
+    assert moderation.Moderator().flagged('Crétin') is None
+    with pytest.raises(ValueError):
+        moderation.Moderator(action='delete')
+
+
+def test_fingerprint_collapses_variants_only():
+    assert moderation.fingerprint('Looool !!') == moderation.fingerprint('lol') == 'lol'
+    assert moderation.fingerprint('  Bravo,   Éric ') == moderation.fingerprint('bravo eric')
+    assert moderation.fingerprint('bravo') != moderation.fingerprint('bravo eric')
+
+
+def test_duplicates_are_counted_on_the_first_message(server):
+    for phone, content in (('0600000001', 'Bravooo !'), ('0600000002', 'bravo'), ('0600000003', 'Encore')):
+        server._process_sms(server._reader.record('test', '20170101_200000', phone, content))
+    assert [(message[1], message[4]) for message in server._messages] == [('Bravooo !', 2), ('Encore', 1)]
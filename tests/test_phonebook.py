@@ -0,0 +1,35 @@
+import utils
+import phonebook
+
+
+def vote(phone, timestamp):
+    return utils.Event(timestamp=timestamp, phone=phone, data='VRAI', type=utils.EventTypes.vote)
+
+
+def test_revisions_are_not_reused_after_a_crash(tmp_path):
+    path = str(tmp_path / 'phonebook.sqlite')
+    store = phonebook.PhonebookStore(path)
+    store.record(vote('0600000001', '20170101_200000'), poll='p')
+    store.commit()
+    store.record(vote('0600000002', '20170101_200001'), poll='p')
+    sent_rev = store.rev
+    # Crash: the last changes are never committed
+    store._db.close()
+
+    store = phonebook.PhonebookStore(path)
+    assert store.get('0600000002') is None
+    voter = store.record(vote('0600000003', '20170101_200002'), poll='p')
+    assert voter.rev > sent_rev
+    store.close()
+
+
+def test_select_and_poll_votes(tmp_path):
+    store = phonebook.PhonebookStore(str(tmp_path / 'phonebook.sqlite'))
+    for i, phone in enumerate(('0600000001', '0600000002', '0600000003')):
+        store.record(vote(phone, '20170101_20000{}'.format(i)), poll='p')
+    store.update('0600000002', opt_out=True)
+    assert store.select() == ['0600000001', '0600000003']
+    assert store.select(opt_out=True) == ['0600000002']
+    assert store.select(poll='p', choice='FAUX') == []
+    assert store.poll_votes('p') == {'VRAI': (3, 3)}
+    store.close()
@@ -0,0 +1,64 @@
+import gzip
+import json
+import asyncio
+
+import utils
+import jobqueue
+import timeline
+from SMS_client import Client
+from SMS_recorder import SessionRecorder
+
+
+def test_recorder_leaves_jobs_db_untouched(config, tmp_path):
+    jobs_db = config['client']['jobs_db']
+    jobs = jobqueue.SMSJobQueue(jobs_db)
+    jobs.create_job('Verite', 'Bonsoir', ['0600000001', '0600000002'])
+    jobs.close()
+    with open(jobs_db, 'rb') as f:
+        before = f.read()
+
+    loop = asyncio.new_event_loop()
+    recorder = SessionRecorder(loop, str(tmp_path / 'session.jsonl.gz'))
+    recorder.start()
+    try:
+        with Client(loop, config, recorder.callbacks(), dispatch=False) as client:
+            recorder.client = client
+            assert client._jobs is None and client._dispatcher is None
+            loop.run_until_complete(asyncio.sleep(0.2))
+    finally:
+        recorder.close()
+
+    with open(jobs_db, 'rb') as f:
+        assert f.read() == before
+    jobs = jobqueue.SMSJobQueue(jobs_db)
+    assert [job[3] for job in jobs.pending_jobs()] == [['0600000001', '0600000002']]
+    jobs.close()
+
+
+def test_recorder_archives_the_whole_session(server, config, tmp_path):
+    # Small tiers, so that most of the session is only sent as history pages
+    server._timeline.close()
+    server._timeline = timeline.TieredTimeline(str(tmp_path / 'small.seg'), hot_size=4, spill_size=3, index_interval=2)
+    for second in range(12):
+        server._process_sms(server._reader.record('test', '20170101_2000{:02d}'.format(second), 
+                                                  '06000000{:02d}'.format(second % 3), 'Bravo ' + 'abcdefghijkl'[second]))
+    assert len(server._timeline.cold) == 6
+    path = str(tmp_path / 'session.jsonl.gz')
+    recorder = SessionRecorder(server._loop, path, history_page=2)
+    client = Client(server._loop, config, recorder.callbacks(), dispatch=False)
+    client.request_peer = lambda command, params: getattr(server, 'process_' + command[1:])(params, None)
+    recorder.client = client
+    client.request_peer('/sync', ['', 0, 0, 0])
+    while server.sent:
+        command, params = server.sent.pop(0)
+        getattr(client, 'process_' + command[1:])(params, None)
+    recorder.close()
+
+    with gzip.open(path, 'rt', encoding='utf8') as f:
+        records = [json.loads(line) for line in f]
+    events = sorted(utils.Event(*payload) for kind, timestamp, payload in records if kind == 'event')
+    assert events == server._timeline.cold.read(0, len(server._timeline.cold)) + server._timeline.hot
+    assert [payload[2] for kind, timestamp, payload in records if kind == 'message'] == \
+           ['Bravo ' + letter for letter in 'abcdefghijkl']
+    assert sorted(payload[0] for kind, timestamp, payload in records if kind == 'voter') == \
+           ['0600000000', '0600000001', '0600000002']
@@ -0,0 +1,81 @@
+import asyncio
+
+import utils
+from SMS_server import Server
+
+
+def receive(server, phone, content, timestamp='20170101_200000'):
+    server._process_sms(server._reader.record('test', timestamp, phone, content))
+
+
+def test_stop_opts_out(server):
+    receive(server, '0600000001', 'Bonjour')
+    receive(server, '0600000002', 'Stop !')
+    assert server._phonebook.get('0600000002').opt_out
+    assert not server._phonebook.get('0600000001').opt_out
+    assert [message[1] for message in server._messages] == ['Bonjour']
+
+    server.process_select([1, {'min_messages': 1, 'unknown': 0}], None)
+    assert server.sent == [('/selection', [1, ['0600000001']])]
+
+
+def test_merge_is_a_sliding_hold(server):
+    loop = server._loop
+    server._merge_window = 0.1
+    released = []
+    server._add_event = lambda event: released.append((loop.time(), event.timestamp))
+
+    def vote(timestamp):
+        server._merge_event(utils.Event(timestamp, '0600000001', 'VRAI', utils.EventTypes.vote))
+
+    async def scenario():
+        start = loop.time()
+        vote('20170101_200001')
+        await asyncio.sleep(0.06)
+        vote('20170101_200003')
+        await asyncio.sleep(0.06)
+        # The first event waited the whole window, the second one is still held
+        assert [ts for _, ts in released] == ['20170101_200001']
+        vote('20170101_200002')
+        await asyncio.sleep(0.2)
+        return start
+
+    start = loop.run_until_complete(scenario())
+    assert [ts for _, ts in released] == ['20170101_200001', '20170101_200002', '20170101_200003']
+    # The last two are released together once the earlier one waited its window
+    assert released[1][0] - start >= 0.22
+    assert released[2][0] - released[1][0] < 0.01
+
+
+def test_rate_limit_evicts_on_the_sms_clock(config):
+    config['server']['merge_window'] = 0
+    config['rate_limit'].update(vote_rate=0.1, vote_burst=1)
+    loop = asyncio.new_event_loop()
+    server = Server(loop, config)
+    limit = server._rate_limits[utils.EventTypes.vote]
+    try:
+        receive(server, '0600000001', 'Vrai', '20170101_200000')
+        receive(server, '0600000001', 'Vrai', '20170101_200001')
+        assert server._suppressed['0600000001'] == 1
+        # Years after the SMS on the local clock, but only a second later on the SMS clock
+        server._summarize_suppressed()
+        assert list(limit._buckets) == ['0600000001']
+        receive(server, '0600000002', 'Vrai', '20170101_200100')
+        server._summarize_suppressed()
+        assert list(limit._buckets) == ['0600000002']
+    finally:
+        server._rate_summary.cancel()
+        server._phonebook.close()
+        server._timeline.close()
+        loop.close()
+
+
+def test_votes_after_the_poll_count_for_no_poll(server):
+    server._start_poll('Question', 0, '20170101_200000')
+    poll = server._poll_id
+    receive(server, '0600000001', 'Vrai', '20170101_200001')
+    server._record_finsondage('20170101_200010')
+    receive(server, '0600000002', 'Faux', '20170101_200020')
+    assert server._phonebook.poll_votes(poll) == {'VRAI': (1, 1)}
+    assert server._phonebook.select(poll=poll) == ['0600000001']
+    assert server._phonebook.get('0600000002').votes == 1
@@ -0,0 +1,84 @@
+import asyncio
+
+import sessioncache
+from SMS_client import Client
+
+
+def receive(server, phone, content, timestamp='20170101_200000'):
+    server._process_sms(server._reader.record('test', timestamp, phone, content))
+
+
+def console(server, config):
+    return Client(server._loop, config, {}, session_cache=config['client']['session_cache'], dispatch=False)
+
+
+def sync(server, client):
+    # What the console sends when connected, and the server answers until /synced
+    session = client._session
+    server.process_sync([session['session_id'], session['event_seq'], session['message_rev'], 
+                         session['phonebook_rev']], None)
+    deliver(server, client)
+
+
+def deliver(server, client):
+    # Live updates are sent from loop callbacks
+    server._loop.run_until_complete(asyncio.sleep(0))
+    for command, params in server.sent:
+        getattr(client, 'process_' + command[1:])(params, None)
+    del server.sent[:]
+
+
+def cached(config):
+    cache = sessioncache.SessionCache(config['client']['session_cache'])
+    try:
+        return cache.meta, cache.events(), [message[2] for message in cache.messages()], \
+               [voter.phone for voter in cache.voters()]
+    finally:
+        cache.close()
+
+
+def test_console_only_gets_what_it_missed(server, config, tmp_path):
+    config['client']['session_cache'] = str(tmp_path / 'session.sqlite')
+    receive(server, '0600000001', 'Bonjour')
+    receive(server, '0600000002', 'Bravo', '20170101_200001')
+    client = console(server, config)
+    sync(server, client)
+    receive(server, '0600000003', 'Encore', '20170101_200002')
+    deliver(server, client)
+    client._cache.close()
+    meta, events, messages, phones = cached(config)
+    assert meta['session_id'] == server._session_id
+    assert meta['event_seq'] == server._timeline.seq
+    assert events == server._timeline.hot
+    assert messages == ['Bonjour', 'Bravo', 'Encore']
+    assert phones == ['0600000001', '0600000002', '0600000003']
+
+    # Missed while the console was closed
+    server._peer_synced = False
+    receive(server, '0600000001', 'Merci', '20170101_200003')
+    client = console(server, config)
+    session = client._session
+    server.process_sync([session['session_id'], session['event_seq'], session['message_rev'], 
+                         session['phonebook_rev']], None)
+    assert server.sent[0] == ('/session', [server._session_id, False])
+    assert [params[1:] for command, params in server.sent if command == '/event'] == [list(server._timeline.hot[-1])]
+    assert [params[2] for command, params in server.sent if command == '/message'] == ['Merci']
+    assert [params[0] for command, params in server.sent if command == '/voter'] == ['0600000001']
+    deliver(server, client)
+    client._cache.close()
+    meta, events, messages, phones = cached(config)
+    assert events == server._timeline.hot
+    assert messages == ['Bonjour', 'Bravo', 'Encore', 'Merci']
+
+    # The server restarted with a new session
+    server._session_id = 'restarted'
+    server._messages[0][1] = ''
+    client = console(server, config)
+    sync(server, client)
+    client._cache.close()
+    meta, events, messages, phones = cached(config)
+    assert meta['session_id'] == 'restarted'
+    assert meta['event_seq'] == server._timeline.seq
+    assert events == server._timeline.hot
+    assert messages == ['Bravo', 'Encore', 'Merci']
+    assert len(phones) == 3
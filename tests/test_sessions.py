@@ -0,0 +1,55 @@
+import asyncio
+import logging
+
+import pytest
+
+import utils
+import daemons
+from conftest import load_config
+
+SESSIONS = '''
+[sessions]
+    [[salle1]]
+        [[[globals]]]
+        secret = salle1
+        [[[server]]]
+        phonebook_db = {tmp}/salle1.sqlite
+        sql_inbox = {sql1}
+        [[[timeline]]]
+        segment = {tmp}/salle1.seg
+    [[salle2]]
+        [[[globals]]]
+        secret = salle2
+        [[[server]]]
+        phonebook_db = {tmp}/salle2.sqlite
+        sql_inbox = {sql2}
+        [[[timeline]]]
+        segment = {tmp}/salle2.seg
+'''
+
+
+def test_sessions_without_sql_inbox(tmp_path):
+    config = load_config(tmp_path, SESSIONS.format(tmp=tmp_path, sql1='', sql2=''))
+    assert sorted(config['sessions']) == ['salle1', 'salle2']
+
+
+def test_sessions_sharing_sql_inbox(tmp_path):
+    with pytest.raises(utils.ConfigError, match='sql_inbox'):
+        load_config(tmp_path, SESSIONS.format(tmp=tmp_path, sql1='smsd.db', sql2='smsd.db'))
+
+
+def test_logs_are_forwarded_to_their_session_only():
+    loop = asyncio.new_event_loop()
+    received = {'salle1': [], 'salle2': []}
+    handlers = [daemons.PeerLogHandler(loop, received[name].append, session=name) for name in received]
+    logger = logging.getLogger('test sessions')
+    logger.propagate = False
+    logger.handlers[:] = handlers
+    logging.LoggerAdapter(logger, {'session': 'salle1'}).warning('salle1 only')
+    logging.LoggerAdapter(logger, {'session': 'salle2'}).error('salle2 only')
+    logger.warning('shared')
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+    assert [payload[2] for payload in received['salle1']] == ['salle1 only', 'shared']
+    assert [payload[2] for payload in received['salle2']] == ['salle2 only', 'shared']
+
@@ -0,0 +1,94 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import daemons
+
+# Columns of the gammu-smsd inbox table read by the watcher, with the type affinities of the gammu schema
+SCHEMA = '''
+CREATE TABLE inbox (
+    UpdatedInDB NUMERIC NOT NULL DEFAULT (datetime('now')),
+    ReceivingDateTime NUMERIC NOT NULL DEFAULT (datetime('now')),
+    Text TEXT NOT NULL DEFAULT '',
+    SenderNumber TEXT NOT NULL DEFAULT '',
+    Coding TEXT NOT NULL DEFAULT 'Default_No_Compression',
+    UDH TEXT NOT NULL DEFAULT '',
+    SMSCNumber TEXT NOT NULL DEFAULT '',
+    Class INTEGER NOT NULL DEFAULT -1,
+    TextDecoded TEXT NOT NULL DEFAULT '',
+    ID INTEGER PRIMARY KEY AUTOINCREMENT,
+    RecipientID TEXT NOT NULL DEFAULT '',
+    Processed TEXT NOT NULL DEFAULT 'false',
+    Status INTEGER NOT NULL DEFAULT -1
+);
+'''
+
+
+@pytest.fixture
+def inbox(tmp_path):
+    path = str(tmp_path / 'smsd.db')
+    db = sqlite3.connect(path)
+    # NOT NULL is dropped so that rows broken like those of a faulty writer can be stored
+    db.executescript(SCHEMA.replace(' NOT NULL', ''))
+    yield path, db
+    db.close()
+
+
+def insert(db, rows):
+    with db:
+        db.executemany('INSERT INTO inbox (ReceivingDateTime, SenderNumber, TextDecoded) VALUES (?, ?, ?)', rows)
+
+
+def watcher(server, path, last_id=0):
+    sql_watcher = daemons.SQLInboxWatcher(path, server.got_sql_sms, batch_size=2, last_id=last_id)
+    sql_watcher._db = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    return sql_watcher
+
+
+def test_batches_skip_invalid_rows_and_resume_by_id(server, inbox):
+    path, db = inbox
+    insert(db, [('2017-01-01 20:00:00', '+33600000001', 'Vrai'), 
+                (None, '+33600000002', 'Faux'), 
+                ('yesterday', '+33600000003', 'Faux'), 
+                ('2017-01-01 20:00:02', None, 'Bonjour'), 
+                ('2017-01-01 20:00:03', '+33600000005', 'Bravo')])
+    first = watcher(server, path)
+    first.fetch()
+    assert first.last_id == 5
+    assert first.count == 5
+    assert [server._phonebook.get('060000000{}'.format(i)) is not None for i in range(1, 6)] == \
+           [True, False, False, False, True]
+
+    insert(db, [('2017-01-01 20:00:04', '+33600000006', 'Oui')])
+    resumed = watcher(server, path, last_id=first.last_id)
+    resumed.fetch()
+    assert resumed.last_id == 6
+    assert resumed.count == 1
+    assert server._phonebook.get('0600000006').votes == 1
+    first._db.close()
+    resumed._db.close()
+
+
+def test_locked_database_is_read_on_a_later_tick(inbox):
+    path, db = inbox
+    loop = asyncio.new_event_loop()
+    received = []
+    sql_watcher = daemons.SQLInboxWatcher(path, lambda *row: received.append(row[0]), poll_interval=0.05)
+    sql_watcher._db = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True, timeout=sql_watcher.LOCK_TIMEOUT)
+    sql_watcher._loop = loop
+    sql_watcher._changed = asyncio.Event()
+    sql_watcher._listen_to_inotify = lambda: asyncio.sleep(3600)
+    insert(db, [('2017-01-01 20:00:00', '+33600000001', 'Vrai')])
+    db.execute('BEGIN EXCLUSIVE')
+    task = loop.create_task(sql_watcher.listen_to_database())
+    loop.run_until_complete(asyncio.sleep(0.3))
+    assert not task.done()
+    assert received == []
+    db.rollback()
+    loop.run_until_complete(asyncio.sleep(0.3))
+    assert received == [1]
+    task.cancel()
+    loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+    loop.close()
+    sql_watcher._db.close()
@@ -0,0 +1,66 @@
+import pytest
+
+import utils
+import timeline
+
+
+def event(second, phone='0600000001'):
+    return utils.Event('20170101_20{:04d}'.format(second), phone, 'SMS {}'.format(second), utils.EventTypes.message)
+
+
+@pytest.fixture
+def events(tmp_path):
+    events = timeline.TieredTimeline(str(tmp_path / 'timeline.seg'), hot_size=4, spill_size=3, index_interval=2)
+    yield events
+    events.close()
+
+
+def test_old_events_are_spilled_by_batches(events):
+    for second in range(20):
+        events.add(event(second))
+    assert (len(events.cold), len(events.hot)) == (15, 5)
+    assert events.cold.read(0, 20) + events.hot == [event(second) for second in range(20)]
+    assert events.cold.read(14, 15)[0].type is utils.EventTypes.message
+    # A late SMS older than the spilled events waits in memory for the next batch
+    events.add(event(0, '0600000002'))
+    events.add(event(20))
+    events.add(event(21))
+    assert len(events.cold) == 18
+    assert events.cold.read(15, 16) == [event(0, '0600000002')]
+
+
+def test_history_pages_by_position_and_timestamp(events):
+    for second in range(20):
+        events.add(event(second))
+    pages = []
+    before = len(events.cold)
+    while before:
+        before, page = events.history(before, 4)
+        pages.insert(0, page)
+    assert [len(page) for page in pages] == [3, 4, 4, 4]
+    assert sum(pages, []) == [event(second) for second in range(15)]
+    for second in range(16):
+        assert events.history(event(second).timestamp, 2) == (max(second - 2, 0), [event(s) for s in range(max(second - 2, 0), second)])
+    assert events.history('20170101_199999', 2) == (0, [])
+    assert events.history('20170101_209999', 2) == (13, [event(13), event(14)])
+
+
+def test_since_falls_back_when_events_are_not_kept(events):
+    for second in range(6):
+        events.add(event(second))
+    events.add(event(1, '0600000002'))
+    assert events.seq == 7
+    assert events.since(7) == []
+    assert events.since(5) == [event(5), event(1, '0600000002')]
+    assert events.since(3) == [event(3), event(4), event(5), event(1, '0600000002')]
+    assert events.since(2) is None
+    assert events.since(8) is None
+
+
+def test_sync_resets_a_console_too_far_behind(server):
+    server._timeline._recent.clear()
+    server.process_sync([server._session_id, server._timeline.seq, 0, 0], None)
+    assert server.sent[0] == ('/session', [server._session_id, False])
+    del server.sent[:]
+    server.process_sync([server._session_id, server._timeline.seq - 1, 0, 0], None)
+    assert server.sent[:2] == [('/session', [server._session_id, True]), ('/history_start', 0)]
@@ -0,0 +1,15 @@
+import queue
+import logging
+
+import utils
+
+
+def test_queued_records_keep_the_arguments_at_emit_time():
+    log_queue = queue.Queue()
+    handler = utils.DeferredQueueHandler(log_queue)
+    votes = ['vrai']
+    handler.handle(logging.makeLogRecord({'msg': 'votes %s', 'args': (votes,)}))
+    votes.append('faux')
+    record = log_queue.get_nowait()
+    assert record.getMessage() == "votes ['vrai']"
+    assert record.args is None
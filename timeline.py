@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) 2017 Benoit Bregeault
+
+# ---------------------------------------------------------------------
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# Standard library
+import os
+import json
+import mmap
+import bisect
+import struct
+import logging
+from collections import deque
+
+# Application
+import utils
+
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct('<I')
+
+
+class SegmentFile:
+    # Append-only file of length prefixed JSON events, read back through mmap.
+    # The sparse index holds the offset and the timestamp of every index_interval-th record
+    def __init__(self, path, index_interval=64):
+        self.path = path
+        # The timeline belongs to the server session: the segment is not kept across restarts
+        self._file = open(path, 'w+b')
+        self._index_interval = index_interval
+        self._offsets = []
+        self._timestamps = []
+        self._size = 0
+        self._count = 0
+        self._map = None
+
+    def __repr__(self):
+        return "{}('{}')".format(self.__class__.__qualname__, self.path)
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+        os.remove(self.path)
+
+    def append(self, events):
+        chunks = []
+        for event in events:
+            if self._count % self._index_interval == 0:
+                self._offsets.append(self._size)
+                self._timestamps.append(event.timestamp)
+            data = json.dumps(event, ensure_ascii=False).encode('utf8')
+            chunks.append(RECORD_HEADER.pack(len(data)))
+            chunks.append(data)
+            self._size += RECORD_HEADER.size + len(data)
+            self._count += 1
+        self._file.write(b''.join(chunks))
+        self._file.flush()
+
+    def _view(self):
+        # The map is only rebuilt when records were appended since the last read
+        if self._map is None or len(self._map) < self._size:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), self._size, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _records(self, position):
+        # (position, offset) of every record from the indexed one before position
+        entry = position // self._index_interval
+        position, offset = entry * self._index_interval, self._offsets[entry]
+        while position < self._count:
+            yield position, offset
+            length, = RECORD_HEADER.unpack_from(self._map, offset)
+            position += 1
+            offset += RECORD_HEADER.size + length
+
+    def _decode(self, offset):
+        length, = RECORD_HEADER.unpack_from(self._map, offset)
+        start = offset + RECORD_HEADER.size
+        timestamp, phone, data, type = json.loads(self._map[start:start + length].decode('utf8'))
+        return utils.Event(timestamp, phone, data, utils.EventTypes(type))
+
+    def read(self, start, stop):
+        start, stop = max(start, 0), min(stop, self._count)
+        if start >= stop:
+            return []
+        self._view()
+        events = []
+        for position, offset in self._records(start):
+            if position >= stop:
+                break
+            if position >= start:
+                events.append(self._decode(offset))
+        return events
+
+    def position(self, timestamp):
+        # First record not older than timestamp: bisection of the sparse index, then a short scan
+        entry = bisect.bisect_left(self._timestamps, timestamp) - 1
+        if entry < 0:
+            return 0
+        self._view()
+        for position, offset in self._records(entry * self._index_interval):
+            if self._decode(offset).timestamp >= timestamp:
+                return position
+        return self._count
+
+
+class TieredTimeline:
+    # Session events sorted by time: the most recent ones in memory, the older
+    # ones spilled by batches of spill_size to the segment file. An event older
+    # than the last spilled one is rare (late SMS of a merged inbox): it is
+    # spilled with the next batch, consoles insert the events they get in order.
+    # Events are also numbered in arrival order, and the last hot_size ones are
+    # kept in that order for consoles catching up from their last event
+    def __init__(self, path, hot_size=5000, spill_size=1000, index_interval=64):
+        self.hot = []
+        self.cold = SegmentFile(path, index_interval)
+        self.seq = 0
+        self._recent = deque(maxlen=hot_size)
+        self._hot_size = hot_size
+        self._spill_size = spill_size
+
+    def __repr__(self):
+        return '{}({!r}, hot={}, cold={})'.format(self.__class__.__qualname__, self.cold, 
+                                                  len(self.hot), len(self.cold))
+
+    def __len__(self):
+        return len(self.hot) + len(self.cold)
+
+    def close(self):
+        self.cold.close()
+
+    def add(self, event):
+        self.seq += 1
+        self._recent.append(event)
+        utils.insort_record(self.hot, event)
+        if len(self.hot) > self._hot_size + self._spill_size:
+            self.cold.append(self.hot[:self._spill_size])
+            del self.hot[:self._spill_size]
+            logger.debug('Spilled %d events to %r, %d in memory', self._spill_size, self.cold, len(self.hot))
+        return self.seq
+
+    def since(self, seq):
+        # Events added after number seq, None when they are not all kept anymore
+        missing = self.seq - seq
+        if missing < 0 or missing > len(self._recent):
+            return None
+        return list(self._recent)[len(self._recent) - missing:]
+
+    def history(self, before, limit):
+        # Page of the spilled events preceding position before, or timestamp before
+        if isinstance(before, str):
+            before = self.cold.position(before)
+        start = max(min(before, len(self.cold)) - limit, 0)
+        return start, self.cold.read(start, before)
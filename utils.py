@@ -21,63 +21,140 @@
 
 
 # Standard library
-import re
+import sys
+import copy
+import time
+import pickle
+import hashlib
+import queue
 import os.path
 import bisect
+import logging
+import asyncio
+from logging.handlers import QueueHandler, QueueListener
 from enum import IntEnum
-from collections import namedtuple, Iterable
+from functools import lru_cache
+from collections import namedtuple
+from collections.abc import Iterable
 
 # Third Party
 from pythonosc.osc_message_builder import OscMessageBuilder
 from pythonosc.osc_message import OscMessage
-from configobj import ConfigObj, ConfigObjError
-from validate import VdtTypeError, VdtValueError, Validator
 
 
 CLIENT_ID = '     CLIENT     '
 
 Event = namedtuple('Event', ('timestamp', 'phone', 'data', 'type'))
-EventTypes = IntEnum('EventTypes', 'vrai faux message sondage fin_sondage')
-https_re = r'https://.*\..*/.*\?'
+EventTypes = IntEnum('EventTypes', 'vrai faux message sondage fin_sondage vote')
+# vrai and faux are the votes of sessions recorded before multi-choice polls
+VOTE_TYPES = (EventTypes.vrai, EventTypes.faux, EventTypes.vote)
+CONFIG_CACHE_EXT = '.cache'
+# The validation rules are part of the cache key: a cache written by another version is not used
+CONFIGURATION_MODULE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'configuration.py')
 
 
-def validate_https_url(value):
-    if not isinstance(value, str):
-        raise VdtTypeError(value)
-    elif not re.fullmatch(https_re, value):
-        raise VdtValueError(value)
-    return value
-    
-def validate_directory(value):
-    if not isinstance(value, str):
-        raise VdtTypeError(value)
-    if not os.path.isdir:
-        raise VdtValueError(value)
-    return value
-    
-def validate_re(value):
-    if not isinstance(value, str):
-        raise VdtTypeError(value)
+class ConfigError(ValueError):
+    pass
+
+
+def load_config(configfile, specfile=None):
+    # The validated configuration is cached next to the config file, keyed by the hash of both
+    # files and of the validation code: a restart with unchanged files skips configobj and the
+    # validation altogether
+    config_text = configfile.read()
+    spec_text = specfile.read() if specfile else ''
+    with open(CONFIGURATION_MODULE, 'rb') as f:
+        key = hashlib.sha256(f.read())
+    key.update('\0'.join((config_text, spec_text)).encode('utf8'))
+    key = key.hexdigest()
+    cache_path = configfile.name + CONFIG_CACHE_EXT
     try:
-        re.compile(value)
-    except Exception:
-        raise VdtValueError(value)
-    return value
-    
-check_functions = { 'https_url': validate_https_url, 
-                    'directory': validate_directory,
-                    're': validate_re, 
-                  }
-custom_validator = Validator(check_functions)
-    
-def parse_configfile(configfile, configspec):
-    config = ConfigObj(configfile, configspec=configspec, interpolation=False, encoding='utf8')
-    passed = config.validate(custom_validator)
-    if passed is not True:
-        sections = [k for k, v in passed.items() if v is not True]
-        raise ConfigObjError('Error in config file sections {}'.format(sections))
+        with open(cache_path, 'rb') as f:
+            cached_key, config = pickle.load(f)
+        # Inbox directories are checked again, as the validation did: one may have been removed since
+        if cached_key == key and all(os.path.isdir(directory) for directory in config_directories(config)):
+            return config
+    except (OSError, ValueError, KeyError, EOFError, pickle.UnpicklingError):
+        pass
+
+    import configuration
+    try:
+        config = configuration.parse_configfile(config_text.splitlines(), 
+                                                spec_text.splitlines() if specfile else None)
+    except configuration.ConfigObjError as e:
+        raise ConfigError(e) from e
+    config = config.dict()
+    try:
+        # The SMS service credentials are in it: only readable by the owner
+        fd = os.open(cache_path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((key, config), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError as e:
+        logging.getLogger(__name__).debug('Configuration not cached: %r', e)
     return config
 
+def config_directories(config):
+    sessions = config.get('sessions') or {'': config}
+    return [directory for session in sessions.values() for directory in session['server']['inbox']]
+
+def process_uptime():
+    # Wall time since the process started, from /proc on Linux, None elsewhere
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+
+
+class StartupProfile:
+    # Wall time of each startup phase, reported on stderr by --profile-startup.
+    # The first phase covers the interpreter startup and the eager imports
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = []
+        uptime = process_uptime()
+        if uptime is not None:
+            self.phases.append(('interpreter and imports', uptime))
+        self._last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self):
+        if not self.enabled:
+            return
+        lines = ['Startup profile ({} modules loaded):'.format(len(sys.modules))]
+        lines.extend('  {:<28}{:>8.1f} ms'.format(phase, seconds * 1000) for phase, seconds in self.phases)
+        lines.append('  {:<28}{:>8.1f} ms'.format('total', sum(seconds for _, seconds in self.phases) * 1000))
+        print('\n'.join(lines), file=sys.stderr)
+
+
+def new_event_loop(implementation='auto'):
+    # auto uses uvloop when it is installed, uvloop fails if it is not
+    if implementation in ('auto', 'uvloop'):
+        try:
+            import uvloop
+        except ImportError:
+            if implementation == 'uvloop':
+                raise
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
+
+@lru_cache(maxsize=256)
+def timestamp_seconds(timestamp, timestamp_format):
+    # SMS arrive by bursts within the same second: parse each timestamp once
+    return time.mktime(time.strptime(timestamp, timestamp_format))
+
 def insort_record(sorted_list, record):
     if not sorted_list or record >= sorted_list[-1]:
         index = len(sorted_list)
@@ -87,6 +164,19 @@ def insort_record(sorted_list, record):
         sorted_list.insert(index, record)
     return index
 
+def start_log_listener(level, *handlers):
+    if not handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        handlers = (handler,)
+    log_queue = queue.Queue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers[:] = [DeferredQueueHandler(log_queue)]
+    listener.start()
+    return listener
+
 def forge_secret(secret, port, endianness='big'):
     return secret.encode('utf8') + port.to_bytes(2, endianness)
 
@@ -124,3 +214,71 @@ class CustomOscMessage(OscMessage):
             
     def __repr__(self):
         return "{}('{_address_regexp}', {_parameters})".format(self.__class__.__qualname__, **self.__dict__)
+
+
+class DeferredQueueHandler(QueueHandler):
+    # Formatting is left to the listener thread: the emitting thread (usually
+    # the event loop) only merges the arguments, which may change once queued
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self._clock = clock
+        self._tokens = self.burst
+        self._stamp = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def consume(self, tokens=1):
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+
+class KeyedTokenBuckets:
+    # One token bucket per key, stored as (tokens, stamp) in a single dict.
+    # A bucket idle long enough to be full again is the same as no bucket, so it can be evicted.
+    # now can be given by the caller, e.g. the time of an SMS replayed from an inbox
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self._clock = clock
+        self._buckets = {}
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def consume(self, key, tokens=1, now=None):
+        if now is None:
+            now = self._clock()
+        state = self._buckets.get(key)
+        if state is None:
+            available = self.burst
+        else:
+            # Out of order times never take tokens back
+            now = max(now, state[1])
+            available = min(self.burst, state[0] + (now - state[1]) * self.rate)
+        allowed = available >= tokens
+        self._buckets[key] = (available - tokens if allowed else available, now)
+        return allowed
+
+    def evict_idle(self, now=None):
+        if now is None:
+            now = self._clock()
+        burst, rate = self.burst, self.rate
+        idle = [key for key, (tokens, stamp) in self._buckets.items() if tokens + (now - stamp) * rate >= burst]
+        for key in idle:
+            del self._buckets[key]
+        return len(idle)
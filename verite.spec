@@ -7,24 +7,104 @@ secret = string
 timestamp_format = string(default='%Y%m%d_%H%M%S')
 endianness = option('big', 'little', default='big')
 tcp_header_size = integer(1, 4, default=4)
+scan_interval = float(min=0.1, default=1)
+netlink = boolean(default=True)
+netlink_fallback_interval = float(min=1, default=30)
+heartbeat_interval = float(min=0.1, default=1)
+heartbeat_timeout = float(min=0.2, default=3.5)
+# zlib compression of the frames of the TCP link, 0 to disable. Smaller frames are sent raw
+compression_level = integer(0, 9, default=6)
+compression_min_size = integer(min=0, default=64)
+# Event loop implementation, auto uses uvloop when it is installed
+event_loop = option('auto', 'asyncio', 'uvloop', default='auto')
 
 [regex]
 port_pattern = re(default='(?P<port>..)')
 sms_pattern = re(default='IN(?P<timestamp>\d{8}_\d{6}).*(\+33|0)(?P<phone>\d{9}).*txt')
-vote_pattern = re(default='^((?P<vrai>v(rai)?|o(ui)?)|f(aux)?|n(on)?)$')
+sender_pattern = re(default='(\+33|0)(?P<phone>\d{9})$')
+
+[poll]
+# Poll choices and the pattern of each, matched on the whole SMS in lowercase without accents.
+# Each vote is sent to the display as /<choice in lowercase>
+choices = string_list(default=list('VRAI', 'FAUX'))
+patterns = string_list(default=list('v(rai)?|o(ui)?', 'f(aux)?|n(on)?'))
+# Automatic network SMS to skip
+blocklist = string_list(default=list('delivered', '.*ce correspondant a cherche a vous joindre.*'))
+
+[moderation]
+# Words or phrases flagged in messages, matched as whole words in lowercase without accents
+words = string_list(default=list())
+# Optional file with one word or phrase per line, lines starting with # are ignored
+words_file = string(default='')
+# flag: shown with a warning color on the console, hide: kept out of the messages columns
+action = option('flag', 'hide', default='flag')
+# Collapse messages differing only by case, accents, punctuation or repeated letters into one with a count
+collapse_duplicates = boolean(default=True)
 
 [server]
-inbox = directory
+# One inbox directory per gammu-smsd instance (modem), comma separated
+inbox = directory_list(default=list())
+# gammu-smsd SQLite database, read next to or instead of the inbox directories
+sql_inbox = string(default='')
+sql_poll_interval = float(min=0.01, default=0.5)
+sql_batch_size = integer(min=1, default=500)
+# SMS opting out of the SMS sent by the console, compared without case, accents, punctuation or repeated letters
+opt_out_keywords = string_list(default=list('stop', 'stop sms', 'arret'))
+merge_window = float(min=0, default=0.2)
+# Worker processes reading and classifying inbox files, 0 to do it in the server process
+workers = integer(0, 16, default=0)
+inbox_stats_interval = float(min=0, default=60)
+phonebook_db = string(default='verite_phonebook.sqlite')
+reconnect_attempts = integer(0, 100, default=10)
+reconnect_delay = float(min=0.01, default=0.2)
+log_forward_level = option('INFO', 'WARNING', 'ERROR', 'CRITICAL', default='WARNING')
+log_forward_rate = float(min=0, default=10)
+log_forward_burst = integer(min=1, default=50)
+
+[rate_limit]
+# SMS per second and burst allowed for each phone, by event type. A rate of 0 disables the limit
+vote_rate = float(min=0, default=0)
+vote_burst = integer(min=1, default=5)
+message_rate = float(min=0, default=0)
+message_burst = integer(min=1, default=5)
+# Period of the suppressed SMS summary in the log and of the eviction of idle phones
+summary_interval = float(min=1, default=10)
+
+[timeline]
+# Most recent events kept in memory, older ones are spilled by batches to the segment file
+segment = string(default='verite_timeline.seg')
+hot_size = integer(min=100, default=5000)
+spill_size = integer(min=10, default=1000)
+# One record out of index_interval is indexed in memory
+index_interval = integer(min=1, default=64)
+# Maximum number of events of a history page sent to a console
+history_page = integer(min=10, default=500)
+
+[cues]
+# JSON cue list of a scripted show, see cues.py
+file = string(default='')
+# Cues fired later than this, in seconds, are logged as warnings
+late_warning = float(min=0, default=0.05)
 
 [display]
 addr = ip_addr
 port = integer(1000, 65535)
 
 [client]
+jobs_db = string(default='verite_jobs.sqlite')
+# Local copy of the session shown at once when the console restarts, empty to disable
+session_cache = string(default='verite_session.sqlite')
+frame_budget = float(min=0.001, max=0.1, default=0.008)
+broadcast_min_interval = float(min=0.05, default=0.2)
+broadcast_max_interval = float(min=0.1, default=5)
 
 [sms_service]
 fastapi_url = https_url
 credits_url = https_url
+concurrency = integer(1, 100, default=8)
+rate = float(min=0.1, default=10)
+retries = integer(0, 10, default=3)
+timeout = float(min=1, default=10)
 
     [[credentials]]
     accountid = string
@@ -32,3 +112,9 @@ credits_url = https_url
 
     [[send_options]]
     datacoding = option(0, 8, 16)
+
+# Optional [sessions] section of the config file, for several shows served by one process:
+# one subsection per show holding the sections and options that differ from the rest of the
+# file, at least [[[globals]]] secret, [[[server]]] inbox and phonebook_db and [[[timeline]]]
+# segment, and sql_inbox when one is used. Discovery and worker options are shared, see
+# configuration.SHARED_OPTIONS